@@ -61,6 +61,10 @@ except IOError:
 DJANGO_SETTINGS_ADMIN_EMAIL = config.get('DJANGO_SETTINGS', 'DJANGO_SETTINGS_ADMIN_EMAIL')
 DJANGO_SETTINGS_ADMIN_NAME = config.get('DJANGO_SETTINGS', 'DJANGO_SETTINGS_ADMIN_NAME')
 DJANGO_SETTINGS_CACHE = config.get('DJANGO_SETTINGS', 'DJANGO_SETTINGS_CACHE', fallback="/var/tmp/django-cache")
+# "file", "locmem", "memcached" or "redis". For "memcached" and "redis", DJANGO_SETTINGS_CACHE is the server location
+DJANGO_SETTINGS_CACHE_BACKEND = config.get('DJANGO_SETTINGS', 'DJANGO_SETTINGS_CACHE_BACKEND', fallback="file")
+DJANGO_SETTINGS_CACHE_STATISTICS = config.getboolean('DJANGO_SETTINGS', 'DJANGO_SETTINGS_CACHE_STATISTICS',
+                                                     fallback=False)
 DJANGO_SETTINGS_DATABASE_ENGINE = config.get('DJANGO_SETTINGS', 'DJANGO_SETTINGS_DATABASE_ENGINE',
                                              fallback="django.db.backends.postgresql")
 DJANGO_SETTINGS_DATABASE_HOST = config.get('DJANGO_SETTINGS', 'DJANGO_SETTINGS_DATABASE_HOST', fallback="127.0.0.1")
@@ -99,11 +103,18 @@ REPANIER_SETTINGS_CUSTOM_CUSTOMER_PRICE = config.getboolean('REPANIER_SETTINGS',
 REPANIER_SETTINGS_DELIVERY_POINT = config.getboolean('REPANIER_SETTINGS', 'REPANIER_SETTINGS_DELIVERY_POINT',
                                                      fallback=False)
 REPANIER_SETTINGS_DEMO = config.getboolean('REPANIER_SETTINGS', 'REPANIER_SETTINGS_DEMO', fallback=False)
+# Full text search of the offer items on the order form, PostgreSQL only. See repanier.search
+REPANIER_SETTINGS_FULL_TEXT_SEARCH = config.getboolean('REPANIER_SETTINGS', 'REPANIER_SETTINGS_FULL_TEXT_SEARCH',
+                                                       fallback=DJANGO_SETTINGS_DATABASE_ENGINE.startswith(
+                                                           "django.db.backends.postgresql"))
 REPANIER_SETTINGS_GROUP = config.getboolean('REPANIER_SETTINGS', 'REPANIER_SETTINGS_GROUP', fallback=False)
 REPANIER_SETTINGS_IS_MINIMALIST = config.getboolean('REPANIER_SETTINGS', 'REPANIER_SETTINGS_IS_MINIMALIST',
                                                     fallback=True)
 REPANIER_SETTINGS_MANAGE_ACCOUNTING = config.getboolean('REPANIER_SETTINGS', 'REPANIER_SETTINGS_MANAGE_ACCOUNTING',
                                                         fallback=True)
+# Processes rendering the order documents of the producers and the customers. 0 : one per CPU, 1 : no pool
+REPANIER_SETTINGS_ORDER_DOCUMENT_PROCESSES = config.getint('REPANIER_SETTINGS',
+                                                           'REPANIER_SETTINGS_ORDER_DOCUMENT_PROCESSES', fallback=0)
 REPANIER_SETTINGS_PRE_OPENING = config.getboolean('REPANIER_SETTINGS', 'REPANIER_SETTINGS_PRE_OPENING', fallback=False)
 REPANIER_SETTINGS_PRODUCT_LABEL = config.getboolean('REPANIER_SETTINGS', 'REPANIER_SETTINGS_PRODUCT_LABEL',
                                                     fallback=False)
@@ -673,16 +684,53 @@ DJANGO_SETTINGS_MULTIPLE_LANGUAGE = len(LANGUAGES) > 1
 CACHE_MIDDLEWARE_ALIAS = 'default'
 CACHE_MIDDLEWARE_SECONDS = 3600
 
-CACHES = {
-    'default': {
+if DJANGO_SETTINGS_CACHE_BACKEND == "locmem":
+    # Local to each process : for the tests or a single process deployment
+    CACHE_DEFAULT = {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': ALLOWED_HOSTS[0],
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+            'CULL_FREQUENCY': 3
+        }
+    }
+elif DJANGO_SETTINGS_CACHE_BACKEND == "memcached":
+    # Shared by the processes. Requires python-memcached. E.g. DJANGO_SETTINGS_CACHE=unix:/tmp/memcached.sock
+    CACHE_DEFAULT = {
+        'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+        'LOCATION': DJANGO_SETTINGS_CACHE,
+        'KEY_PREFIX': ALLOWED_HOSTS[0],
+    }
+elif DJANGO_SETTINGS_CACHE_BACKEND == "redis":
+    # Shared by the processes. Requires django-redis. E.g. DJANGO_SETTINGS_CACHE=redis://127.0.0.1:6379/1
+    CACHE_DEFAULT = {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': DJANGO_SETTINGS_CACHE,
+        'KEY_PREFIX': ALLOWED_HOSTS[0],
+    }
+else:
+    CACHE_DEFAULT = {
         'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
         'LOCATION': os.path.join(DJANGO_SETTINGS_CACHE, ALLOWED_HOSTS[0]),
-        'TIMEOUT': 3000,
         'OPTIONS': {
             'MAX_ENTRIES': 10000,
             'CULL_FREQUENCY': 3
         }
     }
+CACHE_DEFAULT['TIMEOUT'] = 3000
+# Stamp the cached pages with a version : see repanier.cache.invalidate_cache
+CACHE_DEFAULT['KEY_FUNCTION'] = 'repanier.cache.make_key'
+if DJANGO_SETTINGS_CACHE_STATISTICS:
+    # Count the hits, misses and time spent into the cache : displayed into the configuration admin
+    CACHE_DEFAULT = {
+        'BACKEND': 'repanier.cache.StatisticsCache',
+        'OPTIONS': {
+            'CACHE': CACHE_DEFAULT
+        }
+    }
+
+CACHES = {
+    'default': CACHE_DEFAULT
 }
 
 ##################### DJANGOCMS-CASCADE
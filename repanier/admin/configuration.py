@@ -1,10 +1,13 @@
 # -*- coding: utf-8
 from django import forms
 from django.conf import settings
+from django.utils.formats import number_format
+from django.utils.safestring import mark_safe
 from django.utils.translation import ugettext_lazy as _
 from parler.admin import TranslatableAdmin
 from parler.forms import TranslatableModelForm
 
+from repanier.cache import get_cache_statistics
 from repanier.const import EMPTY_STRING
 from repanier.models.configuration import Configuration
 from repanier.models.producer import Producer
@@ -74,6 +77,9 @@ class ConfigurationDataForm(TranslatableModelForm):
 
 class ConfigurationAdmin(TranslatableAdmin):
     form = ConfigurationDataForm
+    readonly_fields = [
+        'get_html_cache_statistics'
+    ]
 
     def has_delete_permission(self, request, obj=None):
         # nobody even a superadmin
@@ -185,6 +191,10 @@ class ConfigurationAdmin(TranslatableAdmin):
             ('email_host', 'email_port', 'email_use_tls'),
             ('email_host_user', 'email_host_password')
         ]
+        if get_cache_statistics() is not None:
+            fields += [
+                'get_html_cache_statistics',
+            ]
         fieldsets += [
             (_('Advanced options'), {
                 'classes': ('collapse',),
@@ -192,3 +202,23 @@ class ConfigurationAdmin(TranslatableAdmin):
             }),
         ]
         return fieldsets
+
+    def get_html_cache_statistics(self, obj=None):
+        statistics = get_cache_statistics()
+        if statistics is None:
+            return EMPTY_STRING
+        if statistics["operation"] > 0:
+            hit_ratio = statistics["hit"] * 100 / max(statistics["hit"] + statistics["miss"], 1)
+            latency = statistics["microsecond"] / statistics["operation"]
+        else:
+            hit_ratio = latency = 0
+        return mark_safe(
+            "{} : {} - {} : {} ({} %) - {} : {} µs".format(
+                _("Hits"), statistics["hit"],
+                _("Misses"), statistics["miss"],
+                number_format(hit_ratio, 1),
+                _("Mean latency"), number_format(latency, 0)
+            )
+        )
+
+    get_html_cache_statistics.short_description = (_("Cache statistics"))
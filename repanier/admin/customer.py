@@ -23,9 +23,11 @@ from import_export.widgets import CharWidget
 
 import repanier.apps
 from repanier.const import EMPTY_STRING, DECIMAL_ONE, TWO_DECIMALS
+from repanier.ledger import refresh_customer_ledger
 from repanier.models.customer import Customer
 from repanier.models.lut import LUT_DeliveryPoint
 from repanier.xlsx.extended_formats import XLSX_OPENPYXL_1_8_6
+from repanier.xlsx.export_tools import write_workbook, export_in_context
 from repanier.xlsx.widget import IdWidget, OneToOneWidget, \
     DecimalBooleanWidget, ZeroDecimalsWidget, TwoMoneysWidget, TranslatedForeignKeyWidget, DateWidgetExcel
 from repanier.xlsx.xlsx_invoice import export_invoice
@@ -206,6 +208,7 @@ class CustomerResource(resources.ModelResource):
 
 
 def create__customer_action(year):
+    @export_in_context
     def action(modeladmin, request, customer_qs):
         # To the customer we speak of "invoice".
         # This is the detail of the invoice, i.e. sold products
@@ -218,7 +221,7 @@ def create__customer_action(year):
                 "{} {}".format(_('Invoice'), year),
                 repanier.apps.REPANIER_SETTINGS_GROUP_NAME
             )
-            wb.save(response)
+            write_workbook(wb, response)
             return response
         return
 
@@ -298,6 +301,8 @@ class CustomerWithUserDataAdmin(ImportExportMixin, admin.ModelAdmin):
 
     def get_list_display(self, request):
         if settings.REPANIER_SETTINGS_MANAGE_ACCOUNTING:
+            # Recalculate the outdated ledgers at once rather than row by row into get_balance
+            refresh_customer_ledger()
             return ('__str__', 'get_balance', 'may_order', 'long_basket_name', 'phone1', 'get_email',
                     'get_last_login', 'valid_email')
         else:
@@ -22,6 +22,7 @@ from repanier.models import Customer
 from repanier.models import LUT_DeliveryPoint
 from repanier.models.group import Group
 from repanier.xlsx.extended_formats import XLSX_OPENPYXL_1_8_6
+from repanier.xlsx.export_tools import write_workbook, export_in_context
 from repanier.xlsx.xlsx_invoice import export_invoice
 
 
@@ -101,6 +102,7 @@ class UserDataForm(forms.ModelForm):
 
 
 def create__group_action(year):
+    @export_in_context
     def action(modeladmin, request, group_qs):
         # To the customer we speak of "invoice".
         # This is the detail of the invoice, i.e. sold products
@@ -113,7 +115,7 @@ def create__group_action(year):
                 "{} {}".format(_('Invoice'), year),
                 repanier.apps.REPANIER_SETTINGS_GROUP_NAME
             )
-            wb.save(response)
+            write_workbook(wb, response)
             return response
         return
 
@@ -0,0 +1,9 @@
+# -*- coding: utf-8
+from django.contrib.admin.views.main import ChangeList
+
+
+class PermanenceChangeList(ChangeList):
+    # The producers, customers and board columns of a page are read with a fixed number of queries
+
+    def get_queryset(self, request):
+        return self.model.prefetch_changelist(super(PermanenceChangeList, self).get_queryset(request))
@@ -1,5 +1,4 @@
 # -*- coding: utf-8
-import threading
 
 from django import forms
 from django.conf import settings
@@ -20,17 +19,19 @@ import repanier.apps
 from repanier.admin.forms import InvoiceOrderForm, ProducerInvoicedFormSet, PermanenceInvoicedForm, ImportXlsxForm, \
     ImportInvoiceForm
 from repanier.admin.inline_foreign_key_cache_mixin import InlineForeignKeyCacheMixin
+from repanier.admin.permanence_changelist import PermanenceChangeList
 from repanier.const import *
-from repanier.email import email_invoice
 from repanier.fields.RepanierMoneyField import RepanierMoney
 from repanier.models.bankaccount import BankAccount
 from repanier.models.customer import Customer
 from repanier.models.invoice import ProducerInvoice
+from repanier.models.job import Job
 from repanier.models.lut import LUT_PermanenceRole
 from repanier.models.permanence import PermanenceDone
 from repanier.models.permanenceboard import PermanenceBoard
 from repanier.models.staff import Staff
 from repanier.tools import send_email_to_who
+from repanier.xlsx.export_tools import write_workbook, export_in_context
 from repanier.xlsx.views import import_xslx_view
 from repanier.xlsx.xlsx_invoice import export_bank, export_invoice, handle_uploaded_invoice
 from repanier.xlsx.xlsx_purchase import handle_uploaded_purchase, export_purchase
@@ -177,7 +178,7 @@ class PermanenceDoneAdmin(TranslatableAdmin):
                 _("Invoices"),
                 permanence
             )
-            wb.save(response)
+            write_workbook(wb, response)
             return response
         else:
             return
@@ -199,6 +200,7 @@ class PermanenceDoneAdmin(TranslatableAdmin):
 
     import_xlsx.short_description = _("2 --- Import, update billing preparation list")
 
+    @export_in_context
     def preview_invoices(self, request, permanence_qs):
         valid_permanence_qs = permanence_qs.filter(
             status__in=[PERMANENCE_INVOICED, PERMANENCE_ARCHIVED]
@@ -219,7 +221,7 @@ class PermanenceDoneAdmin(TranslatableAdmin):
                 _("Accounting report"),
                 repanier.apps.REPANIER_SETTINGS_GROUP_NAME
             )
-            wb.save(response)
+            write_workbook(wb, response)
             return response
         user_message = _("No invoice available for %(permanence)s.") % {
             'permanence': ', '.join("{}".format(p) for p in permanence_qs.all())}
@@ -563,8 +565,9 @@ class PermanenceDoneAdmin(TranslatableAdmin):
         if 'apply' in request.POST:
             form = InvoiceOrderForm(request.POST)
             if form.is_valid():
-                t = threading.Thread(target=email_invoice.send_invoice, args=(permanence.id,))
-                t.start()
+                # Run by the "run_jobs" command
+                Job.enqueue("repanier.email.email_invoice.send_invoice", permanence.id,
+                            permanence_id=permanence.id)
                 user_message = _("Emails containing the invoices will be send to the customers and the producers.")
                 user_message_level = messages.INFO
                 self.message_user(request, user_message, user_message_level)
@@ -624,6 +627,9 @@ class PermanenceDoneAdmin(TranslatableAdmin):
         extra_context['module_name'] = EMPTY_STRING
         return super(PermanenceDoneAdmin, self).changelist_view(request, extra_context=extra_context)
 
+    def get_changelist(self, request, **kwargs):
+        return PermanenceChangeList
+
     def get_queryset(self, request):
         qs = super(PermanenceDoneAdmin, self).get_queryset(request)
         if settings.REPANIER_SETTINGS_MANAGE_ACCOUNTING:
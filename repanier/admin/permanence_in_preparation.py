@@ -1,5 +1,4 @@
 # -*- coding: utf-8
-import threading
 
 from django import forms
 from django.conf import settings
@@ -22,12 +21,14 @@ from parler.utils.context import switch_language
 import repanier.apps
 from repanier.admin.forms import OpenAndSendOfferForm, CloseAndSendOrderForm, GeneratePermanenceForm
 from repanier.admin.inline_foreign_key_cache_mixin import InlineForeignKeyCacheMixin
+from repanier.admin.permanence_changelist import PermanenceChangeList
 from repanier.const import *
 from repanier.fields.RepanierMoneyField import RepanierMoney
 from repanier.models import Contract
 from repanier.models.box import Box
 from repanier.models.customer import Customer
 from repanier.models.deliveryboard import DeliveryBoard
+from repanier.models.job import Job
 from repanier.models.lut import LUT_PermanenceRole, LUT_DeliveryPoint
 from repanier.models.permanence import PermanenceInPreparation, Permanence
 from repanier.models.permanenceboard import PermanenceBoard
@@ -35,10 +36,10 @@ from repanier.models.producer import Producer
 from repanier.models.product import Product
 from repanier.models.staff import Staff
 from repanier.task import task_order
-from repanier.task.task_order import pre_open_order, open_order, close_and_send_order
 from repanier.tools import send_email_to_who, get_board_composition, get_recurrence_dates
+from repanier.xlsx.export_tools import write_workbook, export_in_context
 from repanier.xlsx.xlsx_offer import export_offer
-from repanier.xlsx.xlsx_order import generate_producer_xlsx, generate_customer_xlsx
+from repanier.xlsx.xlsx_order import generate_producer_xlsx, generate_customer_xlsx, get_purchase_stream
 
 
 class PermanenceBoardInline(InlineForeignKeyCacheMixin, admin.TabularInline):
@@ -277,13 +278,14 @@ class PermanenceInPreparationAdmin(TranslatableAdmin):
                 _("Preview report"),
                 permanence
             )
-            wb.save(response)
+            write_workbook(wb, response)
             return response
         else:
             return
 
     export_xlsx_offer.short_description = _("1 --- Check offer before opening")
 
+    @export_in_context
     def export_xlsx_customer_order(self, request, queryset):
         if 'cancel' in request.POST:
             user_message = _("Action canceled by the user.")
@@ -308,7 +310,7 @@ class PermanenceInPreparationAdmin(TranslatableAdmin):
                     _("Customers"),
                     permanence
                 )
-                wb.save(response)
+                write_workbook(wb, response)
             return response
         if 'apply' in request.POST:
             if admin.ACTION_CHECKBOX_NAME in request.POST:
@@ -331,7 +333,7 @@ class PermanenceInPreparationAdmin(TranslatableAdmin):
                     _("Customers"),
                     permanence
                 )
-                wb.save(response)
+                write_workbook(wb, response)
             return response
         return render(
             request,
@@ -347,6 +349,7 @@ class PermanenceInPreparationAdmin(TranslatableAdmin):
 
     export_xlsx_customer_order.short_description = _("Export customer orders")
 
+    @export_in_context
     def export_xlsx_producer_order(self, request, queryset):
         if 'cancel' in request.POST:
             user_message = _("Action canceled by the user.")
@@ -365,15 +368,16 @@ class PermanenceInPreparationAdmin(TranslatableAdmin):
         # Perform the action directly. Do not ask to select any delivery point.
         wb = None
         producer_set = Producer.objects.filter(permanence=permanence).order_by("short_profile_name")
+        purchases = get_purchase_stream(permanence)
         for producer in producer_set:
-            wb = generate_producer_xlsx(permanence, producer=producer, wb=wb)
+            wb = generate_producer_xlsx(permanence, producer=producer, wb=wb, purchases=purchases)
         if wb is not None:
             response = HttpResponse(content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
             response['Content-Disposition'] = "attachment; filename={0}-{1}.xlsx".format(
                 _("Producers"),
                 permanence
             )
-            wb.save(response)
+            write_workbook(wb, response)
             return response
         else:
             return
@@ -491,15 +495,15 @@ class PermanenceInPreparationAdmin(TranslatableAdmin):
                         user_message = _("A maximum of one permanence may be pre opened.")
                         user_message_level = messages.ERROR
                     else:
-                        # pre_open_order(permanence.id)
-                        t = threading.Thread(target=pre_open_order, args=(permanence.id,))
-                        t.start()
+                        # pre_open_order(permanence.id), run by the "run_jobs" command
+                        Job.enqueue("repanier.task.task_order.pre_open_order", permanence.id,
+                                    permanence_id=permanence.id)
                         user_message = _("The offers are being generated.")
                         user_message_level = messages.INFO
                 else:
-                    # open_order(permanence.id, do_not_send_any_mail)
-                    t = threading.Thread(target=open_order, args=(permanence.id, do_not_send_any_mail))
-                    t.start()
+                    # open_order(permanence.id, do_not_send_any_mail), run by the "run_jobs" command
+                    Job.enqueue("repanier.task.task_order.open_order", permanence.id, do_not_send_any_mail,
+                                permanence_id=permanence.id)
                     user_message = _("The offers are being generated.")
                     user_message_level = messages.INFO
                 self.message_user(request, user_message, user_message_level)
@@ -566,9 +570,10 @@ class PermanenceInPreparationAdmin(TranslatableAdmin):
                     return
             everything = all_producers or all_deliveries
             # close_and_send_order(permanence.id, everything, producers_to_be_send, deliveries_to_be_send)
-            t = threading.Thread(target=close_and_send_order,
-                                 args=(permanence.id, everything, producers_to_be_send, deliveries_to_be_send))
-            t.start()
+            # Run by the "run_jobs" command
+            Job.enqueue("repanier.task.task_order.close_and_send_order",
+                        permanence.id, everything, producers_to_be_send, deliveries_to_be_send,
+                        permanence_id=permanence.id)
             user_message = _("The orders are being send.")
             user_message_level = messages.INFO
             self.message_user(request, user_message, user_message_level)
@@ -794,6 +799,9 @@ class PermanenceInPreparationAdmin(TranslatableAdmin):
         return super(PermanenceInPreparationAdmin, self).formfield_for_manytomany(
             db_field, request, **kwargs)
 
+    def get_changelist(self, request, **kwargs):
+        return PermanenceChangeList
+
     def get_queryset(self, request):
         qs = super(PermanenceInPreparationAdmin, self).get_queryset(request)
         return qs.filter(
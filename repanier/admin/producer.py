@@ -19,11 +19,13 @@ from import_export.widgets import CharWidget
 import repanier.apps
 from repanier.admin.forms import ImportXlsxForm
 from repanier.const import *
+from repanier.ledger import refresh_producer_ledger
 from repanier.models.box import BoxContent
 from repanier.models.permanence import Permanence
 from repanier.models.producer import Producer
 from repanier.tools import producer_web_services_activated
 from repanier.xlsx.extended_formats import XLSX_OPENPYXL_1_8_6
+from repanier.xlsx.export_tools import write_workbook, export_in_context
 from repanier.xlsx.views import import_xslx_view
 from repanier.xlsx.widget import IdWidget, TwoDecimalsWidget, \
     DecimalBooleanWidget, TwoMoneysWidget, DateWidgetExcel
@@ -101,6 +103,7 @@ class ProducerResource(resources.ModelResource):
 
 
 def create__producer_action(year):
+    @export_in_context
     def action(modeladmin, request, producer_qs):
         # To the producer we speak of "payment".
         # This is the detail of the payment to the producer, i.e. received products
@@ -113,7 +116,7 @@ def create__producer_action(year):
                 "{} {}".format(_('Payment'), year),
                 repanier.apps.REPANIER_SETTINGS_GROUP_NAME
             )
-            wb.save(response)
+            write_workbook(wb, response)
             return response
         return
 
@@ -274,7 +277,7 @@ class ProducerAdmin(ImportExportMixin, admin.ModelAdmin):
             response['Content-Disposition'] = "attachment; filename={0}.xlsx".format(
                 _("Products")
             )
-            wb.save(response)
+            write_workbook(wb, response)
             return response
         else:
             return
@@ -291,7 +294,7 @@ class ProducerAdmin(ImportExportMixin, admin.ModelAdmin):
             response['Content-Disposition'] = "attachment; filename={0}.xlsx".format(
                 _("Inventory")
             )
-            wb.save(response)
+            write_workbook(wb, response)
             return response
         else:
             return
@@ -316,6 +319,8 @@ class ProducerAdmin(ImportExportMixin, admin.ModelAdmin):
             '__str__', 'get_products'
         ]
         if settings.REPANIER_SETTINGS_MANAGE_ACCOUNTING:
+            # Recalculate the outdated ledgers at once rather than row by row into get_balance
+            refresh_producer_ledger()
             list_display += [
                 'get_balance',
             ]
@@ -0,0 +1,193 @@
+# -*- coding: utf-8
+import threading
+import time
+
+from django.core.cache import caches, DEFAULT_CACHE_ALIAS
+from django.core.cache.backends.base import BaseCache, DEFAULT_TIMEOUT
+from django.utils.module_loading import import_string
+
+# Version stamped cache invalidation.
+# Each namespace (a permanence, a user, the pages, ...) has a version stored into the cache.
+# The cache keys of a namespace contain its version : invalidating the namespace only bumps
+# its version, the stale entries are never read again and are removed by the cache expiration.
+
+CACHE_VERSION_KEY = "repanier_cache_version_{}"
+CACHE_VERSION_PAGE = "page"
+# Keys of the pages cached by django.middleware.cache
+CACHE_PAGE_KEY_PREFIXES = ("views.decorators.cache.cache_header.", "views.decorators.cache.cache_page.")
+
+
+def get_cache_version(namespace):
+    cache = caches[DEFAULT_CACHE_ALIAS]
+    version_key = CACHE_VERSION_KEY.format(namespace)
+    version = cache.get(version_key)
+    if version is None:
+        # Start from the time and not from 1 so that a culled version never reuses a previous one
+        version = int(time.time())
+        if not cache.add(version_key, version, None):
+            version = cache.get(version_key, version)
+    return version
+
+
+def invalidate_cache(*namespaces):
+    cache = caches[DEFAULT_CACHE_ALIAS]
+    for namespace in namespaces:
+        version_key = CACHE_VERSION_KEY.format(namespace)
+        try:
+            cache.incr(version_key)
+        except ValueError:
+            # Not yet versioned
+            cache.set(version_key, int(time.time()), None)
+
+
+def get_versioned_cache_key(key, *namespaces):
+    return "{}.{}".format(
+        key,
+        ".".join("{}{}".format(namespace, get_cache_version(namespace)) for namespace in namespaces)
+    )
+
+
+def permanence_namespace(permanence_id):
+    return "permanence{}".format(permanence_id)
+
+
+def user_namespace(user_id):
+    return "user{}".format(user_id)
+
+
+def make_key(key, key_prefix, version):
+    # settings.CACHES KEY_FUNCTION : the pages are stamped with the version of the "page" namespace
+    if key.startswith(CACHE_PAGE_KEY_PREFIXES):
+        key = get_versioned_cache_key(key, CACHE_VERSION_PAGE)
+    return "{}:{}:{}".format(key_prefix, version, key)
+
+
+# Statistics of the cache usage.
+# The counters are kept into each process and added to the shared counters, stored into the cache,
+# every CACHE_STATISTICS_FLUSH operations.
+
+CACHE_STATISTICS_KEY = "repanier_cache_statistics_{}"
+CACHE_STATISTICS = ("hit", "miss", "operation", "microsecond")
+CACHE_STATISTICS_FLUSH = 100
+_MISSING = object()
+
+
+class StatisticsCache(BaseCache):
+    # Delegate to the cache described into OPTIONS["CACHE"] and count the hits, the misses
+    # and the time spent.
+
+    def __init__(self, location, params):
+        super(StatisticsCache, self).__init__({})
+        cache_params = params["OPTIONS"]["CACHE"].copy()
+        backend = cache_params.pop("BACKEND")
+        cache_location = cache_params.pop("LOCATION", "")
+        self._cache = import_string(backend)(cache_location, cache_params)
+        self._lock = threading.Lock()
+        self._statistics = dict.fromkeys(CACHE_STATISTICS, 0)
+
+    def _count(self, start, hit=0, miss=0):
+        with self._lock:
+            self._statistics["hit"] += hit
+            self._statistics["miss"] += miss
+            self._statistics["operation"] += 1
+            self._statistics["microsecond"] += int((time.time() - start) * 1000000)
+            if self._statistics["operation"] < CACHE_STATISTICS_FLUSH:
+                return
+            statistics = self._statistics
+            self._statistics = dict.fromkeys(CACHE_STATISTICS, 0)
+        for name, value in statistics.items():
+            if value:
+                key = CACHE_STATISTICS_KEY.format(name)
+                self._cache.add(key, 0, None)
+                try:
+                    self._cache.incr(key, value)
+                except ValueError:
+                    # Culled in the meantime
+                    self._cache.set(key, value, None)
+
+    def get_statistics(self):
+        statistics = self._cache.get_many([CACHE_STATISTICS_KEY.format(name) for name in CACHE_STATISTICS])
+        with self._lock:
+            return {
+                name: statistics.get(CACHE_STATISTICS_KEY.format(name), 0) + self._statistics[name]
+                for name in CACHE_STATISTICS
+            }
+
+    def reset_statistics(self):
+        self._cache.delete_many([CACHE_STATISTICS_KEY.format(name) for name in CACHE_STATISTICS])
+        with self._lock:
+            self._statistics = dict.fromkeys(CACHE_STATISTICS, 0)
+
+    def get(self, key, default=None, version=None):
+        start = time.time()
+        value = self._cache.get(key, _MISSING, version=version)
+        if value is _MISSING:
+            self._count(start, miss=1)
+            return default
+        self._count(start, hit=1)
+        return value
+
+    def get_many(self, keys, version=None):
+        start = time.time()
+        result = self._cache.get_many(keys, version=version)
+        self._count(start, hit=len(result), miss=len(keys) - len(result))
+        return result
+
+    def has_key(self, key, version=None):
+        start = time.time()
+        result = self._cache.has_key(key, version=version)
+        self._count(start)
+        return result
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        start = time.time()
+        result = self._cache.add(key, value, timeout=timeout, version=version)
+        self._count(start)
+        return result
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        start = time.time()
+        self._cache.set(key, value, timeout=timeout, version=version)
+        self._count(start)
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        start = time.time()
+        result = self._cache.set_many(data, timeout=timeout, version=version)
+        self._count(start)
+        return result
+
+    def delete(self, key, version=None):
+        start = time.time()
+        self._cache.delete(key, version=version)
+        self._count(start)
+
+    def delete_many(self, keys, version=None):
+        start = time.time()
+        self._cache.delete_many(keys, version=version)
+        self._count(start)
+
+    def incr(self, key, delta=1, version=None):
+        start = time.time()
+        result = self._cache.incr(key, delta=delta, version=version)
+        self._count(start)
+        return result
+
+    def decr(self, key, delta=1, version=None):
+        start = time.time()
+        result = self._cache.decr(key, delta=delta, version=version)
+        self._count(start)
+        return result
+
+    def clear(self):
+        self._cache.clear()
+
+    def close(self, **kwargs):
+        self._cache.close(**kwargs)
+
+
+def get_cache_statistics():
+    # None if the statistics are not activated (DJANGO_SETTINGS_CACHE_STATISTICS)
+    cache = caches[DEFAULT_CACHE_ALIAS]
+    if isinstance(cache, StatisticsCache):
+        return cache.get_statistics()
+    return None
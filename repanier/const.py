@@ -76,6 +76,9 @@ LUT_PERMANENCE_STATUS = (
     (PERMANENCE_CANCELLED, _('Cancelled'))
 )
 
+# Status of the permanences displayed into the permanence menu
+PERMANENCE_STATUS_IN_MENU = (PERMANENCE_OPENED, PERMANENCE_CLOSED, PERMANENCE_SEND)
+
 PRODUCT_PLACEMENT_FREEZER = '100'
 PRODUCT_PLACEMENT_FRIDGE = '200'
 PRODUCT_PLACEMENT_OUT_OF_BASKET = '300'
@@ -276,6 +279,7 @@ LUT_PERMANENCE_NAME = (
 
 LIMIT_ORDER_QTY_ITEM = 25
 LIMIT_DISPLAYED_PERMANENCE = 25
+BULK_UPDATE_BATCH_SIZE = 500
 BOX_VALUE_STR = "-1"
 BOX_VALUE_INT = -1
 BOX_UNICODE = "📦"  # http://unicode-table.com/fr/1F6CD/
@@ -308,3 +312,25 @@ LUT_CURRENCY = (
     (CURRENCY_CHF, _('Franc')),
     (CURRENCY_LOC, _('Local')),
 )
+
+JOB_QUEUED = '100'
+JOB_RUNNING = '200'
+JOB_DONE = '300'
+JOB_FAILED = '400'
+
+LUT_JOB_STATUS = (
+    (JOB_QUEUED, _('Queued')),
+    (JOB_RUNNING, _('Running')),
+    (JOB_DONE, _('Done')),
+    (JOB_FAILED, _('Failed')),
+)
+
+STOCK_MOVEMENT_INVENTORY = '100'
+STOCK_MOVEMENT_TAKEN = '200'
+STOCK_MOVEMENT_ADDED = '300'
+
+LUT_STOCK_MOVEMENT = (
+    (STOCK_MOVEMENT_INVENTORY, _('Inventory')),
+    (STOCK_MOVEMENT_TAKEN, _('Stock used')),
+    (STOCK_MOVEMENT_ADDED, _('Additional')),
+)
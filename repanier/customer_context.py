@@ -0,0 +1,119 @@
+# -*- coding: utf-8
+from django.core.cache import cache
+
+from repanier.cache import get_versioned_cache_key, user_namespace
+from repanier.const import *
+
+# Customer of the current request, shared by the views, the ajax views and the template tags.
+# get_customer_context(request) reads the customer once and keeps it on the request.
+# The liked products and the state of a permanence are read on first use, with one query each.
+
+REQUEST_CUSTOMER_CONTEXT = "_repanier_customer_context"
+
+
+def get_liked_product_ids(user_id):
+    # The products liked by the user, cached into the namespace of the user.
+    # The namespace is invalidated when the likes change (see product_likes_changed).
+    from repanier.models.product import Product
+
+    cache_key = get_versioned_cache_key("liked_product_ids", user_namespace(user_id))
+    liked_product_ids = cache.get(cache_key)
+    if liked_product_ids is None:
+        liked_product_ids = set(Product.likes.through.objects.filter(
+            user_id=user_id
+        ).order_by('?').values_list("product_id", flat=True))
+        cache.set(cache_key, liked_product_ids)
+    return liked_product_ids
+
+
+def toggle_like(user, product):
+    # Return True if the user likes the product now
+    is_liked = product.id not in get_liked_product_ids(user.id)
+    if is_liked:
+        product.likes.add(user)
+    else:
+        product.likes.remove(user)
+    return is_liked
+
+
+class CustomerContext(object):
+    def __init__(self, user):
+        from repanier.models.customer import Customer
+
+        self.user = user
+        if user.is_authenticated:
+            self.customer = Customer.objects.filter(user_id=user.id).order_by('?').first()
+        else:
+            self.customer = None
+        self._liked_product_ids = None
+        self._permanence_states = {}
+
+    @property
+    def is_active(self):
+        return self.customer is not None and self.customer.is_active
+
+    @property
+    def may_order(self):
+        return self.is_active and self.customer.may_order
+
+    @property
+    def liked_product_ids(self):
+        if self._liked_product_ids is None:
+            if self.user.is_authenticated:
+                self._liked_product_ids = set(get_liked_product_ids(self.user.id))
+            else:
+                self._liked_product_ids = set()
+        return self._liked_product_ids
+
+    def toggle_like(self, product):
+        is_liked = toggle_like(self.user, product)
+        if is_liked:
+            self.liked_product_ids.add(product.id)
+        else:
+            self.liked_product_ids.discard(product.id)
+        return is_liked
+
+    def get_permanence_state(self, permanence_id):
+        # - "invoice_status" : status of the invoice of the customer, None if the customer has not yet ordered
+        # - "purchases" : {(offer_item_id, is_box_content): (quantity_ordered, status)} of the customer
+        # - "open_producer_ids" : the producers whose invoice is still open
+        state = self._permanence_states.get(permanence_id)
+        if state is None:
+            from repanier.models.invoice import CustomerInvoice, ProducerInvoice
+            from repanier.models.purchase import PurchaseWoReceiver
+
+            invoice_status = None
+            purchases = {}
+            if self.customer is not None:
+                invoice_status = CustomerInvoice.objects.filter(
+                    permanence_id=permanence_id,
+                    customer_id=self.customer.id
+                ).order_by('?').values_list("status", flat=True).first()
+                if invoice_status is not None:
+                    for offer_item_id, is_box_content, quantity_ordered, status in PurchaseWoReceiver.objects.filter(
+                            permanence_id=permanence_id,
+                            customer_id=self.customer.id
+                    ).order_by('?').values_list(
+                        "offer_item_id", "is_box_content", "quantity_ordered", "status"
+                    ):
+                        purchases[(offer_item_id, is_box_content)] = (quantity_ordered, status)
+            state = {
+                "invoice_status": invoice_status,
+                "purchases": purchases,
+                "open_producer_ids": set(ProducerInvoice.objects.filter(
+                    permanence_id=permanence_id,
+                    status=PERMANENCE_OPENED
+                ).order_by('?').values_list(
+                    "producer_id", flat=True
+                ))
+            }
+            self._permanence_states[permanence_id] = state
+        return state
+
+
+def get_customer_context(request):
+    customer_context = getattr(request, REQUEST_CUSTOMER_CONTEXT, None)
+    if customer_context is None or customer_context.user is not request.user:
+        customer_context = CustomerContext(request.user)
+        setattr(request, REQUEST_CUSTOMER_CONTEXT, customer_context)
+    return customer_context
@@ -1,8 +1,11 @@
 # -*- coding: utf-8
 
+import copy
 import datetime
 import logging
+import threading
 import time
+from functools import wraps
 from smtplib import SMTPRecipientsRefused, SMTPAuthenticationError
 
 from django.conf import settings
@@ -15,6 +18,189 @@ from django.utils.html import strip_tags
 logger = logging.getLogger(__name__)
 from repanier.const import DEMO_EMAIL, EMPTY_STRING
 
+_local = threading.local()
+
+
+class RepanierEmailBatch(object):
+    # Send the mails through one SMTP connection, kept open until the end of the batch.
+    #
+    #   with RepanierEmailBatch():
+    #       email.send_email()
+    #       ...
+    #
+    # The customers of the recipients are read with one query per mail. A mail which fails is
+    # retried later, after a growing delay, while the next mails are sent. Only the outermost
+    # batch is active : a nested batch joins it.
+
+    def __init__(self, max_attempt=3, backoff=5):
+        self.max_attempt = max_attempt
+        self.backoff = backoff
+        self.connection = None
+        self.connection_param = None
+        self.authentication_error = None
+        # email address -> customer or None
+        self.customers = {}
+        self.valid_customer_ids = set()
+        # [(retry_at, attempt, email, customer), ...]
+        self.deferred = []
+        self.errors = []
+        self.is_outermost = False
+
+    @classmethod
+    def get_current(cls):
+        return getattr(_local, "batch", None)
+
+    def __enter__(self):
+        current = RepanierEmailBatch.get_current()
+        if current is not None:
+            return current
+        self.is_outermost = True
+        _local.batch = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self.is_outermost:
+            return
+        try:
+            self.flush()
+        finally:
+            _local.batch = None
+            self.is_outermost = False
+
+    def prefetch_customers(self, email_addresses):
+        from repanier.models.customer import Customer
+
+        missing = set(email_addresses) - set(self.customers)
+        if not missing:
+            return
+        # try to find a customer based on user__email or customer__email2
+        for customer in Customer.objects.filter(
+            Q(
+                user__email__in=missing
+            ) | Q(
+                email2__in=missing
+            )
+        ).exclude(
+            valid_email=False,
+        ).select_related("user").order_by('?'):
+            for email_address in (customer.user.email, customer.email2):
+                if email_address in missing and self.customers.get(email_address) is None:
+                    self.customers[email_address] = customer
+        for email_address in missing:
+            self.customers.setdefault(email_address, None)
+
+    def get_customer(self, email_address):
+        self.prefetch_customers([email_address])
+        return self.customers[email_address]
+
+    def send(self, email, customer=None, defer=True):
+        # Return True if the mail has been sent now.
+        # If not and "defer", the mail is retried later.
+        self._send_deferred(wait=False)
+        return self._send(email, customer, 1, defer)
+
+    def flush(self):
+        self._send_deferred(wait=True)
+        if self.valid_customer_ids:
+            from repanier.models.customer import Customer
+
+            # use update() because save() will call "pre_save" function which reset valid_email to None
+            Customer.objects.filter(id__in=self.valid_customer_ids).order_by('?').update(valid_email=True)
+            self.valid_customer_ids = set()
+        self._close_connection()
+        if self.errors:
+            mail_admins("ERROR", "\n\n".join(self.errors))
+            self.errors = []
+
+    def _get_connection(self, email):
+        connection_param = (email.host, email.port, email.host_user, email.host_password, email.use_tls)
+        if self.connection is not None and self.connection_param != connection_param:
+            self._close_connection()
+        if self.connection is None:
+            self.connection = mail.get_connection(
+                host=email.host,
+                port=email.port,
+                username=email.host_user,
+                password=email.host_password,
+                use_tls=email.use_tls,
+                use_ssl=not email.use_tls)
+            self.connection_param = connection_param
+            self.connection.open()
+        return self.connection
+
+    def _close_connection(self):
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except Exception:
+                pass
+            self.connection = None
+
+    def _send(self, email, customer, attempt, defer):
+        message = email.get_log_message()
+        if self.authentication_error is not None:
+            self.errors.append("{}\n{}".format(message, self.authentication_error))
+            return False
+        try:
+            email.connection = self._get_connection(email)
+            email.send()
+        except SMTPAuthenticationError as error_str:
+            logger.fatal("################################## send_email SMTPAuthenticationError")
+            # https://support.google.com/accounts/answer/185833
+            # https://support.google.com/accounts/answer/6010255
+            # https://security.google.com/settings/security/apppasswords
+            logger.fatal(error_str)
+            self._close_connection()
+            # Do not retry with wrong credentials
+            self.authentication_error = error_str
+            self.errors.append("{}\n{}".format(message, error_str))
+            return False
+        except SMTPRecipientsRefused as error_str:
+            logger.error("################################## send_email SMTPRecipientsRefused")
+            logger.error(error_str)
+            # Retrying a refused recipient is useless
+            self.errors.append("{}\n{}".format(message, error_str))
+            return False
+        except Exception as error_str:
+            logger.error("################################## send_email error")
+            logger.error(error_str)
+            # The connection may be broken, open a new one for the next mail
+            self._close_connection()
+            if defer and attempt < self.max_attempt:
+                retry_at = time.time() + self.backoff * 2 ** (attempt - 1)
+                self.deferred.append((retry_at, attempt + 1, email, customer))
+            else:
+                self.errors.append("{}\n{}".format(message, error_str))
+            return False
+        logger.info("##################################")
+        if customer is not None:
+            self.valid_customer_ids.add(customer.id)
+        return True
+
+    def _send_deferred(self, wait):
+        # Send the deferred mails whose delay is over. If "wait", wait until all are sent or abandoned.
+        while self.deferred:
+            now = time.time()
+            ready = [deferred for deferred in self.deferred if deferred[0] <= now]
+            if not ready:
+                if not wait:
+                    return
+                time.sleep(min(deferred[0] for deferred in self.deferred) - now)
+                continue
+            self.deferred = [deferred for deferred in self.deferred if deferred[0] > now]
+            for _, attempt, email, customer in ready:
+                self._send(email, customer, attempt, True)
+
+
+def send_email_in_batch(function):
+    # Decorator : the mails sent by the function share one batch
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        with RepanierEmailBatch():
+            return function(*args, **kwargs)
+
+    return wrapper
+
 
 class RepanierEmail(EmailMultiAlternatives):
     def __init__(self, *args, **kwargs):
@@ -43,7 +229,21 @@ class RepanierEmail(EmailMultiAlternatives):
             self.host_password = settings.EMAIL_HOST_PASSWORD
             self.use_tls = settings.EMAIL_USE_TLS
 
+    def _create_mime_attachment(self, content, mimetype):
+        # The content of an attachment may be a file object, e.g. the spooled file of write_workbook.
+        # It is read only while the message of one recipient is built, and not kept in memory
+        # while the mail waits into its batch.
+        if hasattr(content, "read"):
+            content.seek(0)
+            content = content.read()
+        return super(RepanierEmail, self)._create_mime_attachment(content, mimetype)
+
     def send_email(self, from_name=EMPTY_STRING):
+        # Outside of a batch, the recipients of this mail form the batch
+        with RepanierEmailBatch():
+            return self._send_email(from_name)
+
+    def _send_email(self, from_name):
         from repanier.apps import REPANIER_SETTINGS_GROUP_NAME
 
         email_send = False
@@ -94,16 +294,18 @@ class RepanierEmail(EmailMultiAlternatives):
                     self.bcc = []
                     email_send = True
                     if len(send_email_to) >= 1:
+                        if not self.test_connection:
+                            RepanierEmailBatch.get_current().prefetch_customers(send_email_to)
                         for email_to in send_email_to:
                             self.to = [email_to]
                             email_send &= self._send_email_with_error_log()
-                            time.sleep(1)
         return email_send
 
     def _send_email_with_error_log(self):
+        batch = RepanierEmailBatch.get_current()
         email_to = self.to[0]
         if not self.test_connection:
-            customer = self._get_customer(email_to)
+            customer = batch.get_customer(email_to)
             if customer is not None:
                 if not self.send_even_if_unsubscribed and not customer.subscribe_to_email:
                     return False
@@ -126,88 +328,17 @@ class RepanierEmail(EmailMultiAlternatives):
                 self.html_body,
                 "text/html"
             )
-        email_send = False
         # Email subject *must not* contain newlines
         self.subject = ''.join(self.subject.splitlines())
 
         logger.info("################################## send_email")
-        # from_email : GasAth Ptidej <GasAth Ptidej <ptidej-cde@repanier.be>>
-        from_email = "from_email : {}".format(self.from_email)
-        logger.info(from_email)
-        reply_to = "reply_to : {}".format(self.reply_to)
-        logger.info(reply_to)
-        to_email = "to : {}".format(self.to)
-        logger.info(to_email)
-        cc_email = "cc : {}".format(self.cc)
-        logger.info(cc_email)
-        bcc_email = "bcc : {}".format(self.bcc)
-        logger.info(bcc_email)
-        subject = "subject : {}".format(self.subject)
-        logger.info(subject)
-        message = "{}\n{}\n{}\n{}\n{}\n{}".format(from_email, reply_to, to_email, cc_email, bcc_email,
-                                                  subject)
-        try:
-            with mail.get_connection(
-                    host=self.host,
-                    port=self.port,
-                    username=self.host_user,
-                    password=self.host_password,
-                    use_tls=self.use_tls,
-                    use_ssl=not self.use_tls) as connection:
-                self.connection = connection
-                try:
-                    self.send()
-                    email_send = True
-                except SMTPRecipientsRefused as error_str:
-                    logger.error("################################## send_email SMTPRecipientsRefused")
-                    logger.error(error_str)
-                    time.sleep(1)
-                    connection = mail.get_connection()
-                    connection.open()
-                    mail_admins("ERROR", "{}\n{}".format(message, error_str), connection=connection)
-                    connection.close()
-                except Exception as error_str:
-                    logger.error("################################## send_email error")
-                    logger.error(error_str)
-                    time.sleep(1)
-                    connection = mail.get_connection()
-                    connection.open()
-                    mail_admins("ERROR", "{}\n{}".format(message, error_str), connection=connection)
-                    connection.close()
-                logger.info("##################################")
-                if email_send and customer is not None:
-                    from repanier.models.customer import Customer
-
-                    # customer.valid_email = valid_email
-                    # customer.save(update_fields=['valid_email'])
-                    # use vvvv because ^^^^^ will call "pre_save" function which reset valid_email to None
-                    Customer.objects.filter(id=customer.id).order_by('?').update(valid_email=email_send)
-        except SMTPAuthenticationError as error_str:
-            logger.fatal("################################## send_email SMTPAuthenticationError")
-            # https://support.google.com/accounts/answer/185833
-            # https://support.google.com/accounts/answer/6010255
-            # https://security.google.com/settings/security/apppasswords
-            logger.fatal(error_str)
-            time.sleep(5)
-            mail_admins("FATAL", "{}\n{}".format(message, error_str))
-        except Exception as error_str:
-            logger.fatal("################################## send_email error")
-            logger.fatal(error_str)
-            time.sleep(5)
-            mail_admins("FATAL", "{}\n{}".format(message, error_str))
-        return email_send
-
-    def _get_customer(self, email_address):
-        from repanier.models.customer import Customer
+        logger.info(self.get_log_message())
+        # Send a copy : "self.to" changes with the next recipient while a failed mail waits for its retry.
+        # The result of a connection test must be known now.
+        return batch.send(copy.copy(self), customer, defer=not self.test_connection)
 
-        # try to find a customer based on user__email or customer__email2
-        customer = Customer.objects.filter(
-            Q(
-                user__email=email_address
-            ) | Q(
-                email2=email_address
-            )
-        ).exclude(
-            valid_email=False,
-        ).order_by('?').first()
-        return customer
+    def get_log_message(self):
+        # from_email : GasAth Ptidej <GasAth Ptidej <ptidej-cde@repanier.be>>
+        return "from_email : {}\nreply_to : {}\nto : {}\ncc : {}\nbcc : {}\nsubject : {}".format(
+            self.from_email, self.reply_to, self.to, self.cc, self.bcc, self.subject
+        )
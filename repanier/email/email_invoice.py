@@ -3,6 +3,7 @@
 from django.core.urlresolvers import reverse
 from django.template import Template, Context as TemplateContext
 
+from repanier.email.email import send_email_in_batch
 from repanier.models.customer import Customer
 from repanier.models.permanence import Permanence
 from repanier.models.producer import Producer
@@ -11,7 +12,9 @@ from repanier.models.staff import Staff
 from repanier.tools import *
 
 
-def send_invoice(permanence_id):
+@send_email_in_batch
+def send_invoice(permanence_id, job=None):
+    # job : when run by a job, the invoices are sent in one step
     from repanier.apps import REPANIER_SETTINGS_SEND_INVOICE_MAIL_TO_PRODUCER, \
         REPANIER_SETTINGS_GROUP_NAME, REPANIER_SETTINGS_SEND_INVOICE_MAIL_TO_CUSTOMER, \
         REPANIER_SETTINGS_CONFIG
@@ -8,6 +8,7 @@ from django.template import Template, Context as TemplateContext
 # is the "bad One" this lib has a Context object too. Thanks for anyone reading!
 from django.utils.translation import ugettext_lazy as _
 
+from repanier.email.email import send_email_in_batch
 from repanier.models.customer import Customer
 from repanier.models.offeritem import OfferItemWoReceiver
 from repanier.models.permanence import Permanence
@@ -16,6 +17,7 @@ from repanier.models.staff import Staff
 from repanier.tools import *
 
 
+@send_email_in_batch
 def send_pre_open_order(permanence_id):
     from repanier.apps import REPANIER_SETTINGS_GROUP_NAME, REPANIER_SETTINGS_CONFIG
     cur_language = translation.get_language()
@@ -83,6 +85,7 @@ def send_pre_open_order(permanence_id):
     translation.activate(cur_language)
 
 
+@send_email_in_batch
 def send_open_order(permanence_id):
     from repanier.apps import REPANIER_SETTINGS_GROUP_NAME, REPANIER_SETTINGS_CONFIG
     cur_language = translation.get_language()
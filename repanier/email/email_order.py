@@ -1,10 +1,13 @@
 # -*- coding: utf-8
+import multiprocessing
 
+from django.core.cache import caches
 from django.core.urlresolvers import reverse
+from django.db import connection, connections
 from django.template import Template, Context as TemplateContext
 from django.utils.translation import ugettext_lazy as _
-from openpyxl.writer.excel import save_virtual_workbook
 
+from repanier.email.email import send_email_in_batch
 from repanier.models.customer import Customer
 from repanier.models.deliveryboard import DeliveryBoard
 from repanier.models.invoice import CustomerInvoice, ProducerInvoice
@@ -13,11 +16,15 @@ from repanier.models.permanenceboard import PermanenceBoard
 from repanier.models.producer import Producer
 from repanier.models.staff import Staff
 from repanier.tools import *
+from repanier.xlsx.export_tools import write_workbook, export_in_context
 from repanier.xlsx.xlsx_order import generate_customer_xlsx, generate_producer_xlsx
 
 
+@send_email_in_batch
+@export_in_context
 def email_order(permanence_id, everything=True, producers_id=(), deliveries_id=()):
     from repanier.apps import REPANIER_SETTINGS_SEND_ORDER_MAIL_TO_BOARD, \
+        REPANIER_SETTINGS_SEND_ABSTRACT_ORDER_MAIL_TO_CUSTOMER, \
         REPANIER_SETTINGS_GROUP_NAME, \
         REPANIER_SETTINGS_CONFIG
     cur_language = translation.get_language()
@@ -86,7 +93,7 @@ def email_order(permanence_id, everything=True, producers_id=(), deliveries_id=(
                     reply_to=order_responsible.get_reply_to_email
                 )
                 email.attach(filename,
-                             save_virtual_workbook(wb),
+                             write_workbook(wb),
                              'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
                 email.send_email()
 
@@ -97,66 +104,21 @@ def email_order(permanence_id, everything=True, producers_id=(), deliveries_id=(
         ).order_by('?')
         if len(producers_id) > 0:
             producer_set = producer_set.filter(id__in=producers_id)
+        producers = {}
+        tasks = []
         for producer in producer_set:
-            long_profile_name = producer.long_profile_name if producer.long_profile_name is not None else producer.short_profile_name
-            wb = generate_producer_xlsx(permanence=permanence, producer=producer, wb=None)
-
-            order_producer_mail = config.safe_translation_getter(
-                'order_producer_mail', any_language=True, default=EMPTY_STRING
-            )
-            order_producer_mail_subject = "{} - {}".format(REPANIER_SETTINGS_GROUP_NAME, permanence)
-
-            template = Template(order_producer_mail)
-            context = TemplateContext({
-                'name': long_profile_name,
-                'long_profile_name': long_profile_name,
-                'order_empty': wb is None,
-                'duplicate': not (wb is None or producer.manage_replenishment),
-                'permanence_link': mark_safe("<a href=\"https://{}{}\">{}</a>".format(
-                    settings.ALLOWED_HOSTS[0], reverse('order_view', args=(permanence.id,)), permanence)),
-                'signature': order_responsible.get_html_signature
-            })
-            html_body = template.render(context)
-
-            producer_invoice = ProducerInvoice.objects.filter(
-                producer_id=producer.id, permanence_id=permanence.id
-            ).only("total_price_with_tax").order_by('?').first()
-
-            to_email = []
-            if producer_invoice is not None \
-                    and producer_invoice.total_price_with_tax < producer.minimum_order_value:
-                html_body = "{}<br><br>{}".format(
-                    order_producer_mail_subject, html_body
+            producers[producer.id] = producer
+            task = (language_code, permanence.id, producer.id)
+            if producer.represent_this_buyinggroup and abstract_ws is not None:
+                # The abstract sheet can't be sent to another process
+                email_producer_order(
+                    permanence, producer, render_producer_order(task, abstract_ws)[1], filename, order_responsible
                 )
-                order_producer_mail_subject = _(
-                    '⚠ Mail not send to our producer {} because the minimum order value has not been reached.').format(
-                    long_profile_name)
             else:
-                if producer.email:
-                    to_email.append(producer.email)
-                if producer.email2:
-                    to_email.append(producer.email2)
-                if producer.email3:
-                    to_email.append(producer.email3)
-            to_email = list(set(to_email + order_responsible.get_to_email + Staff.get_to_order_copy()))
-            email = RepanierEmail(
-                subject=order_producer_mail_subject,
-                html_body=html_body,
-                from_email=order_responsible.get_from_email,
-                to=to_email,
-                reply_to=order_responsible.get_reply_to_email
-            )
-            if wb is not None:
-                if producer.represent_this_buyinggroup:
-                    if abstract_ws is not None:
-                        wb.add_sheet(abstract_ws, index=0)
-                email.attach(
-                    filename,
-                    save_virtual_workbook(wb),
-                    'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-                )
-
-            email.send_email()
+                tasks.append(task)
+        # The mails are sent while the next documents are rendered
+        for producer_id, document in render_documents(render_producer_order, tasks):
+            email_producer_order(permanence, producers[producer_id], document, filename, order_responsible)
 
         if everything:
             # Orders send to our customers only if they don't have already received it
@@ -174,12 +136,21 @@ def email_order(permanence_id, everything=True, producers_id=(), deliveries_id=(
                     customer_set = customer_set.filter(
                         customerinvoice__delivery_id__in=deliveries_id,
                     )
-                for customer in customer_set:
-                    export_order_2_1_customer(
-                        customer, filename, permanence,
-                        order_responsible,
-                        abstract_ws
-                    )
+                customers = {customer.id: customer for customer in customer_set}
+                tasks = [(language_code, permanence.id, customer_id) for customer_id in customers]
+                if REPANIER_SETTINGS_SEND_ABSTRACT_ORDER_MAIL_TO_CUSTOMER and abstract_ws is not None:
+                    # The abstract sheet can't be sent to another process
+                    documents = (render_customer_order(task, abstract_ws) for task in tasks)
+                else:
+                    documents = render_documents(render_customer_order, tasks)
+                for customer_id, document in documents:
+                    customer = customers[customer_id]
+                    if document is not None:
+                        export_order_2_1_customer(
+                            customer, filename, permanence,
+                            order_responsible,
+                            document=document
+                        )
                     # confirm_customer_invoice(permanence_id, customer.id)
                     customer_invoice = CustomerInvoice.objects.filter(
                         customer_id=customer.id,
@@ -190,6 +161,122 @@ def email_order(permanence_id, everything=True, producers_id=(), deliveries_id=(
     translation.activate(cur_language)
 
 
+def render_documents(render, tasks):
+    # Yield render(task) for each task.
+    # The documents are rendered by a pool of processes and yielded as soon as they are ready,
+    # so that the mails are sent while the next documents are rendered.
+    processes = settings.REPANIER_SETTINGS_ORDER_DOCUMENT_PROCESSES or multiprocessing.cpu_count()
+    if processes <= 1 or len(tasks) <= 1 or connection.in_atomic_block:
+        # The processes of the pool wouldn't see the changes not yet committed
+        for task in tasks:
+            yield render(task)
+        return
+    # Don't share the database and the cache connections with the processes of the pool
+    connections.close_all()
+    for cache in caches.all():
+        cache.close()
+    pool = multiprocessing.Pool(min(processes, len(tasks)))
+    try:
+        for result in pool.imap_unordered(render, tasks):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def render_producer_order(task, abstract_ws=None):
+    # Read only : run into a process of the pool. Return (producer_id, xlsx content or None)
+    # The content goes back to the main process, so it is read into bytes.
+    language_code, permanence_id, producer_id = task
+    translation.activate(language_code)
+    permanence = Permanence.objects.get(id=permanence_id)
+    producer = Producer.objects.get(id=producer_id)
+    wb = generate_producer_xlsx(permanence=permanence, producer=producer, wb=None)
+    if wb is None:
+        return producer_id, None
+    if abstract_ws is not None:
+        wb.add_sheet(abstract_ws, index=0)
+    return producer_id, write_workbook(wb).read()
+
+
+def render_customer_order(task, abstract_ws=None):
+    # Read only : run into a process of the pool. Return (customer_id, xlsx content or None)
+    # The content goes back to the main process, so it is read into bytes.
+    language_code, permanence_id, customer_id = task
+    translation.activate(language_code)
+    permanence = Permanence.objects.get(id=permanence_id)
+    customer = Customer.objects.get(id=customer_id)
+    wb = generate_customer_xlsx(permanence=permanence, customer=customer)[0]
+    translation.activate(language_code)
+    if wb is None:
+        return customer_id, None
+    if abstract_ws is not None:
+        wb.add_sheet(abstract_ws, index=0)
+    return customer_id, write_workbook(wb).read()
+
+
+def email_producer_order(permanence, producer, document, filename, order_responsible):
+    from repanier.apps import REPANIER_SETTINGS_GROUP_NAME, REPANIER_SETTINGS_CONFIG
+
+    config = REPANIER_SETTINGS_CONFIG
+    long_profile_name = producer.long_profile_name if producer.long_profile_name is not None else producer.short_profile_name
+    order_producer_mail = config.safe_translation_getter(
+        'order_producer_mail', any_language=True, default=EMPTY_STRING
+    )
+    order_producer_mail_subject = "{} - {}".format(REPANIER_SETTINGS_GROUP_NAME, permanence)
+
+    template = Template(order_producer_mail)
+    context = TemplateContext({
+        'name': long_profile_name,
+        'long_profile_name': long_profile_name,
+        'order_empty': document is None,
+        'duplicate': not (document is None or producer.manage_replenishment),
+        'permanence_link': mark_safe("<a href=\"https://{}{}\">{}</a>".format(
+            settings.ALLOWED_HOSTS[0], reverse('order_view', args=(permanence.id,)), permanence)),
+        'signature': order_responsible.get_html_signature
+    })
+    html_body = template.render(context)
+
+    producer_invoice = ProducerInvoice.objects.filter(
+        producer_id=producer.id, permanence_id=permanence.id
+    ).only("total_price_with_tax").order_by('?').first()
+
+    to_email = []
+    if producer_invoice is not None \
+            and producer_invoice.total_price_with_tax < producer.minimum_order_value:
+        html_body = "{}<br><br>{}".format(
+            order_producer_mail_subject, html_body
+        )
+        order_producer_mail_subject = _(
+            '⚠ Mail not send to our producer {} because the minimum order value has not been reached.').format(
+            long_profile_name)
+    else:
+        if producer.email:
+            to_email.append(producer.email)
+        if producer.email2:
+            to_email.append(producer.email2)
+        if producer.email3:
+            to_email.append(producer.email3)
+    to_email = list(set(to_email + order_responsible.get_to_email + Staff.get_to_order_copy()))
+    email = RepanierEmail(
+        subject=order_producer_mail_subject,
+        html_body=html_body,
+        from_email=order_responsible.get_from_email,
+        to=to_email,
+        reply_to=order_responsible.get_reply_to_email
+    )
+    if document is not None:
+        email.attach(
+            filename,
+            document,
+            'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+        )
+
+    email.send_email()
+
+
+@export_in_context
 def export_order_2_1_group(config, delivery_id, filename, permanence, order_responsible):
     delivery_board = DeliveryBoard.objects.filter(
         id=delivery_id
@@ -245,14 +332,16 @@ def export_order_2_1_group(config, delivery_id, filename, permanence, order_resp
             reply_to=order_responsible.get_reply_to
         )
         email.attach(filename,
-                     save_virtual_workbook(wb),
+                     write_workbook(wb),
                      'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
 
         email.send_email()
 
 
+@export_in_context
 def export_order_2_1_customer(customer, filename, permanence, order_responsible=None,
-                              abstract_ws=None, cancel_order=False):
+                              abstract_ws=None, cancel_order=False, document=None):
+    # document : the xlsx content (bytes or file object) when already rendered
     from repanier.apps import \
         REPANIER_SETTINGS_GROUP_NAME, \
         REPANIER_SETTINGS_SEND_ABSTRACT_ORDER_MAIL_TO_CUSTOMER, \
@@ -266,8 +355,11 @@ def export_order_2_1_customer(customer, filename, permanence, order_responsible=
     if customer_invoice is not None:
         if order_responsible is None:
             order_responsible = Staff.get_or_create_order_responsible()
-        wb = generate_customer_xlsx(permanence=permanence, customer=customer)[0]
-        if wb is not None:
+        if document is None:
+            wb = generate_customer_xlsx(permanence=permanence, customer=customer)[0]
+        else:
+            wb = None
+        if wb is not None or document is not None:
             to_email = [customer.user.email]
             if customer.email2:
                 to_email.append(customer.email2)
@@ -328,11 +420,13 @@ def export_order_2_1_customer(customer, filename, permanence, order_responsible=
                 show_customer_may_unsubscribe=False,
                 send_even_if_unsubscribed=True
             )
-            if not cancel_order and REPANIER_SETTINGS_SEND_ABSTRACT_ORDER_MAIL_TO_CUSTOMER:
-                if abstract_ws is not None:
-                    wb.add_sheet(abstract_ws, index=0)
+            if document is None:
+                if not cancel_order and REPANIER_SETTINGS_SEND_ABSTRACT_ORDER_MAIL_TO_CUSTOMER:
+                    if abstract_ws is not None:
+                        wb.add_sheet(abstract_ws, index=0)
+                document = write_workbook(wb)
             email.attach(filename,
-                         save_virtual_workbook(wb),
+                         document,
                          'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
 
             email.send_email()
@@ -0,0 +1,123 @@
+# -*- coding: utf-8
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import translation
+
+from repanier.cache import get_versioned_cache_key, permanence_namespace
+
+# Navigation of the order form : the boxes, the producers and the departments of a permanence.
+# They only change with the offer, so they are calculated once per permanence, producer filter
+# and language, then cached into the namespace of the permanence.
+# The namespace is invalidated when the offer is opened (reorder_offer_items), when the products
+# are updated (update_offer_item) and when the status of the permanence changes.
+# Plain lists of dicts, so that the template does not query the database.
+
+
+def get_order_facets(permanence_id, producer_id='all'):
+    language_code = translation.get_language()
+    cache_key = get_versioned_cache_key(
+        "order_facets_{}_{}_{}".format(permanence_id, producer_id, language_code),
+        permanence_namespace(permanence_id)
+    )
+    facets = cache.get(cache_key)
+    if facets is None:
+        facets = calculate_order_facets(permanence_id, producer_id, language_code)
+        cache.set(cache_key, facets)
+    return facets
+
+
+def calculate_order_facets(permanence_id, producer_id, language_code):
+    from repanier.models.lut import LUT_DepartmentForCustomer
+    from repanier.models.offeritem import OfferItemWoReceiver
+    from repanier.models.producer import Producer
+
+    if settings.REPANIER_SETTINGS_SHOW_PRODUCER_ON_ORDER_FORM:
+        producers = list(Producer.objects.filter(permanence=permanence_id).values("id", "short_profile_name"))
+    else:
+        producers = None
+    department_qs = LUT_DepartmentForCustomer.objects.filter(
+        offeritem__permanence_id=permanence_id,
+        offeritem__is_active=True,
+        offeritem__is_box=False)
+    if producer_id != 'all':
+        department_qs = department_qs.filter(offeritem__producer_id=producer_id)
+    department_list = list(department_qs.order_by(
+        "tree_id", "lft"
+    ).distinct(
+        "id", "tree_id", "lft"
+    ).prefetch_related("translations"))
+    parents = {
+        parent.id: {
+            "level": parent.level,
+            "short_name": parent.safe_translation_getter('short_name', any_language=True)
+        } for parent in LUT_DepartmentForCustomer.objects.filter(
+            id__in={department.parent_id for department in department_list if department.parent_id is not None}
+        ).order_by('?').prefetch_related("translations")
+    }
+    departments = [
+        {
+            "id": department.id,
+            "level": department.level,
+            "tree_id": department.tree_id,
+            "lft": department.lft,
+            "rght": department.rght,
+            "parent_id": department.parent_id,
+            "parent": parents.get(department.parent_id),
+            "short_name": department.safe_translation_getter('short_name', any_language=True)
+        } for department in department_list
+    ]
+    boxes = [
+        {
+            "id": box_id,
+            "long_name": long_name
+        } for box_id, long_name in OfferItemWoReceiver.objects.filter(
+            permanence_id=permanence_id,
+            is_box=True,
+            is_active=True,
+            may_order=True,
+            translations__language_code=language_code
+        ).order_by(
+            'customer_unit_price',
+            'unit_deposit',
+            'translations__long_name',
+        ).values_list("id", "translations__long_name")
+    ]
+    return {
+        "producers": producers,
+        "departments": departments,
+        "boxes": boxes
+    }
+
+
+def get_offer_departments(offer_item_qs, permanence_id, producer_id, permanences_date):
+    # The departments of the offer items the customer may order (offer_item_qs), before the department filter.
+    # Unlike the departments of the navigation, they depend on may_order and on the date of the contracts,
+    # so they are cached per date as well.
+    language_code = translation.get_language()
+    cache_key = get_versioned_cache_key(
+        "offer_departments_{}_{}_{}_{}".format(permanence_id, producer_id, permanences_date, language_code),
+        permanence_namespace(permanence_id)
+    )
+    departments = cache.get(cache_key)
+    if departments is None:
+        departments = [
+            {
+                "tree_id": tree_id,
+                "lft": lft,
+                "rght": rght
+            } for tree_id, lft, rght in offer_item_qs.filter(
+                department_for_customer__isnull=False
+            ).order_by().values_list(
+                "department_for_customer__tree_id", "department_for_customer__lft", "department_for_customer__rght"
+            ).distinct()
+        ]
+        cache.set(cache_key, departments)
+    return departments
+
+
+def department_has_offer(departments, department):
+    # Does the department, or one of its sub departments, contain offer items ?
+    return any(
+        row["tree_id"] == department.tree_id and row["lft"] >= department.lft and row["rght"] <= department.rght
+        for row in departments
+    )
@@ -0,0 +1,196 @@
+# -*- coding: utf-8
+from django.db.models import F, Sum, Case, When, Value
+
+from repanier.const import *
+
+# Ledger of the amounts "not yet invoiced" of the customers and of the producers :
+# the bank movements not yet invoiced and the orders not yet invoiced.
+# They are stored into the customer / producer row (ledger_bank_not_invoiced, ledger_order_not_invoiced)
+# and valid when ledger_calculated_version == ledger_version.
+# Any change to the bank movements, to the totals or to the statuses of the invoices increments
+# ledger_version. The next read recalculates the ledger.
+# A refresh only stores its result if ledger_version has not been incremented meanwhile.
+# The ledger fields are only written by the update() of this module : a full save() of a customer
+# or of a producer skips them, so that a stale instance never writes back an old version.
+
+LEDGER_FIELDS = (
+    "ledger_bank_not_invoiced", "ledger_order_not_invoiced", "ledger_version", "ledger_calculated_version"
+)
+
+
+def get_update_fields_wo_ledger(instance):
+    return [
+        field.name for field in instance._meta.concrete_fields
+        if not field.primary_key and field.name not in LEDGER_FIELDS
+    ]
+
+
+def invalidate_customer_ledger(*customer_ids):
+    from repanier.models.customer import Customer
+
+    customer_ids = [customer_id for customer_id in customer_ids if customer_id is not None]
+    if customer_ids:
+        Customer.objects.filter(id__in=customer_ids).order_by('?').update(ledger_version=F('ledger_version') + 1)
+
+
+def invalidate_producer_ledger(*producer_ids):
+    from repanier.models.producer import Producer
+
+    producer_ids = [producer_id for producer_id in producer_ids if producer_id is not None]
+    if producer_ids:
+        Producer.objects.filter(id__in=producer_ids).order_by('?').update(ledger_version=F('ledger_version') + 1)
+
+
+def invalidate_permanence_ledger(permanence_id):
+    # The customers and the producers having an invoice into this permanence
+    from repanier.models.customer import Customer
+    from repanier.models.invoice import CustomerInvoice, ProducerInvoice
+    from repanier.models.producer import Producer
+
+    Customer.objects.filter(
+        id__in=CustomerInvoice.objects.filter(permanence_id=permanence_id).order_by('?').values('customer_id')
+    ).order_by('?').update(ledger_version=F('ledger_version') + 1)
+    Producer.objects.filter(
+        id__in=ProducerInvoice.objects.filter(permanence_id=permanence_id).order_by('?').values('producer_id')
+    ).order_by('?').update(ledger_version=F('ledger_version') + 1)
+
+
+def invalidate_all_ledgers():
+    from repanier.models.customer import Customer
+    from repanier.models.producer import Producer
+
+    Customer.objects.order_by('?').update(ledger_version=F('ledger_version') + 1)
+    Producer.objects.order_by('?').update(ledger_version=F('ledger_version') + 1)
+
+
+def calculate_customer_ledger(customer_ids=None):
+    # {customer_id: [bank_not_invoiced, order_not_invoiced]} with one grouped aggregate per amount
+    # Note : .order_by() and not .order_by('?'), the random order would be added to the "group by"
+    from repanier.models.bankaccount import BankAccount
+    from repanier.models.invoice import CustomerInvoice
+
+    bank_qs = BankAccount.objects.filter(
+        customer__isnull=False,
+        customer_invoice__isnull=True
+    )
+    order_qs = CustomerInvoice.objects.filter(
+        status__gte=PERMANENCE_OPENED,
+        status__lte=PERMANENCE_SEND,
+        customer_charged_id=F('customer_id')
+    )
+    if customer_ids is not None:
+        bank_qs = bank_qs.filter(customer_id__in=customer_ids)
+        order_qs = order_qs.filter(customer_id__in=customer_ids)
+    return _calculate_ledger(bank_qs, order_qs, 'customer_id', customer_ids)
+
+
+def calculate_producer_ledger(producer_ids=None):
+    # {producer_id: [bank_not_invoiced, order_not_invoiced]}
+    from repanier.models.bankaccount import BankAccount
+    from repanier.models.invoice import ProducerInvoice
+
+    bank_qs = BankAccount.objects.filter(
+        producer__isnull=False,
+        producer_invoice__isnull=True
+    )
+    order_qs = ProducerInvoice.objects.filter(
+        status__gte=PERMANENCE_OPENED,
+        status__lte=PERMANENCE_SEND
+    )
+    if producer_ids is not None:
+        bank_qs = bank_qs.filter(producer_id__in=producer_ids)
+        order_qs = order_qs.filter(producer_id__in=producer_ids)
+    return _calculate_ledger(bank_qs, order_qs, 'producer_id', producer_ids)
+
+
+def _calculate_ledger(bank_qs, order_qs, key, ids):
+    ledger = {}
+    for row in bank_qs.order_by().values(key).annotate(
+            Sum('bank_amount_in'), Sum('bank_amount_out')
+    ):
+        ledger[row[key]] = [
+            (row["bank_amount_in__sum"] or DECIMAL_ZERO) - (row["bank_amount_out__sum"] or DECIMAL_ZERO),
+            DECIMAL_ZERO
+        ]
+    for row in order_qs.order_by().values(key).annotate(
+            Sum('total_price_with_tax'), Sum('delta_price_with_tax'), Sum('delta_transport')
+    ):
+        ledger.setdefault(row[key], [DECIMAL_ZERO, DECIMAL_ZERO])[1] = \
+            (row["total_price_with_tax__sum"] or DECIMAL_ZERO) + \
+            (row["delta_price_with_tax__sum"] or DECIMAL_ZERO) + \
+            (row["delta_transport__sum"] or DECIMAL_ZERO)
+    for row_id in ids or ():
+        ledger.setdefault(row_id, [DECIMAL_ZERO, DECIMAL_ZERO])
+    return ledger
+
+
+def refresh_customer_ledger(customer_ids=None):
+    from repanier.models.customer import Customer
+
+    return _refresh_ledger(Customer, calculate_customer_ledger, customer_ids)
+
+
+def refresh_producer_ledger(producer_ids=None):
+    from repanier.models.producer import Producer
+
+    return _refresh_ledger(Producer, calculate_producer_ledger, producer_ids)
+
+
+def _refresh_ledger(model, calculate_ledger, ids):
+    # Recalculate and store the ledger of the given ids, or of all the rows not up to date.
+    # Return {id: [bank_not_invoiced, order_not_invoiced]}
+    qs = model.objects.order_by('?')
+    if ids is not None:
+        qs = qs.filter(id__in=ids)
+    else:
+        qs = qs.exclude(ledger_calculated_version=F('ledger_version'))
+    # Read the versions before the amounts
+    versions = dict(qs.values_list('id', 'ledger_version'))
+    if not versions:
+        return {}
+    ledger = calculate_ledger(list(versions))
+    bank_field = model._meta.get_field('ledger_bank_not_invoiced')
+    order_field = model._meta.get_field('ledger_order_not_invoiced')
+    version_field = model._meta.get_field('ledger_calculated_version')
+    rows = list(versions.items())
+    for i in range(0, len(rows), BULK_UPDATE_BATCH_SIZE):
+        batch = rows[i:i + BULK_UPDATE_BATCH_SIZE]
+        model.objects.filter(id__in=[row_id for row_id, _version in batch]).order_by('?').update(
+            ledger_bank_not_invoiced=Case(
+                *[When(id=row_id, ledger_version=version, then=Value(ledger[row_id][0], output_field=bank_field))
+                  for row_id, version in batch],
+                default=F('ledger_bank_not_invoiced'),
+                output_field=bank_field
+            ),
+            ledger_order_not_invoiced=Case(
+                *[When(id=row_id, ledger_version=version, then=Value(ledger[row_id][1], output_field=order_field))
+                  for row_id, version in batch],
+                default=F('ledger_order_not_invoiced'),
+                output_field=order_field
+            ),
+            ledger_calculated_version=Case(
+                *[When(id=row_id, ledger_version=version, then=Value(version, output_field=version_field))
+                  for row_id, version in batch],
+                default=F('ledger_calculated_version'),
+                output_field=version_field
+            )
+        )
+    return ledger
+
+
+def check_ledgers():
+    # Compare the stored ledgers, when up to date, with a full recalculation.
+    # Return [(model, id, stored [bank, order], calculated [bank, order]), ...]
+    from repanier.models.customer import Customer
+    from repanier.models.producer import Producer
+
+    differences = []
+    for model, calculate_ledger in ((Customer, calculate_customer_ledger), (Producer, calculate_producer_ledger)):
+        ledger = calculate_ledger()
+        for row_id, bank_not_invoiced, order_not_invoiced in model.objects.filter(
+                ledger_calculated_version=F('ledger_version')
+        ).order_by('id').values_list('id', 'ledger_bank_not_invoiced', 'ledger_order_not_invoiced'):
+            calculated = ledger.get(row_id, [DECIMAL_ZERO, DECIMAL_ZERO])
+            if [bank_not_invoiced, order_not_invoiced] != calculated:
+                differences.append((model, row_id, [bank_not_invoiced, order_not_invoiced], calculated))
+    return differences
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+
+from repanier.ledger import check_ledgers, invalidate_customer_ledger, invalidate_producer_ledger, \
+    refresh_customer_ledger, refresh_producer_ledger
+from repanier.models.customer import Customer
+
+
+class Command(BaseCommand):
+    args = '<none>'
+    help = 'Check the amounts not yet invoiced stored into the ledger against a full recalculation'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true', help='Recalculate the wrong ledgers')
+
+    def handle(self, *args, **options):
+        differences = check_ledgers()
+        for model, row_id, stored, calculated in differences:
+            self.stdout.write("{} {} : bank not invoiced {} / {}, order not invoiced {} / {}".format(
+                model.__name__, row_id, stored[0], calculated[0], stored[1], calculated[1]
+            ))
+        self.stdout.write("{} difference(s)".format(len(differences)))
+        if options['fix'] and differences:
+            customer_ids = [row_id for model, row_id, _stored, _calculated in differences if model is Customer]
+            producer_ids = [row_id for model, row_id, _stored, _calculated in differences if model is not Customer]
+            invalidate_customer_ledger(*customer_ids)
+            invalidate_producer_ledger(*producer_ids)
+            refresh_customer_ledger()
+            refresh_producer_ledger()
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from repanier.stock import check_stock, open_stock_ledger, replay_stock
+
+
+class Command(BaseCommand):
+    args = '<none>'
+    help = 'Check the stock of the products against the sum of their stock movements'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--open', action='store_true',
+                            help='Take the stock of the products as it is : record the differences as inventory movements')
+        parser.add_argument('--fix', action='store_true', help='Rebuild the wrong stocks from their movements')
+
+    @transaction.atomic
+    def handle(self, *args, **options):
+        if options['open']:
+            self.stdout.write("{} movement(s) recorded".format(open_stock_ledger()))
+        differences = check_stock()
+        for product_id, stored, calculated in differences:
+            self.stdout.write("Product {} : stock {} / {}".format(product_id, stored, calculated))
+        self.stdout.write("{} difference(s)".format(len(differences)))
+        if options['fix'] and differences:
+            replay_stock([product_id for product_id, _stored, _calculated in differences])
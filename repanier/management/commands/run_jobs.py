@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+import time
+
+from django.core.management.base import BaseCommand
+
+from repanier.const import JOB_FAILED
+from repanier.models.job import Job
+
+
+class Command(BaseCommand):
+    args = '<none>'
+    help = 'Run the queued jobs (open, close, send invoices, ...). Interrupted jobs resume at the failed step'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Run the queued jobs then stop')
+        parser.add_argument('--retry', type=int, help='Queue again the failed job with this id')
+        parser.add_argument('--sleep', type=int, default=5, help='Seconds to wait when no job is queued')
+
+    def handle(self, *args, **options):
+        if options['retry'] is not None:
+            job = Job.objects.filter(id=options['retry'], status=JOB_FAILED).order_by('?').first()
+            if job is None:
+                self.stdout.write('No failed job {}'.format(options['retry']))
+                return
+            job.retry()
+        while True:
+            Job.requeue_interrupted()
+            while Job.run_next():
+                pass
+            if options['once']:
+                break
+            time.sleep(options['sleep'])
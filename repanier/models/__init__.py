@@ -5,6 +5,7 @@ from .configuration import Configuration
 from .customer import Customer
 from .deliveryboard import DeliveryBoard
 from .invoice import CustomerInvoice, ProducerInvoice, CustomerProducerInvoice
+from .job import Job
 from .lut import LUT_ProductionMode, LUT_DeliveryPoint, LUT_DepartmentForCustomer, LUT_PermanenceRole
 from .offeritem import OfferItem
 from .permanence import Permanence
@@ -13,6 +14,7 @@ from .producer import Producer
 from .product import Product, Product_Translation
 from .purchase import Purchase
 from .staff import Staff
+from .stockmovement import StockMovement
 # after Producer and Product
 from .box import Box
 from .box import BoxContent
@@ -2,6 +2,8 @@
 
 from django.core.validators import MinValueValidator
 from django.db import models
+from django.db.models.signals import post_init, post_save, post_delete
+from django.dispatch import receiver
 from django.utils import timezone
 from django.utils.safestring import mark_safe
 from django.utils.translation import ugettext_lazy as _
@@ -9,6 +11,7 @@ from django.utils.translation import ugettext_lazy as _
 from repanier.apps import REPANIER_SETTINGS_PERMANENCE_NAME
 from repanier.const import *
 from repanier.fields.RepanierMoneyField import ModelMoneyField
+from repanier.ledger import invalidate_customer_ledger, invalidate_producer_ledger
 
 
 class BankAccount(models.Model):
@@ -165,3 +168,26 @@ class BankAccount(models.Model):
             ['producer_invoice', 'operation_date', 'operation_date', 'id'],
             ['permanence', 'customer', 'producer', 'operation_date', 'id'],
         ]
+
+
+@receiver(post_init, sender=BankAccount)
+def bank_account_post_init(sender, **kwargs):
+    bank_account = kwargs["instance"]
+    bank_account.previous_customer_id = bank_account.customer_id
+    bank_account.previous_producer_id = bank_account.producer_id
+
+
+@receiver(post_save, sender=BankAccount)
+def bank_account_post_save(sender, **kwargs):
+    bank_account = kwargs["instance"]
+    invalidate_customer_ledger(bank_account.customer_id, bank_account.previous_customer_id)
+    invalidate_producer_ledger(bank_account.producer_id, bank_account.previous_producer_id)
+    bank_account.previous_customer_id = bank_account.customer_id
+    bank_account.previous_producer_id = bank_account.producer_id
+
+
+@receiver(post_delete, sender=BankAccount)
+def bank_account_post_delete(sender, **kwargs):
+    bank_account = kwargs["instance"]
+    invalidate_customer_ledger(bank_account.customer_id)
+    invalidate_producer_ledger(bank_account.producer_id)
@@ -3,13 +3,13 @@
 from django.core.validators import MinValueValidator
 from django.db import models
 from django.db.models import Sum
-from django.db.models.signals import pre_save
+from django.db.models.signals import pre_save, post_init, post_save
 from django.dispatch import receiver
 from django.utils.translation import ugettext_lazy as _
 
 from repanier.const import *
 from repanier.fields.RepanierMoneyField import ModelMoneyField
-from repanier.models.product import Product, product_pre_save
+from repanier.models.product import Product, product_pre_save, product_post_init, record_stock_inventory
 
 
 class Box(Product):
@@ -71,6 +71,16 @@ def box_pre_save(sender, **kwargs):
     product_pre_save(sender, **kwargs)
 
 
+@receiver(post_init, sender=Box)
+def box_post_init(sender, **kwargs):
+    product_post_init(sender, **kwargs)
+
+
+@receiver(post_save, sender=Box)
+def box_post_save(sender, **kwargs):
+    record_stock_inventory(kwargs["instance"])
+
+
 class BoxContent(models.Model):
     box = models.ForeignKey(
         'Box', verbose_name=_("Box"),
@@ -3,7 +3,6 @@ from cms.toolbar_pool import toolbar_pool
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.sites.models import Site
-from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.core.validators import MinValueValidator
 from django.db import models
@@ -17,6 +16,7 @@ from djangocms_text_ckeditor.fields import HTMLField
 from menus.menu_pool import menu_pool
 from parler.models import TranslatableModel, TranslatedFields, TranslationDoesNotExist
 
+from repanier.cache import invalidate_cache, CACHE_VERSION_PAGE
 from repanier.const import *
 from repanier.fields.RepanierMoneyField import ModelMoneyField
 
@@ -555,4 +555,4 @@ def configuration_post_save(sender, **kwargs):
         menu_pool.clear()
         toolbar_pool.unregister(repanier.cms_toolbar.RepanierToolbar)
         toolbar_pool.register(repanier.cms_toolbar.RepanierToolbar)
-        cache.clear()
+        invalidate_cache(CACHE_VERSION_PAGE)
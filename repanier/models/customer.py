@@ -9,7 +9,7 @@ from django.core import urlresolvers
 from django.core.signing import TimestampSigner, BadSignature, SignatureExpired
 from django.core.validators import MinValueValidator
 from django.db import models
-from django.db.models import Q, Sum
+from django.db.models import Q
 from django.db.models.signals import pre_save, post_delete
 from django.dispatch import receiver
 from django.urls import reverse
@@ -19,7 +19,7 @@ from django.utils.translation import ugettext_lazy as _
 
 from repanier.const import *
 from repanier.fields.RepanierMoneyField import ModelMoneyField, RepanierMoney
-from repanier.models.bankaccount import BankAccount
+from repanier.ledger import get_update_fields_wo_ledger
 from repanier.models.invoice import CustomerInvoice
 from repanier.models.permanenceboard import PermanenceBoard
 from repanier.picture.const import SIZE_S
@@ -98,6 +98,13 @@ class Customer(models.Model):
     # The initial balance is needed to compute the invoice control list
     initial_balance = ModelMoneyField(
         _("Initial balance"), max_digits=8, decimal_places=2, default=DECIMAL_ZERO)
+    # Amounts not yet invoiced, maintained by repanier.ledger
+    ledger_bank_not_invoiced = ModelMoneyField(
+        max_digits=8, decimal_places=2, default=DECIMAL_ZERO, editable=False)
+    ledger_order_not_invoiced = ModelMoneyField(
+        max_digits=8, decimal_places=2, default=DECIMAL_ZERO, editable=False)
+    ledger_version = models.IntegerField(default=0, editable=False)
+    ledger_calculated_version = models.IntegerField(default=-1, editable=False)
     represent_this_buyinggroup = models.BooleanField(
         _("Represent_this_buyinggroup"), default=False)
     delivery_point = models.ForeignKey(
@@ -187,40 +194,27 @@ class Customer(models.Model):
     get_admin_balance.short_description = (_("Balance"))
     get_admin_balance.allow_tags = False
 
+    def get_ledger(self):
+        # [bank_not_invoiced, order_not_invoiced], recalculated only if a movement occurred since the last read
+        if self.id is None:
+            return [DECIMAL_ZERO, DECIMAL_ZERO]
+        if self.ledger_calculated_version != self.ledger_version:
+            from repanier.ledger import refresh_customer_ledger
+
+            self.ledger_bank_not_invoiced, self.ledger_order_not_invoiced = refresh_customer_ledger([self.id])[self.id]
+            self.ledger_calculated_version = self.ledger_version
+        return [self.ledger_bank_not_invoiced.amount, self.ledger_order_not_invoiced.amount]
+
     def get_order_not_invoiced(self):
         if settings.REPANIER_SETTINGS_MANAGE_ACCOUNTING:
-            result_set = CustomerInvoice.objects.filter(
-                customer_id=self.id,
-                status__gte=PERMANENCE_OPENED,
-                status__lte=PERMANENCE_SEND,
-                customer_charged_id=self.id
-            ).order_by('?').aggregate(Sum('total_price_with_tax'), Sum('delta_price_with_tax'), Sum('delta_transport'))
-            if result_set["total_price_with_tax__sum"] is not None:
-                order_not_invoiced = RepanierMoney(result_set["total_price_with_tax__sum"])
-            else:
-                order_not_invoiced = REPANIER_MONEY_ZERO
-            if result_set["delta_price_with_tax__sum"] is not None:
-                order_not_invoiced += RepanierMoney(result_set["delta_price_with_tax__sum"])
-            if result_set["delta_transport__sum"] is not None:
-                order_not_invoiced += RepanierMoney(result_set["delta_transport__sum"])
+            order_not_invoiced = RepanierMoney(self.get_ledger()[1])
         else:
             order_not_invoiced = REPANIER_MONEY_ZERO
         return order_not_invoiced
 
     def get_bank_not_invoiced(self):
         if settings.REPANIER_SETTINGS_MANAGE_ACCOUNTING:
-            result_set = BankAccount.objects.filter(
-                customer_id=self.id, customer_invoice__isnull=True
-            ).order_by('?').aggregate(Sum('bank_amount_in'), Sum('bank_amount_out'))
-            if result_set["bank_amount_in__sum"] is not None:
-                bank_in = RepanierMoney(result_set["bank_amount_in__sum"])
-            else:
-                bank_in = REPANIER_MONEY_ZERO
-            if result_set["bank_amount_out__sum"] is not None:
-                bank_out = RepanierMoney(result_set["bank_amount_out__sum"])
-            else:
-                bank_out = REPANIER_MONEY_ZERO
-            bank_not_invoiced = bank_in - bank_out
+            bank_not_invoiced = RepanierMoney(self.get_ledger()[0])
         else:
             bank_not_invoiced = REPANIER_MONEY_ZERO
         return bank_not_invoiced
@@ -434,6 +428,13 @@ class Customer(models.Model):
         self.show_phones_to_members = False
         self.save()
 
+    def save(self, *args, **kwargs):
+        if not args and not self._state.adding and kwargs.get("update_fields") is None \
+                and not kwargs.get("force_insert"):
+            # Never write back the ledger, see repanier.ledger
+            kwargs["update_fields"] = get_update_fields_wo_ledger(self)
+        super(Customer, self).save(*args, **kwargs)
+
     def __str__(self):
         if self.delivery_point is None:
             return self.short_basket_name
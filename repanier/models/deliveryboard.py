@@ -36,6 +36,7 @@ class DeliveryBoard(TranslatableModel):
     )
 
     def set_status(self, new_status):
+        from repanier.ledger import invalidate_customer_ledger
         from repanier.models.invoice import CustomerInvoice
         from repanier.models.purchase import PurchaseWoReceiver
 
@@ -55,6 +56,9 @@ class DeliveryBoard(TranslatableModel):
         ).order_by('?').update(
             status=new_status
         )
+        invalidate_customer_ledger(*CustomerInvoice.objects.filter(
+            delivery_id=self.id
+        ).order_by('?').values_list('customer_id', flat=True))
 
     def get_delivery_display(self, br=False, color=False):
         short_name = "{}".format(self.delivery_point.safe_translation_getter(
@@ -8,12 +8,15 @@ from django.core.validators import MinValueValidator
 from django.db import models
 from django.db import transaction
 from django.db.models import F, Sum, Q
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from django.utils.formats import number_format
 from django.utils.safestring import mark_safe
 from django.utils.translation import ugettext_lazy as _
 
 from repanier.const import *
 from repanier.fields.RepanierMoneyField import ModelMoneyField
+from repanier.ledger import invalidate_customer_ledger, invalidate_producer_ledger
 from repanier.models.deliveryboard import DeliveryBoard
 from repanier.models.staff import Staff
 from repanier.tools import create_or_update_one_cart_item, round_gov_be
@@ -144,21 +147,36 @@ class CustomerInvoice(Invoice):
         # round to 2 decimals
         return RepanierMoney(self.total_vat.amount + self.delta_vat.amount)
 
+    @classmethod
+    def annotate_purchase_sums(cls, customer_invoice_qs):
+        # The sums used by has_purchase, calculated by the query of the customer invoices
+        return customer_invoice_qs.annotate(
+            sum_quantity_ordered=Sum('purchase__quantity_ordered'),
+            sum_quantity_invoiced=Sum('purchase__quantity_invoiced')
+        )
+
     @property
     def has_purchase(self):
         if self.total_price_with_tax.amount != DECIMAL_ZERO or self.is_order_confirm_send:
             return True
 
-        from repanier.models.purchase import PurchaseWoReceiver
+        if hasattr(self, "sum_quantity_ordered"):
+            # Annotated by annotate_purchase_sums
+            result_set = {
+                "quantity_ordered__sum": self.sum_quantity_ordered,
+                "quantity_invoiced__sum": self.sum_quantity_invoiced
+            }
+        else:
+            from repanier.models.purchase import PurchaseWoReceiver
 
+            result_set = PurchaseWoReceiver.objects.filter(
+                permanence_id=self.permanence_id,
+                customer_invoice_id=self.id
+            ).order_by('?').aggregate(
+                Sum('quantity_ordered'),
+                Sum('quantity_invoiced'),
+            )
         result = False
-        result_set = PurchaseWoReceiver.objects.filter(
-            permanence_id=self.permanence_id,
-            customer_invoice_id=self.id
-        ).order_by('?').aggregate(
-            Sum('quantity_ordered'),
-            Sum('quantity_invoiced'),
-        )
         if result_set["quantity_ordered__sum"] is not None:
             sum_quantity_ordered = result_set["quantity_ordered__sum"]
             if sum_quantity_ordered != DECIMAL_ZERO:
@@ -264,6 +282,7 @@ class CustomerInvoice(Invoice):
                         permanence_id=permanence.id,
                         customer_id=self.customer_id).order_by('?').update(
                         status=PERMANENCE_OPENED)
+                    invalidate_customer_ledger(self.customer_id)
                 else:
                     label = "{}".format(_('No delivery point is open for you. You can not place order.'))
                     # IMPORTANT :
@@ -274,6 +293,7 @@ class CustomerInvoice(Invoice):
                         customer_id=self.customer_id
                     ).order_by('?').update(
                         status=PERMANENCE_CLOSED)
+                    invalidate_customer_ledger(self.customer_id)
             if self.customer_id != self.customer_charged_id:
                 msg_price = msg_transport = EMPTY_STRING
             else:
@@ -479,7 +499,10 @@ class CustomerInvoice(Invoice):
 
             producer_invoice_buyinggroup.save()
 
-    def calculate_delta_price(self):
+    def calculate_delta_price(self, purchase_totals=None):
+        # purchase_totals : the sums of the purchases charged to the customer, when already known
+        # {"customer_vat__sum": ..., "deposit__sum": ..., "selling_price__sum": ...} for all of them (key None)
+        # and for those whose resale price is not fixed (key False), see Permanence.invoice
         from repanier.models.purchase import Purchase
 
         self.delta_price_with_tax.amount = DECIMAL_ZERO
@@ -490,15 +513,18 @@ class CustomerInvoice(Invoice):
             #   self.customer_charged_id = self.customer_id
             #   self.price_list_multiplier may vary
             if self.price_list_multiplier != DECIMAL_ONE:
-                result_set = Purchase.objects.filter(
-                    permanence_id=self.permanence_id,
-                    customer_invoice__customer_charged_id=self.customer_id,
-                    is_resale_price_fixed=False
-                ).order_by('?').aggregate(
-                    Sum('customer_vat'),
-                    Sum('deposit'),
-                    Sum('selling_price')
-                )
+                if purchase_totals is not None:
+                    result_set = purchase_totals[False]
+                else:
+                    result_set = Purchase.objects.filter(
+                        permanence_id=self.permanence_id,
+                        customer_invoice__customer_charged_id=self.customer_id,
+                        is_resale_price_fixed=False
+                    ).order_by('?').aggregate(
+                        Sum('customer_vat'),
+                        Sum('deposit'),
+                        Sum('selling_price')
+                    )
 
                 if result_set["customer_vat__sum"] is not None:
                     total_vat = result_set["customer_vat__sum"]
@@ -524,14 +550,17 @@ class CustomerInvoice(Invoice):
                          ).quantize(FOUR_DECIMALS) - total_vat
                 )
 
-            result_set = Purchase.objects.filter(
-                permanence_id=self.permanence_id,
-                customer_invoice__customer_charged_id=self.customer_id,
-            ).order_by('?').aggregate(
-                Sum('customer_vat'),
-                Sum('deposit'),
-                Sum('selling_price')
-            )
+            if purchase_totals is not None:
+                result_set = purchase_totals[None]
+            else:
+                result_set = Purchase.objects.filter(
+                    permanence_id=self.permanence_id,
+                    customer_invoice__customer_charged_id=self.customer_id,
+                ).order_by('?').aggregate(
+                    Sum('customer_vat'),
+                    Sum('deposit'),
+                    Sum('selling_price')
+                )
         else:
             # It's an invoice of a member of a group
             #   self.customer_charged_id != self.customer_id
@@ -562,18 +591,22 @@ class CustomerInvoice(Invoice):
             total_price_gov_be = round_gov_be(total_price)
             self.delta_price_with_tax.amount += (total_price_gov_be - total_price)
 
-    def calculate_delta_transport(self):
+    def calculate_delta_transport(self, children_totals=None):
+        # children_totals : the sums of the children customer invoices, when already known
 
         self.delta_transport.amount = DECIMAL_ZERO
         if self.master_permanence_id is None and self.transport.amount != DECIMAL_ZERO:
             # Calculate transport only on master customer invoice
             # But take into account the children customer invoices
-            result_set = CustomerInvoice.objects.filter(
-                master_permanence_id=self.permanence_id
-            ).order_by('?').aggregate(
-                Sum('total_price_with_tax'),
-                Sum('delta_price_with_tax')
-            )
+            if children_totals is not None:
+                result_set = children_totals
+            else:
+                result_set = CustomerInvoice.objects.filter(
+                    master_permanence_id=self.permanence_id
+                ).order_by('?').aggregate(
+                    Sum('total_price_with_tax'),
+                    Sum('delta_price_with_tax')
+                )
             if result_set["total_price_with_tax__sum"] is not None:
                 sum_total_price_with_tax = result_set["total_price_with_tax__sum"]
             else:
@@ -738,6 +771,30 @@ class ProducerInvoice(Invoice):
         unique_together = ("permanence", "producer",)
 
 
+@receiver(post_save, sender=CustomerInvoice)
+def customer_invoice_post_save(sender, **kwargs):
+    customer_invoice = kwargs["instance"]
+    invalidate_customer_ledger(customer_invoice.customer_id)
+
+
+@receiver(post_delete, sender=CustomerInvoice)
+def customer_invoice_post_delete(sender, **kwargs):
+    customer_invoice = kwargs["instance"]
+    invalidate_customer_ledger(customer_invoice.customer_id)
+
+
+@receiver(post_save, sender=ProducerInvoice)
+def producer_invoice_post_save(sender, **kwargs):
+    producer_invoice = kwargs["instance"]
+    invalidate_producer_ledger(producer_invoice.producer_id)
+
+
+@receiver(post_delete, sender=ProducerInvoice)
+def producer_invoice_post_delete(sender, **kwargs):
+    producer_invoice = kwargs["instance"]
+    invalidate_producer_ledger(producer_invoice.producer_id)
+
+
 class CustomerProducerInvoice(models.Model):
     customer = models.ForeignKey(
         'Customer', verbose_name=_("Customer"),
@@ -0,0 +1,122 @@
+# -*- coding: utf-8
+import json
+import logging
+import os
+import socket
+
+from django.db import models, transaction
+from django.utils.module_loading import import_string
+from django.utils.translation import ugettext_lazy as _
+
+from repanier.const import *
+
+logger = logging.getLogger(__name__)
+
+
+class Job(models.Model):
+    # A long task (open, close, send invoices, ...) queued by the admin and run by the "run_jobs" command.
+    # The task is made of steps : "step" counts the steps done so that a failed or interrupted job
+    # resumes at the step which did not succeed.
+    task = models.CharField(_("Task"), max_length=100)
+    arguments = models.TextField(_("Arguments"), default="[]")
+    permanence = models.ForeignKey(
+        'Permanence', verbose_name=_("Permanence"),
+        null=True, blank=True, default=None,
+        on_delete=models.CASCADE)
+    status = models.CharField(
+        max_length=3,
+        choices=LUT_JOB_STATUS,
+        default=JOB_QUEUED,
+        verbose_name=_("Status"),
+        db_index=True)
+    step = models.IntegerField(_("Steps done"), default=0)
+    step_name = models.CharField(_("Step"), max_length=100, default=EMPTY_STRING, blank=True)
+    attempt = models.IntegerField(_("Attempt"), default=0)
+    # "host:pid" of the worker running the job
+    worker = models.CharField(max_length=100, default=EMPTY_STRING, blank=True)
+    error = models.TextField(_("Error"), default=EMPTY_STRING, blank=True)
+    is_created_on = models.DateTimeField(_("Created on"), auto_now_add=True)
+    is_updated_on = models.DateTimeField(_("Updated on"), auto_now=True)
+
+    @classmethod
+    def enqueue(cls, task, *arguments, permanence_id=None):
+        # task : dotted path of a function accepting the arguments and a "job" keyword argument
+        return cls.objects.create(
+            task=task,
+            arguments=json.dumps(arguments),
+            permanence_id=permanence_id
+        )
+
+    @classmethod
+    def get_worker_name(cls):
+        return "{}:{}".format(socket.gethostname(), os.getpid())
+
+    @classmethod
+    def requeue_interrupted(cls):
+        # Jobs left running by a dead worker of this host are queued again, they will resume
+        host = socket.gethostname()
+        for job in cls.objects.filter(
+                status=JOB_RUNNING,
+                worker__startswith="{}:".format(host)
+        ).order_by('?'):
+            pid = int(job.worker.split(":")[-1])
+            try:
+                os.kill(pid, 0)
+            except OSError:
+                # No such process
+                cls.objects.filter(id=job.id, status=JOB_RUNNING).update(status=JOB_QUEUED)
+
+    @classmethod
+    def run_next(cls):
+        # Run the oldest queued job. Return False if there is none.
+        with transaction.atomic():
+            job = cls.objects.select_for_update().filter(
+                status=JOB_QUEUED
+            ).order_by("id").first()
+            if job is None:
+                return False
+            job.status = JOB_RUNNING
+            job.worker = cls.get_worker_name()
+            job.attempt += 1
+            job.save(update_fields=["status", "worker", "attempt", "is_updated_on"])
+        try:
+            import_string(job.task)(*json.loads(job.arguments), job=job)
+            job.status = JOB_DONE
+            job.error = EMPTY_STRING
+        except Exception as error:
+            logger.exception("Job %s failed at step %s", job.id, job.step_name)
+            job.status = JOB_FAILED
+            job.error = "{}".format(error)
+        job.save(update_fields=["status", "error", "is_updated_on"])
+        return True
+
+    def retry(self):
+        # Resume a failed job at the failed step
+        Job.objects.filter(id=self.id, status=JOB_FAILED).update(status=JOB_QUEUED)
+
+    def run_steps(self, steps):
+        # steps : [(step_name, callable), ...]. Skip the steps already done.
+        for i, (step_name, step) in enumerate(steps):
+            if i < self.step:
+                continue
+            self.step_name = step_name
+            self.save(update_fields=["step_name", "is_updated_on"])
+            step()
+            self.step = i + 1
+            self.save(update_fields=["step", "is_updated_on"])
+
+    class Meta:
+        verbose_name = _("Job")
+        verbose_name_plural = _("Jobs")
+
+    def __str__(self):
+        return "{} {}".format(self.task.split(".")[-1], self.get_status_display())
+
+
+def run_steps(steps, job=None):
+    # Run the steps of a task, checkpointed into the job if the task is run by a job
+    if job is not None:
+        job.run_steps(steps)
+    else:
+        for step_name, step in steps:
+            step()
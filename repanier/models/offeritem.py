@@ -17,10 +17,25 @@ from parler.models import TranslatedFields
 from repanier.apps import REPANIER_SETTINGS_PERMANENCE_NAME
 from repanier.const import *
 from repanier.fields.RepanierMoneyField import ModelMoneyField, RepanierMoney
+from repanier.ledger import invalidate_producer_ledger
 from repanier.models.invoice import ProducerInvoice
 from repanier.models.item import Item
+from repanier.search import FULL_TEXT_SEARCH
+from repanier.stock import calculate_stock_usage
 from repanier.tools import create_or_update_one_purchase
 
+if FULL_TEXT_SEARCH:
+    from django.contrib.postgres.indexes import GinIndex
+    from django.contrib.postgres.search import SearchVectorField
+
+    # Language dependant tsvector of search_text, see repanier.search
+    SEARCH_VECTOR_FIELDS = {
+        "search_vector": SearchVectorField(null=True, blank=True),
+        "meta": {"indexes": [GinIndex(fields=["search_vector"])]}
+    }
+else:
+    SEARCH_VECTOR_FIELDS = {}
+
 
 class OfferItem(Item):
     translations = TranslatedFields(
@@ -28,12 +43,17 @@ class OfferItem(Item):
                                    default=EMPTY_STRING, blank=True, null=True),
         cache_part_a=HTMLField(default=EMPTY_STRING, blank=True),
         cache_part_b=HTMLField(default=EMPTY_STRING, blank=True),
+        # Hash of the source fields of cache_part_a and cache_part_b, to only render them again when needed
+        cache_part_hash=models.CharField(max_length=32, default=EMPTY_STRING, blank=True),
         # Language dependant customer sort order for optimization
         order_sort_order=models.IntegerField(default=0, db_index=True),
         # Language dependant preparation sort order for optimization
         preparation_sort_order=models.IntegerField(default=0, db_index=True),
         # Language dependant producer sort order for optimization
-        producer_sort_order=models.IntegerField(default=0, db_index=True)
+        producer_sort_order=models.IntegerField(default=0, db_index=True),
+        # Language dependant search of the order form, see repanier.search
+        search_text=models.TextField(default=EMPTY_STRING, blank=True),
+        **SEARCH_VECTOR_FIELDS
     )
     permanence = models.ForeignKey(
         'Permanence',
@@ -118,23 +138,7 @@ class OfferItem(Item):
 
     def get_producer_qty_stock_invoiced(self):
         # Return quantity to buy to the producer and stock used to deliver the invoiced quantity
-        if self.quantity_invoiced > DECIMAL_ZERO:
-            if self.manage_replenishment:
-                # if RepanierSettings.producer_pre_opening then the stock is the max available qty by the producer,
-                # not into our stock
-                quantity_for_customer = self.quantity_invoiced - self.add_2_stock
-                if self.stock == DECIMAL_ZERO:
-                    return self.quantity_invoiced, DECIMAL_ZERO, quantity_for_customer
-                else:
-                    delta = (quantity_for_customer - self.stock).quantize(FOUR_DECIMALS)
-                    if delta <= DECIMAL_ZERO:
-                        # i.e. quantity_for_customer <= self.stock
-                        return self.add_2_stock, quantity_for_customer, quantity_for_customer
-                    else:
-                        return delta + self.add_2_stock, self.stock, quantity_for_customer
-            else:
-                return self.quantity_invoiced, DECIMAL_ZERO, self.quantity_invoiced
-        return DECIMAL_ZERO, DECIMAL_ZERO, DECIMAL_ZERO
+        return calculate_stock_usage(self.quantity_invoiced, self.add_2_stock, self.stock, self.manage_replenishment)
 
     def get_html_producer_qty_stock_invoiced(self):
         invoiced_qty, taken_from_stock, customer_qty = self.get_producer_qty_stock_invoiced()
@@ -191,9 +195,12 @@ class OfferItem(Item):
     get_html_producer_price_purchased.short_description = (_("Producer amount invoiced"))
     get_html_producer_price_purchased.admin_order_field = 'total_purchase_with_tax'
 
-    def get_html_like(self, user):
+    def get_html_like(self, user, is_liked=None):
+        # is_liked : known by the caller, e.g. from the liked products of the customer context
+        if is_liked is None:
+            is_liked = self.product.likes.filter(id=user.id).only("id").exists()
         return mark_safe("<span class=\"glyphicon glyphicon-heart{}\" onclick=\"like_ajax({});return false;\"></span>".format(
-            EMPTY_STRING if self.product.likes.filter(id=user.id).only("id").exists() else "-empty", self.id))
+            EMPTY_STRING if is_liked else "-empty", self.id))
 
     @cached_property
     def get_not_permanences_dates(self):
@@ -349,6 +356,7 @@ def offer_item_pre_save(sender, **kwargs):
                 total_price_with_tax=F('total_price_with_tax') +
                                      delta_producer_price
             )
+            invalidate_producer_ledger(offer_item.producer_id)
             offer_item.quantity_invoiced += delta_add_2_stock_invoiced
             offer_item.total_purchase_with_tax.amount += delta_producer_price
             # Do not do it twice
@@ -2,13 +2,13 @@
 
 import datetime
 import logging
+import time
 
 from dateutil.relativedelta import relativedelta
 from django.conf import settings
 from django.core import urlresolvers
-from django.core.cache import cache
 from django.db import models, transaction
-from django.db.models import F, Sum
+from django.db.models import F, Sum, Subquery, OuterRef, Prefetch
 from django.utils import timezone, translation
 from django.utils.functional import cached_property
 from django.utils.safestring import mark_safe
@@ -19,6 +19,9 @@ from parler.models import TranslatableModel, TranslatedFields, TranslationDoesNo
 
 logger = logging.getLogger(__name__)
 
+from repanier.cache import invalidate_cache, permanence_namespace, CACHE_VERSION_PAGE
+from repanier.ledger import invalidate_permanence_ledger, invalidate_all_ledgers
+from repanier.stock import record_stock_movements
 from repanier.const import *
 from repanier.fields.RepanierMoneyField import ModelMoneyField
 from repanier.models.bankaccount import BankAccount
@@ -30,9 +33,10 @@ from repanier.models.offeritem import OfferItem, OfferItemWoReceiver
 from repanier.models.permanenceboard import PermanenceBoard
 from repanier.models.producer import Producer
 from repanier.models.product import Product
+from repanier.models.stockmovement import StockMovement
 from repanier.picture.const import SIZE_L
 from repanier.picture.fields import AjaxPictureField
-from repanier.tools import cap, create_or_update_one_purchase
+from repanier.tools import cap, bulk_update
 
 refresh_status = [
     PERMANENCE_WAIT_FOR_PRE_OPEN,
@@ -44,6 +48,28 @@ refresh_status = [
 ]
 
 
+def get_producer_invoice_qs():
+    return ProducerInvoice.objects.select_related("producer").order_by("producer")
+
+
+def get_customer_invoice_qs():
+    return CustomerInvoice.objects.select_related(
+        "customer", "customer_charged", "delivery", "delivery__delivery_point"
+    ).prefetch_related(
+        "delivery__translations", "delivery__delivery_point__translations"
+    ).order_by("delivery", "customer")
+
+
+def get_permanence_board_qs():
+    return PermanenceBoard.objects.filter(
+        permanence_role__rght=F('permanence_role__lft') + 1
+    ).select_related(
+        "permanence_role", "customer"
+    ).prefetch_related(
+        "permanence_role__translations"
+    ).order_by("permanence_role__tree_id", "permanence_role__lft")
+
+
 class Permanence(TranslatableModel):
     translations = TranslatedFields(
         short_name=models.CharField(
@@ -141,6 +167,39 @@ class Permanence(TranslatableModel):
         default=0, editable=False
     )
 
+    # The invoices and the board of the permanences of an admin changelist page are prefetched,
+    # with a fixed number of queries, by prefetch_changelist.
+
+    @classmethod
+    def prefetch_changelist(cls, queryset):
+        return queryset.select_related(
+            "contract"
+        ).prefetch_related(
+            "producers",
+            "contract__producers",
+            Prefetch("producerinvoice_set", queryset=get_producer_invoice_qs(),
+                     to_attr="prefetched_producer_invoices"),
+            Prefetch("customerinvoice_set", queryset=get_customer_invoice_qs(),
+                     to_attr="prefetched_customer_invoices"),
+            Prefetch("permanenceboard_set", queryset=get_permanence_board_qs(),
+                     to_attr="prefetched_permanence_boards"),
+        )
+
+    def get_producer_invoices(self):
+        if hasattr(self, "prefetched_producer_invoices"):
+            return self.prefetched_producer_invoices
+        return get_producer_invoice_qs().filter(permanence_id=self.id)
+
+    def get_customer_invoices(self):
+        if hasattr(self, "prefetched_customer_invoices"):
+            return self.prefetched_customer_invoices
+        return get_customer_invoice_qs().filter(permanence_id=self.id)
+
+    def get_permanence_boards(self):
+        if hasattr(self, "prefetched_permanence_boards"):
+            return self.prefetched_permanence_boards
+        return get_permanence_board_qs().filter(permanence_id=self.id)
+
     @cached_property
     def get_producers(self):
         if self.status == PERMANENCE_PLANNED:
@@ -186,10 +245,9 @@ class Permanence(TranslatableModel):
                 link_unicode = "{} ".format(LINK_UNICODE)
             else:
                 link_unicode = EMPTY_STRING
-            for p in self.producers.all().only("id"):
-                pi = ProducerInvoice.objects.filter(
-                    producer_id=p.id, permanence_id=self.id
-                ).order_by('?').first()
+            producer_invoices = {pi.producer_id: pi for pi in self.get_producer_invoices()}
+            for p in self.producers.all():
+                pi = producer_invoices.get(p.id)
                 if pi is not None:
                     if pi.status == PERMANENCE_OPENED:
                         label = (
@@ -224,8 +282,7 @@ class Permanence(TranslatableModel):
             )
             link = []
             at_least_one_permanence_send = False
-            for pi in ProducerInvoice.objects.filter(permanence_id=self.id).select_related(
-                    "producer").order_by('producer'):
+            for pi in self.get_producer_invoices():
                 if pi.status == PERMANENCE_SEND:
                     at_least_one_permanence_send = True
                     if pi.producer.invoice_by_basket:
@@ -291,11 +348,9 @@ class Permanence(TranslatableModel):
                     self.id, _("Show"), _("Hide"), _("Show"), _("Show"), self.id, producers
                 )
         else:
-            msg_html = "<div class=\"wrap-text\">{}</div>".format(", ".join([p.short_profile_name
-                                                                             for p in
-                                                                             Producer.objects.filter(
-                                                                                 producerinvoice__permanence_id=self.id).only(
-                                                                                 'short_profile_name')]))
+            msg_html = "<div class=\"wrap-text\">{}</div>".format(", ".join([pi.producer.short_profile_name
+                                                                             for pi in
+                                                                             self.get_producer_invoices()]))
         return mark_safe(msg_html)
 
     get_producers.short_description = (_("Offers from"))
@@ -310,8 +365,7 @@ class Permanence(TranslatableModel):
             )
             link = []
             delivery_save = None
-            for ci in CustomerInvoice.objects.filter(permanence_id=self.id).select_related(
-                    "customer").order_by('delivery', 'customer'):
+            for ci in self.get_customer_invoices():
                 if delivery_save != ci.delivery:
                     delivery_save = ci.delivery
                     if ci.delivery is not None:
@@ -336,8 +390,7 @@ class Permanence(TranslatableModel):
         elif self.status in [PERMANENCE_INVOICED, PERMANENCE_ARCHIVED]:
             link = []
             delivery_save = None
-            for ci in CustomerInvoice.objects.filter(permanence_id=self.id).select_related(
-                    "customer").order_by('delivery', 'customer'):
+            for ci in self.get_customer_invoices():
                 if delivery_save != ci.delivery:
                     delivery_save = ci.delivery
                     if ci.delivery is not None:
@@ -363,10 +416,9 @@ class Permanence(TranslatableModel):
                 )
             customers = ", ".join(link)
         else:
-            customers = ", ".join([c.short_basket_name
-                                   for c in
-                                   Customer.objects.filter(customerinvoice__permanence_id=self.id).only(
-                                       'short_basket_name')])
+            customers = ", ".join([ci.customer.short_basket_name
+                                   for ci in
+                                   self.get_customer_invoices()])
         if len(customers) > 0:
             msg_html = """
                 <div class="wrap-text"><button
@@ -390,9 +442,7 @@ class Permanence(TranslatableModel):
 
     @cached_property
     def get_board(self):
-        permanenceboard_set = PermanenceBoard.objects.filter(
-            permanence=self, permanence_role__rght=F('permanence_role__lft') + 1
-        ).order_by("permanence_role__tree_id", "permanence_role__lft")
+        permanenceboard_set = self.get_permanence_boards()
         first_board = True
         board = EMPTY_STRING
         if permanenceboard_set:
@@ -461,6 +511,7 @@ class Permanence(TranslatableModel):
         ).first()
         if permanence is None:
             raise ValueError
+        previous_status = permanence.status
         if new_status == PERMANENCE_WAIT_FOR_OPEN:
             everything = True
             all_producers = self.contract.producers.all() if self.contract else self.producers.all()
@@ -544,8 +595,19 @@ class Permanence(TranslatableModel):
             #     self.save(update_fields=['status', 'is_updated_on', 'highest_status'])
         # Unlock
         permanence.save()
-        menu_pool.clear(all=True)
-        cache.clear()
+        # The amounts not yet invoiced depend on the status of the invoices
+        invalidate_permanence_ledger(self.id)
+        # Only invalidate what depends on this permanence, not the whole cache
+        invalidate_cache(permanence_namespace(self.id))
+        if everything and (
+                previous_status in PERMANENCE_STATUS_IN_MENU or new_status in PERMANENCE_STATUS_IN_MENU or
+                (previous_status <= PERMANENCE_WAIT_FOR_INVOICED) != (new_status <= PERMANENCE_WAIT_FOR_INVOICED)
+        ):
+            # The permanence menu (cms_menus.py) displays the opened, closed and send permanences
+            # and the task registration as long as permanences are not invoiced.
+            # The menu is into every cached page.
+            menu_pool.clear(all=True)
+            invalidate_cache(CACHE_VERSION_PAGE)
 
     @transaction.atomic
     def back_to_scheduled(self):
@@ -559,9 +621,23 @@ class Permanence(TranslatableModel):
 
     @transaction.atomic
     def close_order(self, everything, producers_id=(), deliveries_id=()):
+        # Set based : the technical purchases (membership fee, deposit, transport) are computed
+        # in a few queries and bulk created. The totals are reconciled once afterwards
+        # by recalculate_order_amount(send_to_producer=True) into task_order.close_and_send_order.
+        # Return the duration of each step.
         from repanier.apps import REPANIER_SETTINGS_MEMBERSHIP_FEE_DURATION, \
             REPANIER_SETTINGS_MEMBERSHIP_FEE
 
+        timings = []
+        step_start = time.time()
+
+        def end_of_step(step):
+            nonlocal step_start
+            now = time.time()
+            timings.append((step, now - step_start))
+            logger.info("close_order %s : %s - %.3fs", self.id, step, now - step_start)
+            step_start = now
+
         if settings.REPANIER_SETTINGS_CUSTOMER_MUST_CONFIRM_ORDER:
             # Cancel unconfirmed purchases whichever the producer is
             customer_invoice_qs = CustomerInvoice.objects.filter(
@@ -573,6 +649,7 @@ class Permanence(TranslatableModel):
                 customer_invoice_qs = customer_invoice_qs.filter(delivery_id__in=deliveries_id)
             for customer_invoice in customer_invoice_qs:
                 customer_invoice.cancel_if_unconfirmed(self)
+            end_of_step("cancel unconfirmed orders")
         if everything:
             # Add membership fee
             if REPANIER_SETTINGS_MEMBERSHIP_FEE_DURATION > 0 and REPANIER_SETTINGS_MEMBERSHIP_FEE > 0:
@@ -584,62 +661,58 @@ class Permanence(TranslatableModel):
                 # Update the prices
                 membership_fee_product.save()
 
-                customer_invoice_qs = CustomerInvoice.objects.filter(
-                    permanence_id=self.id,
-                    customer_charged_id=F('customer_id')
-                ).select_related("customer").order_by('?')
+                customer_filter = dict(
+                    customerinvoice__permanence_id=self.id,
+                    customerinvoice__customer_charged_id=F('id'),
+                    represent_this_buyinggroup=False,
+                    membership_fee_valid_until__lt=self.permanence_date
+                )
                 if self.with_delivery_point:
-                    customer_invoice_qs = customer_invoice_qs.filter(delivery_id__in=deliveries_id)
-
-                for customer_invoice in customer_invoice_qs:
-                    customer = customer_invoice.customer
-                    if not customer.represent_this_buyinggroup:
-                        # Should pay a membership fee
-                        if customer.membership_fee_valid_until < self.permanence_date:
-                            membership_fee_offer_item = membership_fee_product.get_or_create_offer_item(self)
-                            self.producers.add(membership_fee_offer_item.producer_id)
-                            create_or_update_one_purchase(
-                                customer.id,
-                                membership_fee_offer_item,
-                                q_order=1,
-                                batch_job=True,
-                                is_box_content=False
-                            )
-                            membership_fee_valid_until = customer.membership_fee_valid_until + relativedelta(
-                                months=int(REPANIER_SETTINGS_MEMBERSHIP_FEE_DURATION)
-                            )
-                            today = timezone.now().date()
-                            if membership_fee_valid_until < today:
-                                # For or occasional customer
-                                membership_fee_valid_until = today
-                            # customer.save(update_fields=['membership_fee_valid_until', ])
-                            # use vvvv because ^^^^^ will call "pre_save" function which reset valid_email to None
-                            Customer.objects.filter(id=customer.id).order_by('?').update(
-                                membership_fee_valid_until=membership_fee_valid_until
-                            )
+                    customer_filter["customerinvoice__delivery_id__in"] = deliveries_id
+                customers = list(Customer.objects.filter(**customer_filter).order_by('?'))
+                if len(customers) > 0:
+                    membership_fee_offer_item = membership_fee_product.get_or_create_offer_item(self)
+                    self.producers.add(membership_fee_offer_item.producer_id)
+                    self.bulk_create_or_update_purchases(
+                        [(customer, membership_fee_offer_item) for customer in customers],
+                        q_order=DECIMAL_ONE
+                    )
+                    today = timezone.now().date()
+                    membership_fee_valid_until = {}
+                    for customer in customers:
+                        valid_until = customer.membership_fee_valid_until + relativedelta(
+                            months=int(REPANIER_SETTINGS_MEMBERSHIP_FEE_DURATION)
+                        )
+                        if valid_until < today:
+                            # For or occasional customer
+                            valid_until = today
+                        membership_fee_valid_until[customer.id] = {"membership_fee_valid_until": valid_until}
+                    # Do not use customer.save() because it will call "pre_save" function which reset valid_email to None
+                    bulk_update(Customer, membership_fee_valid_until)
+            end_of_step("membership fee")
         if everything or self.with_delivery_point:
             # Add deposit products to be able to return them
-            customer_qs = Customer.objects.filter(
-                may_order=True,
-                customerinvoice__permanence_id=self.id,
-                represent_this_buyinggroup=False
+            offer_item_qs = OfferItem.objects.filter(
+                permanence_id=self.id,
+                order_unit=PRODUCT_ORDER_UNIT_DEPOSIT
             ).order_by('?')
-            if self.with_delivery_point:
-                customer_qs = customer_qs.filter(customerinvoice__delivery_id__in=deliveries_id)
-            for customer in customer_qs:
-                offer_item_qs = OfferItem.objects.filter(
-                    permanence_id=self.id,
-                    order_unit=PRODUCT_ORDER_UNIT_DEPOSIT
-                ).order_by('?')
-                if not everything:
-                    offer_item_qs = offer_item_qs.filter(producer_id__in=producers_id)
-                for offer_item in offer_item_qs:
-                    create_or_update_one_purchase(customer.id, offer_item, q_order=1,
-                                                  batch_job=True,
-                                                  is_box_content=False)
-                    create_or_update_one_purchase(customer.id, offer_item, q_order=0,
-                                                  batch_job=True,
-                                                  is_box_content=False)
+            if not everything:
+                offer_item_qs = offer_item_qs.filter(producer_id__in=producers_id)
+            offer_items = list(offer_item_qs)
+            if len(offer_items) > 0:
+                customer_filter = dict(
+                    may_order=True,
+                    customerinvoice__permanence_id=self.id,
+                    represent_this_buyinggroup=False
+                )
+                if self.with_delivery_point:
+                    customer_filter["customerinvoice__delivery_id__in"] = deliveries_id
+                customers = list(Customer.objects.filter(**customer_filter).order_by('?'))
+                self.bulk_create_or_update_purchases(
+                    [(customer, offer_item) for customer in customers for offer_item in offer_items],
+                    q_order=DECIMAL_ZERO
+                )
+            end_of_step("deposit")
         if everything or len(producers_id) > 0:
             # Round to multiple producer_order_by_quantity
             offer_item_qs = OfferItem.objects.filter(
@@ -661,6 +734,7 @@ class Permanence(TranslatableModel):
                     offer_item.add_2_stock = offer_item.producer_order_by_quantity - (
                             needed % offer_item.producer_order_by_quantity)
                     offer_item.save()
+            end_of_step("round to producer order by quantity")
             # Add Transport
             offer_item_qs = OfferItem.objects.filter(
                 permanence_id=self.id,
@@ -668,12 +742,171 @@ class Permanence(TranslatableModel):
             ).order_by('?')
             if not everything:
                 offer_item_qs = offer_item_qs.filter(producer_id__in=producers_id)
-            group_id = Customer.get_or_create_group().id
-            for offer_item in offer_item_qs:
-                create_or_update_one_purchase(
-                    group_id, offer_item, q_order=1,
-                    batch_job=True, is_box_content=False
+            offer_items = list(offer_item_qs)
+            if len(offer_items) > 0:
+                customer_buyinggroup = Customer.get_or_create_group()
+                self.bulk_create_or_update_purchases(
+                    [(customer_buyinggroup, offer_item) for offer_item in offer_items],
+                    q_order=DECIMAL_ONE
                 )
+            end_of_step("transport")
+        return timings
+
+    def bulk_create_or_update_purchases(self, customer_offer_items, q_order, status=PERMANENCE_OPENED,
+                                        quantities=None, comments=None):
+        # Set the quantity ordered to q_order for each (customer, offer_item) of customer_offer_items.
+        # Same result as create_or_update_one_purchase(..., batch_job=True) called for each pair,
+        # but the invoices and purchases are created in bulk.
+        # From PERMANENCE_SEND, the quantity invoiced is set instead of the quantity ordered.
+        # quantities and comments : {(customer_id, offer_item_id): value} to set them pair by pair.
+        # The purchase pre_save is not called : the totals must be recalculated afterwards.
+        from repanier.models.purchase import Purchase
+
+        if len(customer_offer_items) == 0:
+            return
+        quantity_field = "quantity_ordered" if status < PERMANENCE_SEND else "quantity_invoiced"
+        quantities = quantities or {}
+        comments = comments or {}
+        customers = {customer.id: customer for customer, offer_item in customer_offer_items}
+        offer_items = {offer_item.id: offer_item for customer, offer_item in customer_offer_items}
+
+        pairs = {(customer.id, offer_item.id) for customer, offer_item in customer_offer_items}
+        existing_purchases = {}
+        existing_comments = {}
+        for purchase_id, customer_id, offer_item_id, comment in Purchase.objects.filter(
+                permanence_id=self.id,
+                customer_id__in=customers.keys(),
+                offer_item_id__in=offer_items.keys(),
+                is_box_content=False
+        ).order_by('?').values_list(
+            "id", "customer_id", "offer_item_id", "comment"
+        ):
+            if (customer_id, offer_item_id) in pairs:
+                existing_purchases[(customer_id, offer_item_id)] = purchase_id
+                existing_comments[purchase_id] = comment
+        if len(existing_purchases) > 0:
+            if quantities or comments:
+                purchase_rows = {}
+                for pair, purchase_id in existing_purchases.items():
+                    purchase_rows[purchase_id] = {quantity_field: quantities.get(pair, q_order)}
+                    comment = comments.get(pair)
+                    if comment:
+                        # As Purchase.set_comment
+                        if existing_comments[purchase_id]:
+                            comment = "{}, {}".format(existing_comments[purchase_id], comment)
+                        purchase_rows[purchase_id]["comment"] = cap(comment, 100)
+                bulk_update(Purchase, purchase_rows)
+            else:
+                Purchase.objects.filter(
+                    id__in=existing_purchases.values()
+                ).order_by('?').update(
+                    **{quantity_field: q_order}
+                )
+        customer_offer_items = [
+            (customer, offer_item) for customer, offer_item in customer_offer_items
+            if (customer.id, offer_item.id) not in existing_purchases
+        ]
+        if len(customer_offer_items) == 0:
+            return
+
+        # Invoices needed by the new purchases
+        customer_invoice_ids = dict(CustomerInvoice.objects.filter(
+            permanence_id=self.id,
+            customer_id__in=customers.keys()
+        ).order_by('?').values_list(
+            "customer_id", "id"
+        ))
+        for customer_id in customers.keys():
+            if customer_id not in customer_invoice_ids:
+                customer_invoice = CustomerInvoice.objects.create(
+                    permanence_id=self.id,
+                    customer_id=customer_id,
+                    customer_charged_id=customer_id,
+                    status=status
+                )
+                customer_invoice.set_delivery(delivery=None)
+                customer_invoice.save()
+                customer_invoice_ids[customer_id] = customer_invoice.id
+
+        producer_ids = {offer_item.producer_id for offer_item in offer_items.values()}
+        producer_invoice_ids = dict(ProducerInvoice.objects.filter(
+            permanence_id=self.id,
+            producer_id__in=producer_ids
+        ).order_by('?').values_list(
+            "producer_id", "id"
+        ))
+        missing_producer_ids = producer_ids - set(producer_invoice_ids.keys())
+        if len(missing_producer_ids) > 0:
+            ProducerInvoice.objects.bulk_create([
+                ProducerInvoice(
+                    permanence_id=self.id,
+                    producer_id=producer_id,
+                    status=status
+                ) for producer_id in missing_producer_ids
+            ])
+            producer_invoice_ids = dict(ProducerInvoice.objects.filter(
+                permanence_id=self.id,
+                producer_id__in=producer_ids
+            ).order_by('?').values_list(
+                "producer_id", "id"
+            ))
+
+        customer_producer_ids = {
+            (customer.id, offer_item.producer_id) for customer, offer_item in customer_offer_items
+        }
+        customer_producer_invoice_ids = {
+            (customer_id, producer_id): customer_producer_invoice_id
+            for customer_id, producer_id, customer_producer_invoice_id in CustomerProducerInvoice.objects.filter(
+                permanence_id=self.id,
+                customer_id__in=customers.keys(),
+                producer_id__in=producer_ids
+            ).order_by('?').values_list(
+                "customer_id", "producer_id", "id"
+            )
+        }
+        missing_customer_producer_ids = customer_producer_ids - set(customer_producer_invoice_ids.keys())
+        if len(missing_customer_producer_ids) > 0:
+            CustomerProducerInvoice.objects.bulk_create([
+                CustomerProducerInvoice(
+                    permanence_id=self.id,
+                    customer_id=customer_id,
+                    producer_id=producer_id
+                ) for customer_id, producer_id in missing_customer_producer_ids
+            ])
+            customer_producer_invoice_ids = {
+                (customer_id, producer_id): customer_producer_invoice_id
+                for customer_id, producer_id, customer_producer_invoice_id in CustomerProducerInvoice.objects.filter(
+                    permanence_id=self.id,
+                    customer_id__in=customers.keys(),
+                    producer_id__in=producer_ids
+                ).order_by('?').values_list(
+                    "customer_id", "producer_id", "id"
+                )
+            }
+
+        purchases = []
+        for customer, offer_item in customer_offer_items:
+            pair = (customer.id, offer_item.id)
+            quantity = quantities.get(pair, q_order)
+            purchase = Purchase(
+                permanence_id=self.id,
+                offer_item=offer_item,
+                producer_id=offer_item.producer_id,
+                customer=customer,
+                customer_invoice_id=customer_invoice_ids[customer.id],
+                producer_invoice_id=producer_invoice_ids[offer_item.producer_id],
+                customer_producer_invoice_id=customer_producer_invoice_ids[(customer.id, offer_item.producer_id)],
+                quantity_ordered=quantity if status < PERMANENCE_SEND else DECIMAL_ZERO,
+                quantity_invoiced=quantity if status >= PERMANENCE_SEND else DECIMAL_ZERO,
+                is_box_content=False,
+                status=status,
+                comment=cap(comments.get(pair, EMPTY_STRING), 100)
+            )
+            offer_item_quantity, quantity = purchase.get_quantities()
+            purchase.calculate_row_price(quantity)
+            purchase.calculate_row_vat(quantity)
+            purchases.append(purchase)
+        Purchase.objects.bulk_create(purchases, batch_size=BULK_UPDATE_BATCH_SIZE)
 
     @transaction.atomic
     def invoice(self, payment_date):
@@ -774,58 +1007,137 @@ class Permanence(TranslatableModel):
 
             new_permanence.recalculate_order_amount(re_init=True)
 
+        # Calculate delta_price_with_tax, delta_vat and delta_transport of all the customer invoices in memory,
+        # then save them and the delta of the buying group at once
+        delivery_points = {
+            delivery_point.customer_responsible_id: delivery_point
+            for delivery_point in LUT_DeliveryPoint.objects.filter(
+                customer_responsible__isnull=False
+            ).order_by('?')
+        }
+        # The sums needed by calculate_delta_price and calculate_delta_transport, with three grouped aggregates
+        # {customer_charged_id: {None: sums of all the purchases, False: sums of the purchases wo fixed resale price}}
+        no_purchase = {"customer_vat__sum": None, "deposit__sum": None, "selling_price__sum": None}
+        purchase_totals = {}
+        for is_resale_price_fixed, purchase_qs in (
+                (None, PurchaseWoReceiver.objects.filter(permanence_id=self.id)),
+                (False, PurchaseWoReceiver.objects.filter(permanence_id=self.id, is_resale_price_fixed=False))
+        ):
+            # Note : .order_by() and not .order_by('?'), the random order would be added to the "group by"
+            for row in purchase_qs.order_by().values("customer_invoice__customer_charged_id").annotate(
+                    Sum('customer_vat'),
+                    Sum('deposit'),
+                    Sum('selling_price')
+            ):
+                purchase_totals.setdefault(
+                    row["customer_invoice__customer_charged_id"], {None: no_purchase, False: no_purchase}
+                )[is_resale_price_fixed] = row
+        children_totals = CustomerInvoice.objects.filter(
+            master_permanence_id=self.id
+        ).order_by('?').aggregate(
+            Sum('total_price_with_tax'),
+            Sum('delta_price_with_tax')
+        )
+        customer_invoice_rows = {}
+        buyinggroup_delta_price_with_tax = DECIMAL_ZERO
+        buyinggroup_delta_vat = DECIMAL_ZERO
+        buyinggroup_delta_transport = DECIMAL_ZERO
         for customer_invoice in CustomerInvoice.objects.filter(
                 permanence_id=self.id,
                 customer_id=F('customer_charged_id')
-        ).order_by('?'):
-            # Need to calculate delta_price_with_tax, delta_vat and delta_transport
+        ).select_related('customer').order_by('?'):
             # Important : A customer may only be responsible of one and only one delivery point
             if customer_invoice.is_group:
                 # Refresh in case of change in the admin
-                delivery_point = LUT_DeliveryPoint.objects.filter(
-                    customer_responsible=customer_invoice.customer).order_by(
-                    '?').first()
+                delivery_point = delivery_points.get(customer_invoice.customer_id)
                 if delivery_point is not None:
-                    customer_invoice.price_list_multiplier = delivery_point.customer_responsible.price_list_multiplier
+                    customer_invoice.price_list_multiplier = customer_invoice.customer.price_list_multiplier
                     customer_invoice.transport = delivery_point.transport
                     customer_invoice.min_transport = delivery_point.min_transport
-
-            customer_invoice.calculate_and_save_delta_buyinggroup()
-            customer_invoice.save()
+            previous_delta_price_with_tax = customer_invoice.delta_price_with_tax.amount
+            previous_delta_vat = customer_invoice.delta_vat.amount
+            previous_delta_transport = customer_invoice.delta_transport.amount
+            customer_invoice.calculate_delta_price(
+                purchase_totals=purchase_totals.get(
+                    customer_invoice.customer_id, {None: no_purchase, False: no_purchase}
+                )
+            )
+            customer_invoice.calculate_delta_transport(children_totals=children_totals)
+            buyinggroup_delta_price_with_tax += customer_invoice.delta_price_with_tax.amount - previous_delta_price_with_tax
+            buyinggroup_delta_vat += customer_invoice.delta_vat.amount - previous_delta_vat
+            buyinggroup_delta_transport += customer_invoice.delta_transport.amount - previous_delta_transport
+            customer_invoice_rows[customer_invoice.id] = {
+                'price_list_multiplier': customer_invoice.price_list_multiplier,
+                'transport': customer_invoice.transport,
+                'min_transport': customer_invoice.min_transport,
+                'delta_price_with_tax': customer_invoice.delta_price_with_tax,
+                'delta_vat': customer_invoice.delta_vat,
+                'delta_transport': customer_invoice.delta_transport,
+                'total_price_with_tax': customer_invoice.total_price_with_tax,
+                'total_vat': customer_invoice.total_vat,
+                'total_deposit': customer_invoice.total_deposit,
+            }
+        bulk_update(CustomerInvoice, customer_invoice_rows)
+        if buyinggroup_delta_price_with_tax != DECIMAL_ZERO or buyinggroup_delta_vat != DECIMAL_ZERO \
+                or buyinggroup_delta_transport != DECIMAL_ZERO:
+            if not ProducerInvoice.objects.filter(
+                    producer_id=producer_buyinggroup.id,
+                    permanence_id=self.id
+            ).order_by('?').update(
+                delta_price_with_tax=F('delta_price_with_tax') + buyinggroup_delta_price_with_tax,
+                delta_vat=F('delta_vat') + buyinggroup_delta_vat,
+                delta_transport=F('delta_transport') + buyinggroup_delta_transport
+            ):
+                ProducerInvoice.objects.create(
+                    producer_id=producer_buyinggroup.id,
+                    permanence_id=self.id,
+                    status=self.status,
+                    delta_price_with_tax=buyinggroup_delta_price_with_tax,
+                    delta_vat=buyinggroup_delta_vat,
+                    delta_transport=buyinggroup_delta_transport
+                )
 
         self.recalculate_profit()
         self.save()
 
+        customer_invoice_rows = {}
+        customer_rows = {}
         for customer_invoice in CustomerInvoice.objects.filter(
                 permanence_id=self.id
-        ):
-            customer_invoice.balance = customer_invoice.previous_balance = customer_invoice.customer.balance
-            customer_invoice.date_previous_balance = customer_invoice.customer.date_balance
-            customer_invoice.date_balance = payment_date
-
+        ).select_related('customer').order_by('?'):
+            customer = customer_invoice.customer
+            customer_invoice_row = {
+                'previous_balance': customer.balance,
+                'date_previous_balance': customer.date_balance,
+                'date_balance': payment_date
+            }
             if customer_invoice.customer_id == customer_invoice.customer_charged_id:
                 # ajuster sa balance
                 # il a droit aux réductions
                 total_price_with_tax = customer_invoice.get_total_price_with_tax().amount
-                customer_invoice.balance.amount -= total_price_with_tax
-                Customer.objects.filter(
-                    id=customer_invoice.customer_id
-                ).update(
-                    date_balance=payment_date,
-                    balance=F('balance') - total_price_with_tax
-                )
+                customer_invoice_row['balance'] = customer.balance.amount - total_price_with_tax
+                customer_rows[customer.id] = {
+                    'date_balance': payment_date,
+                    'balance': F('balance') - total_price_with_tax
+                }
             else:
                 # ne pas modifier sa balance
                 # ajuster la balance de celui qui paye
                 # celui qui paye a droit aux réductions
-                Customer.objects.filter(
-                    id=customer_invoice.customer_id
-                ).update(
-                    date_balance=payment_date,
-                )
-            customer_invoice.save()
+                customer_invoice_row['balance'] = customer.balance
+                customer_rows[customer.id] = {
+                    'date_balance': payment_date
+                }
+            customer_invoice_rows[customer_invoice.id] = customer_invoice_row
+        bulk_update(CustomerInvoice, customer_invoice_rows)
+        # use bulk_update because save() will call "pre_save" function which reset valid_email to None
+        bulk_update(Customer, customer_rows)
 
         # Claculate new stock
+        # producer_id -> [delta_stock_with_tax, delta_stock_vat, delta_stock_deposit]
+        producer_delta_stock = {}
+        offer_item_rows = {}
+        stock_movements = []
         for offer_item in OfferItem.objects.filter(
                 is_active=True, manage_replenishment=True, permanence_id=self.id
         ).order_by('?'):
@@ -841,50 +1153,67 @@ class Permanence(TranslatableModel):
                                          offer_item.unit_deposit.amount) * taken_from_stock).quantize(TWO_DECIMALS)
                 delta_vat = unit_vat * taken_from_stock
                 delta_deposit = offer_item.unit_deposit.amount * taken_from_stock
-                producer_invoice = ProducerInvoice.objects.get(
-                    producer_id=offer_item.producer_id,
-                    permanence_id=self.id,
+                delta_stock = producer_delta_stock.setdefault(
+                    offer_item.producer_id, [DECIMAL_ZERO, DECIMAL_ZERO, DECIMAL_ZERO]
                 )
-                producer_invoice.delta_stock_with_tax.amount -= delta_price_with_tax
-                producer_invoice.delta_stock_vat.amount -= delta_vat
-                producer_invoice.delta_stock_deposit.amount -= delta_deposit
-                producer_invoice.save(update_fields=[
-                    'delta_stock_with_tax',
-                    'delta_stock_vat',
-                    'delta_stock_deposit'
-                ])
+                delta_stock[0] += delta_price_with_tax
+                delta_stock[1] += delta_vat
+                delta_stock[2] += delta_deposit
 
             # Update new_stock even if no order
             # // xslx_stock and task_invoice
-            offer_item.new_stock = offer_item.stock - taken_from_stock + offer_item.add_2_stock
-            if offer_item.new_stock < DECIMAL_ZERO:
-                offer_item.new_stock = DECIMAL_ZERO
-            offer_item.previous_add_2_stock = offer_item.add_2_stock
-            offer_item.previous_producer_unit_price = offer_item.producer_unit_price
-            offer_item.previous_unit_deposit = offer_item.unit_deposit
-            if self.highest_status <= PERMANENCE_SEND:
+            new_stock = offer_item.stock - taken_from_stock + offer_item.add_2_stock
+            if new_stock < DECIMAL_ZERO:
+                new_stock = DECIMAL_ZERO
+            offer_item_rows[offer_item.id] = {'new_stock': new_stock}
+            if self.highest_status <= PERMANENCE_SEND and offer_item.product_id is not None:
                 # Asked by Bees-Coop : Do not update stock when canceling
-                new_stock = offer_item.stock if offer_item.stock > DECIMAL_ZERO else DECIMAL_ZERO
-                Product.objects.filter(
-                    id=offer_item.product_id, stock=new_stock
-                ).update(stock=offer_item.new_stock)
-            offer_item.save()
+                # The movements are added to the current stock of the product,
+                # even if it has been changed since the offer item was created
+                stock_movements.append(StockMovement(
+                    product_id=offer_item.product_id,
+                    permanence_id=self.id,
+                    offer_item_id=offer_item.id,
+                    movement=STOCK_MOVEMENT_TAKEN,
+                    quantity=-taken_from_stock
+                ))
+                stock_movements.append(StockMovement(
+                    product_id=offer_item.product_id,
+                    permanence_id=self.id,
+                    offer_item_id=offer_item.id,
+                    movement=STOCK_MOVEMENT_ADDED,
+                    quantity=offer_item.add_2_stock
+                ))
+        bulk_update(OfferItem, offer_item_rows)
+        record_stock_movements(stock_movements)
 
+        producer_invoice_rows = {}
+        producer_rows = {}
         for producer_invoice in ProducerInvoice.objects.filter(
-                permanence_id=self.id):
-            producer_invoice.balance = producer_invoice.previous_balance = producer_invoice.producer.balance
-            producer_invoice.date_previous_balance = producer_invoice.producer.date_balance
-            producer_invoice.date_balance = payment_date
+                permanence_id=self.id
+        ).select_related('producer').order_by('?'):
+            producer = producer_invoice.producer
+            delta_stock = producer_delta_stock.get(producer_invoice.producer_id)
+            if delta_stock is not None:
+                producer_invoice.delta_stock_with_tax.amount -= delta_stock[0]
+                producer_invoice.delta_stock_vat.amount -= delta_stock[1]
+                producer_invoice.delta_stock_deposit.amount -= delta_stock[2]
             total_price_with_tax = producer_invoice.get_total_price_with_tax().amount
-            producer_invoice.balance.amount += total_price_with_tax
-            producer_invoice.save()
-            Producer.objects.filter(
-                id=producer_invoice.producer_id
-            ).update(
-                date_balance=payment_date,
-                balance=F('balance') + total_price_with_tax
-            )
-            producer_invoice.save()
+            producer_invoice_rows[producer_invoice.id] = {
+                'delta_stock_with_tax': producer_invoice.delta_stock_with_tax,
+                'delta_stock_vat': producer_invoice.delta_stock_vat,
+                'delta_stock_deposit': producer_invoice.delta_stock_deposit,
+                'previous_balance': producer.balance,
+                'date_previous_balance': producer.date_balance,
+                'balance': producer.balance.amount + total_price_with_tax,
+                'date_balance': payment_date
+            }
+            producer_rows[producer.id] = {
+                'date_balance': payment_date,
+                'balance': F('balance') + total_price_with_tax
+            }
+        bulk_update(ProducerInvoice, producer_invoice_rows)
+        bulk_update(Producer, producer_rows)
 
         result_set = PurchaseWoReceiver.objects.filter(
             permanence_id=self.id,
@@ -918,8 +1247,10 @@ class Permanence(TranslatableModel):
 
         purchases_delta_price_wo_tax = purchases_delta_price_with_tax - purchases_delta_vat
 
+        # The profit, the VAT and the shipping entries are created at once
+        bank_accounts = []
         if purchases_delta_price_wo_tax != DECIMAL_ZERO:
-            BankAccount.objects.create(
+            bank_accounts.append(BankAccount(
                 permanence_id=self.id,
                 producer=None,
                 customer_id=customer_buyinggroup.id,
@@ -930,9 +1261,9 @@ class Permanence(TranslatableModel):
                 bank_amount_in=purchases_delta_price_wo_tax if purchases_delta_price_wo_tax > DECIMAL_ZERO else DECIMAL_ZERO,
                 customer_invoice_id=None,
                 producer_invoice=None
-            )
+            ))
         if purchases_delta_vat != DECIMAL_ZERO:
-            BankAccount.objects.create(
+            bank_accounts.append(BankAccount(
                 permanence_id=self.id,
                 producer=None,
                 customer_id=customer_buyinggroup.id,
@@ -944,31 +1275,32 @@ class Permanence(TranslatableModel):
                 bank_amount_in=purchases_delta_vat if purchases_delta_vat > DECIMAL_ZERO else DECIMAL_ZERO,
                 customer_invoice_id=None,
                 producer_invoice=None
-            )
+            ))
 
-        for customer_invoice in CustomerInvoice.objects.filter(
+        # --> These bank movements are not real entries
+        # customer_invoice_id=customer_invoice_buyinggroup.id
+        # making this, they will not be counted into the customer_buyinggroup movements twice
+        # because Repanier will see they have already been counted into the customer_buyinggroup movements
+        bank_accounts.extend(
+            BankAccount(
                 permanence_id=self.id,
-        ).exclude(
-            customer_id=customer_buyinggroup.id,
-            delta_transport=DECIMAL_ZERO
-        ):
-            if customer_invoice.delta_transport != DECIMAL_ZERO:
-                # --> This bank movement is not a real entry
-                # customer_invoice_id=customer_invoice_buyinggroup.id
-                # making this, it will not be counted into the customer_buyinggroup movements twice
-                # because Repanier will see it has already been counted into the customer_buyinggroup movements
-                BankAccount.objects.create(
-                    permanence_id=self.id,
-                    producer=None,
-                    customer_id=customer_buyinggroup.id,
-                    operation_date=payment_date,
-                    operation_status=BANK_PROFIT,
-                    operation_comment="{} : {}".format(_("Shipping"), customer_invoice.customer.short_basket_name),
-                    bank_amount_in=customer_invoice.delta_transport,
-                    bank_amount_out=DECIMAL_ZERO,
-                    customer_invoice_id=customer_invoice_buyinggroup.id,
-                    producer_invoice=None
-                )
+                producer=None,
+                customer_id=customer_buyinggroup.id,
+                operation_date=payment_date,
+                operation_status=BANK_PROFIT,
+                operation_comment="{} : {}".format(_("Shipping"), customer_invoice.customer.short_basket_name),
+                bank_amount_in=customer_invoice.delta_transport,
+                bank_amount_out=DECIMAL_ZERO,
+                customer_invoice_id=customer_invoice_buyinggroup.id,
+                producer_invoice=None
+            ) for customer_invoice in CustomerInvoice.objects.filter(
+                permanence_id=self.id,
+            ).exclude(
+                customer_id=customer_buyinggroup.id,
+                delta_transport=DECIMAL_ZERO
+            ).select_related('customer').order_by('?') if customer_invoice.delta_transport != DECIMAL_ZERO
+        )
+        BankAccount.objects.bulk_create(bank_accounts, batch_size=BULK_UPDATE_BATCH_SIZE)
 
         # generate bank account movements
         self.generate_bank_account_movement(
@@ -978,111 +1310,181 @@ class Permanence(TranslatableModel):
         new_bank_latest_total = old_bank_latest_total
 
         # Calculate new current balance : Bank
-        for bank_account in BankAccount.objects.select_for_update().filter(
-
+        # --> The profit and tax bank movements are not real entries
+        # They will not be counted into the customer_buyinggroup bank movements twice
+        bank_account_ids = []
+        bank_amount = DECIMAL_ZERO
+        for bank_account_id, bank_amount_in, bank_amount_out in BankAccount.objects.select_for_update().filter(
                 customer_invoice__isnull=True,
                 producer_invoice__isnull=True,
                 operation_status__in=[BANK_PROFIT, BANK_TAX],
                 customer_id=customer_buyinggroup.id,
                 operation_date__lte=payment_date
-        ).order_by('?'):
-            # --> This bank movement is not a real entry
-            # It will not be counted into the customer_buyinggroup bank movements twice
+        ).order_by('?').values_list('id', 'bank_amount_in', 'bank_amount_out'):
+            bank_account_ids.append(bank_account_id)
+            bank_amount += bank_amount_in - bank_amount_out
+        if bank_account_ids:
             Customer.objects.filter(
-                id=bank_account.customer_id
-            ).update(
+                id=customer_buyinggroup.id
+            ).order_by('?').update(
                 date_balance=payment_date,
-                balance=F('balance') + bank_account.bank_amount_in.amount - bank_account.bank_amount_out.amount
+                balance=F('balance') + bank_amount
             )
             CustomerInvoice.objects.filter(
-                customer_id=bank_account.customer_id,
+                customer_id=customer_buyinggroup.id,
                 permanence_id=self.id,
-            ).update(
+            ).order_by('?').update(
                 date_balance=payment_date,
-                balance=F('balance') + bank_account.bank_amount_in.amount - bank_account.bank_amount_out.amount
+                balance=F('balance') + bank_amount
+            )
+            BankAccount.objects.filter(
+                id__in=bank_account_ids
+            ).order_by('?').update(
+                customer_invoice_id=customer_invoice_buyinggroup.id
             )
-            bank_account.customer_invoice_id = customer_invoice_buyinggroup.id
-            bank_account.save(update_fields=['customer_invoice'])
-
-        for bank_account in BankAccount.objects.select_for_update().filter(
-                customer_invoice__isnull=True,
-                producer_invoice__isnull=True,
-                customer__isnull=False,
-                operation_date__lte=payment_date).order_by('?'):
 
-            customer_invoice = CustomerInvoice.objects.filter(
-                customer_id=bank_account.customer_id,
-                permanence_id=self.id,
-            ).order_by('?').first()
-            if customer_invoice is None:
-                customer_invoice = CustomerInvoice.objects.create(
-                    customer_id=bank_account.customer_id,
+        # The bank movements of the customers, then of the producers, grouped by customer / producer
+        bank_accounts = list(BankAccount.objects.select_for_update().filter(
+            customer_invoice__isnull=True,
+            producer_invoice__isnull=True,
+            customer__isnull=False,
+            operation_date__lte=payment_date
+        ).order_by('?').values_list('id', 'customer_id', 'bank_amount_in', 'bank_amount_out'))
+        if bank_accounts:
+            customer_ids = set(customer_id for _id, customer_id, _in, _out in bank_accounts)
+            customer_invoices = {
+                customer_invoice.customer_id: customer_invoice
+                for customer_invoice in CustomerInvoice.objects.filter(
+                    customer_id__in=customer_ids,
                     permanence_id=self.id,
-                    date_previous_balance=bank_account.customer.date_balance,
-                    previous_balance=bank_account.customer.balance,
+                ).order_by('?')
+            }
+            CustomerInvoice.objects.bulk_create([
+                CustomerInvoice(
+                    customer_id=customer.id,
+                    permanence_id=self.id,
+                    date_previous_balance=customer.date_balance,
+                    previous_balance=customer.balance,
                     date_balance=payment_date,
-                    balance=bank_account.customer.balance,
-                    customer_charged_id=bank_account.customer_id,
+                    balance=customer.balance,
+                    customer_charged_id=customer.id,
                     transport=REPANIER_SETTINGS_TRANSPORT,
                     min_transport=REPANIER_SETTINGS_MIN_TRANSPORT
+                ) for customer in Customer.objects.filter(
+                    id__in=customer_ids - set(customer_invoices)
+                ).order_by('?')
+            ], batch_size=BULK_UPDATE_BATCH_SIZE)
+            customer_invoices = {
+                customer_invoice.customer_id: customer_invoice
+                for customer_invoice in CustomerInvoice.objects.filter(
+                    customer_id__in=customer_ids,
+                    permanence_id=self.id,
+                ).order_by('?')
+            }
+            customer_deltas = {}
+            for _id, customer_id, bank_amount_in, bank_amount_out in bank_accounts:
+                new_bank_latest_total += bank_amount_in - bank_amount_out
+                customer_invoice = customer_invoices[customer_id]
+                customer_invoice.bank_amount_in.amount += bank_amount_in
+                customer_invoice.bank_amount_out.amount += bank_amount_out
+                customer_invoice.balance.amount += (bank_amount_in - bank_amount_out)
+                customer_deltas[customer_id] = customer_deltas.get(customer_id, DECIMAL_ZERO) + \
+                    bank_amount_in - bank_amount_out
+            bulk_update(CustomerInvoice, {
+                customer_invoices[customer_id].id: {
+                    'date_balance': payment_date,
+                    'bank_amount_in': customer_invoices[customer_id].bank_amount_in,
+                    'bank_amount_out': customer_invoices[customer_id].bank_amount_out,
+                    'balance': customer_invoices[customer_id].balance,
+                } for customer_id in customer_deltas
+            })
+            # use bulk_update because save() will call "pre_save" function which reset valid_email to None
+            bulk_update(Customer, {
+                customer_id: {
+                    'date_balance': payment_date,
+                    'balance': F('balance') + delta
+                } for customer_id, delta in customer_deltas.items()
+            })
+            BankAccount.objects.filter(
+                id__in=[bank_account_id for bank_account_id, _customer_id, _in, _out in bank_accounts]
+            ).order_by('?').update(
+                permanence_id=self.id,
+                customer_invoice_id=Subquery(
+                    CustomerInvoice.objects.filter(
+                        customer_id=OuterRef('customer_id'),
+                        permanence_id=self.id
+                    ).order_by('?').values('id')[:1]
                 )
-            bank_amount_in = bank_account.bank_amount_in.amount
-            new_bank_latest_total += bank_amount_in
-            bank_amount_out = bank_account.bank_amount_out.amount
-            new_bank_latest_total -= bank_amount_out
-            customer_invoice.date_balance = payment_date
-            customer_invoice.bank_amount_in.amount += bank_amount_in
-            customer_invoice.bank_amount_out.amount += bank_amount_out
-            customer_invoice.balance.amount += (bank_amount_in - bank_amount_out)
-
-            customer_invoice.save()
-            Customer.objects.filter(
-                id=bank_account.customer_id
-            ).update(
-                date_balance=payment_date,
-                balance=F('balance') + bank_amount_in - bank_amount_out
             )
-            bank_account.customer_invoice_id = customer_invoice.id
-            bank_account.permanence_id = self.id
-            bank_account.save()
-
-        for bank_account in BankAccount.objects.select_for_update().filter(
-                customer_invoice__isnull=True,
-                producer_invoice__isnull=True,
-                producer__isnull=False,
-                operation_date__lte=payment_date).order_by('?'):
 
-            producer_invoice = ProducerInvoice.objects.filter(
-                producer_id=bank_account.producer_id,
-                permanence_id=self.id,
-            ).order_by('?').first()
-            if producer_invoice is None:
-                producer_invoice = ProducerInvoice.objects.create(
-                    producer=bank_account.producer,
+        bank_accounts = list(BankAccount.objects.select_for_update().filter(
+            customer_invoice__isnull=True,
+            producer_invoice__isnull=True,
+            producer__isnull=False,
+            operation_date__lte=payment_date
+        ).order_by('?').values_list('id', 'producer_id', 'bank_amount_in', 'bank_amount_out'))
+        if bank_accounts:
+            producer_ids = set(producer_id for _id, producer_id, _in, _out in bank_accounts)
+            producer_invoices = {
+                producer_invoice.producer_id: producer_invoice
+                for producer_invoice in ProducerInvoice.objects.filter(
+                    producer_id__in=producer_ids,
                     permanence_id=self.id,
-                    date_previous_balance=bank_account.producer.date_balance,
-                    previous_balance=bank_account.producer.balance,
+                ).order_by('?')
+            }
+            ProducerInvoice.objects.bulk_create([
+                ProducerInvoice(
+                    producer_id=producer.id,
+                    permanence_id=self.id,
+                    date_previous_balance=producer.date_balance,
+                    previous_balance=producer.balance,
                     date_balance=payment_date,
-                    balance=bank_account.producer.balance
+                    balance=producer.balance
+                ) for producer in Producer.objects.filter(
+                    id__in=producer_ids - set(producer_invoices)
+                ).order_by('?')
+            ], batch_size=BULK_UPDATE_BATCH_SIZE)
+            producer_invoices = {
+                producer_invoice.producer_id: producer_invoice
+                for producer_invoice in ProducerInvoice.objects.filter(
+                    producer_id__in=producer_ids,
+                    permanence_id=self.id,
+                ).order_by('?')
+            }
+            producer_deltas = {}
+            for _id, producer_id, bank_amount_in, bank_amount_out in bank_accounts:
+                new_bank_latest_total += bank_amount_in - bank_amount_out
+                producer_invoice = producer_invoices[producer_id]
+                producer_invoice.bank_amount_in.amount += bank_amount_in
+                producer_invoice.bank_amount_out.amount += bank_amount_out
+                producer_invoice.balance.amount += (bank_amount_in - bank_amount_out)
+                producer_deltas[producer_id] = producer_deltas.get(producer_id, DECIMAL_ZERO) + \
+                    bank_amount_in - bank_amount_out
+            bulk_update(ProducerInvoice, {
+                producer_invoices[producer_id].id: {
+                    'date_balance': payment_date,
+                    'bank_amount_in': producer_invoices[producer_id].bank_amount_in,
+                    'bank_amount_out': producer_invoices[producer_id].bank_amount_out,
+                    'balance': producer_invoices[producer_id].balance,
+                } for producer_id in producer_deltas
+            })
+            bulk_update(Producer, {
+                producer_id: {
+                    'date_balance': payment_date,
+                    'balance': F('balance') + delta
+                } for producer_id, delta in producer_deltas.items()
+            })
+            BankAccount.objects.filter(
+                id__in=[bank_account_id for bank_account_id, _producer_id, _in, _out in bank_accounts]
+            ).order_by('?').update(
+                permanence_id=self.id,
+                producer_invoice_id=Subquery(
+                    ProducerInvoice.objects.filter(
+                        producer_id=OuterRef('producer_id'),
+                        permanence_id=self.id
+                    ).order_by('?').values('id')[:1]
                 )
-            bank_amount_in = bank_account.bank_amount_in.amount
-            new_bank_latest_total += bank_amount_in
-            bank_amount_out = bank_account.bank_amount_out.amount
-            new_bank_latest_total -= bank_amount_out
-            producer_invoice.date_balance = payment_date
-            producer_invoice.bank_amount_in.amount += bank_amount_in
-            producer_invoice.bank_amount_out.amount += bank_amount_out
-            producer_invoice.balance.amount += (bank_amount_in - bank_amount_out)
-            producer_invoice.save()
-            Producer.objects.filter(
-                id=bank_account.producer_id
-            ).update(
-                date_balance=payment_date,
-                balance=F('balance') + bank_amount_in - bank_amount_out
             )
-            bank_account.permanence_id = self.id
-            bank_account.producer_invoice_id = producer_invoice.id
-            bank_account.save()
 
         BankAccount.objects.filter(
             operation_status=BANK_LATEST_TOTAL
@@ -1113,6 +1515,8 @@ class Permanence(TranslatableModel):
             id=self.id
         ).update(invoice_sort_order=bank_account.id)
 
+        # The bank movements of everybody are now invoiced
+        invalidate_all_ledgers()
         new_status = PERMANENCE_INVOICED if settings.REPANIER_SETTINGS_MANAGE_ACCOUNTING else PERMANENCE_ARCHIVED
         self.set_status(old_status=(PERMANENCE_WAIT_FOR_INVOICED,), new_status=new_status,
                         update_payment_date=True, payment_date=payment_date)
@@ -1212,6 +1616,7 @@ class Permanence(TranslatableModel):
         Permanence.objects.filter(
             id=self.id
         ).update(invoice_sort_order=None)
+        invalidate_all_ledgers()
         self.set_status(old_status=(PERMANENCE_WAIT_FOR_CANCEL_INVOICE,), new_status=PERMANENCE_SEND)
 
     @transaction.atomic
@@ -1300,6 +1705,9 @@ class Permanence(TranslatableModel):
 
         from repanier.apps import REPANIER_SETTINGS_GROUP_NAME
 
+        # The bank movements are created at once. Each producer only reads its own bank movements.
+        bank_accounts = []
+        customer_buyinggroup = Customer.get_or_create_group()
         for producer_invoice in ProducerInvoice.objects.filter(
                 permanence_id=self.id,
                 invoice_sort_order__isnull=True,
@@ -1355,7 +1763,7 @@ class Permanence(TranslatableModel):
                                                             settings.DJANGO_SETTINGS_DATE)
                                                     }
 
-                    BankAccount.objects.create(
+                    bank_accounts.append(BankAccount(
                         permanence_id=None,
                         producer_id=producer.id,
                         customer=None,
@@ -1365,17 +1773,16 @@ class Permanence(TranslatableModel):
                         bank_amount_out=delta,
                         customer_invoice=None,
                         producer_invoice=None
-                    )
+                    ))
 
             delta = (producer.balance.amount - producer_invoice.to_be_invoiced_balance.amount).quantize(TWO_DECIMALS)
             if delta != DECIMAL_ZERO:
                 # Profit or loss for the group
-                customer_buyinggroup = Customer.get_or_create_group()
                 operation_comment = _("Correction %(producer)s") \
                                     % {
                                         'producer': producer.short_profile_name
                                     }
-                BankAccount.objects.create(
+                bank_accounts.append(BankAccount(
                     permanence_id=self.id,
                     producer=None,
                     customer_id=customer_buyinggroup.id,
@@ -1386,11 +1793,12 @@ class Permanence(TranslatableModel):
                     bank_amount_out=-delta if delta < DECIMAL_ZERO else DECIMAL_ZERO,
                     customer_invoice_id=None,
                     producer_invoice=None
-                )
+                ))
             producer_invoice.balance.amount -= delta
             producer_invoice.save(update_fields=['balance'])
             producer.balance.amount -= delta
             producer.save(update_fields=['balance'])
+        BankAccount.objects.bulk_create(bank_accounts, batch_size=BULK_UPDATE_BATCH_SIZE)
 
         return
 
@@ -1469,36 +1877,24 @@ class Permanence(TranslatableModel):
                 offer_item.previous_add_2_stock = DECIMAL_ZERO
                 offer_item.save()
 
-        if offer_item_qs is not None:
-            purchase_set = Purchase.objects \
-                .filter(permanence_id=self.id, offer_item__in=offer_item_qs) \
-                .order_by('?')
+            self.recalculate_order_amount_in_batch(send_to_producer=send_to_producer)
         else:
-            purchase_set = Purchase.objects \
-                .filter(permanence_id=self.id) \
-                .order_by('?')
-
-        for a_purchase in purchase_set.select_related("offer_item", "customer_invoice"):
-            # Recalculate the total_price_with_tax of ProducerInvoice,
-            # the total_price_with_tax of CustomerInvoice,
-            # the total_purchase_with_tax + total_selling_with_tax of CustomerProducerInvoice,
-            # and quantity_invoiced + total_purchase_with_tax + total_selling_with_tax of OfferItem
-            if send_to_producer or re_init:
-                a_purchase.previous_quantity_ordered = DECIMAL_ZERO
-                a_purchase.previous_quantity_invoiced = DECIMAL_ZERO
-                a_purchase.previous_purchase_price = DECIMAL_ZERO
-                a_purchase.previous_selling_price = DECIMAL_ZERO
-                a_purchase.previous_producer_vat = DECIMAL_ZERO
-                a_purchase.previous_customer_vat = DECIMAL_ZERO
-                a_purchase.previous_deposit = DECIMAL_ZERO
-                if send_to_producer and a_purchase.status == PERMANENCE_WAIT_FOR_SEND:
-                    offer_item = a_purchase.offer_item
-                    if offer_item.order_unit == PRODUCT_ORDER_UNIT_PC_KG:
-                        a_purchase.quantity_invoiced = (a_purchase.quantity_ordered * offer_item.order_average_weight) \
-                            .quantize(FOUR_DECIMALS)
-                    else:
-                        a_purchase.quantity_invoiced = a_purchase.quantity_ordered
-            a_purchase.save()
+            # Interactive path : rely on purchase_pre_save to propagate the delta
+            if offer_item_qs is not None:
+                purchase_set = Purchase.objects \
+                    .filter(permanence_id=self.id, offer_item__in=offer_item_qs) \
+                    .order_by('?')
+            else:
+                purchase_set = Purchase.objects \
+                    .filter(permanence_id=self.id) \
+                    .order_by('?')
+
+            for a_purchase in purchase_set.select_related("offer_item", "customer_invoice"):
+                # Recalculate the total_price_with_tax of ProducerInvoice,
+                # the total_price_with_tax of CustomerInvoice,
+                # the total_purchase_with_tax + total_selling_with_tax of CustomerProducerInvoice,
+                # and quantity_invoiced + total_purchase_with_tax + total_selling_with_tax of OfferItem
+                a_purchase.save()
 
         if send_to_producer:
             OfferItemWoReceiver.objects.filter(
@@ -1509,6 +1905,148 @@ class Permanence(TranslatableModel):
             )
         self.save()
 
+    @transaction.atomic
+    def recalculate_order_amount_in_batch(self, send_to_producer=False):
+        # Recalculate all the purchases of the permanence in memory, then save them and
+        # the totals of OfferItem, CustomerInvoice, CustomerProducerInvoice, ProducerInvoice and Permanence
+        # with one bulk update per table instead of going through purchase_pre_save for each purchase.
+        # Important : the totals must have been reset before calling this.
+        from repanier.models.purchase import Purchase
+
+        offer_item_total = {}
+        for offer_item_id, quantity_invoiced, total_purchase_with_tax in OfferItemWoReceiver.objects.filter(
+                permanence_id=self.id
+        ).exclude(
+            quantity_invoiced=DECIMAL_ZERO,
+            total_purchase_with_tax=DECIMAL_ZERO
+        ).order_by('?').values_list(
+            "id", "quantity_invoiced", "total_purchase_with_tax"
+        ):
+            # Offer items with "add_2_stock"
+            offer_item_total[offer_item_id] = [quantity_invoiced, total_purchase_with_tax, DECIMAL_ZERO]
+        producer_invoice_total = {}
+        for producer_invoice_id, total_price_with_tax in ProducerInvoice.objects.filter(
+                permanence_id=self.id
+        ).exclude(
+            total_price_with_tax=DECIMAL_ZERO
+        ).order_by('?').values_list(
+            "id", "total_price_with_tax"
+        ):
+            producer_invoice_total[producer_invoice_id] = [total_price_with_tax, DECIMAL_ZERO, DECIMAL_ZERO]
+        customer_invoice_total = {}
+        customer_producer_invoice_total = {}
+        permanence_total = [DECIMAL_ZERO, DECIMAL_ZERO, DECIMAL_ZERO, DECIMAL_ZERO]
+
+        now = timezone.now()
+        purchase_rows = {}
+        for a_purchase in Purchase.objects.filter(
+                permanence_id=self.id
+        ).select_related(
+            "offer_item", "customer"
+        ).order_by('?'):
+            offer_item = a_purchase.offer_item
+            if send_to_producer and a_purchase.status == PERMANENCE_WAIT_FOR_SEND:
+                if offer_item.order_unit == PRODUCT_ORDER_UNIT_PC_KG:
+                    a_purchase.quantity_invoiced = (a_purchase.quantity_ordered * offer_item.order_average_weight) \
+                        .quantize(FOUR_DECIMALS)
+                else:
+                    a_purchase.quantity_invoiced = a_purchase.quantity_ordered
+            offer_item_quantity, quantity = a_purchase.get_quantities()
+            totals = offer_item_total.setdefault(offer_item.id, [DECIMAL_ZERO, DECIMAL_ZERO, DECIMAL_ZERO])
+            totals[0] += offer_item_quantity
+            if a_purchase.is_box_content:
+                a_purchase.is_resale_price_fixed = True
+            else:
+                a_purchase.calculate_row_price(quantity)
+                a_purchase.calculate_row_vat(quantity)
+                purchase_price = a_purchase.purchase_price.amount
+                selling_price = a_purchase.selling_price.amount
+                producer_vat = a_purchase.producer_vat.amount
+                customer_vat = a_purchase.customer_vat.amount
+                deposit = a_purchase.deposit.amount
+
+                totals[1] += purchase_price
+                totals[2] += selling_price
+
+                totals = customer_invoice_total.setdefault(
+                    a_purchase.customer_invoice_id, [DECIMAL_ZERO, DECIMAL_ZERO, DECIMAL_ZERO])
+                totals[0] += selling_price
+                totals[1] += customer_vat
+                totals[2] += deposit
+
+                totals = customer_producer_invoice_total.setdefault(
+                    a_purchase.customer_producer_invoice_id, [DECIMAL_ZERO, DECIMAL_ZERO])
+                totals[0] += purchase_price
+                totals[1] += selling_price
+
+                # As purchase_pre_save : from here, the purchase price is the selling price
+                # if the producer is paid at the selling price
+                if offer_item.price_list_multiplier <= DECIMAL_ONE and not offer_item.is_resale_price_fixed:
+                    purchase_price = selling_price
+                    producer_vat = customer_vat
+
+                totals = producer_invoice_total.setdefault(
+                    a_purchase.producer_invoice_id, [DECIMAL_ZERO, DECIMAL_ZERO, DECIMAL_ZERO])
+                totals[0] += purchase_price
+                totals[1] += producer_vat
+                totals[2] += deposit
+
+                if offer_item.price_list_multiplier < DECIMAL_ONE or a_purchase.price_list_multiplier < DECIMAL_ONE:
+                    permanence_total[0] += selling_price
+                    permanence_total[2] += customer_vat
+                else:
+                    permanence_total[0] += purchase_price
+                    permanence_total[2] += producer_vat
+                permanence_total[1] += selling_price
+                permanence_total[3] += customer_vat
+            purchase_rows[a_purchase.id] = {
+                "quantity_invoiced": a_purchase.quantity_invoiced,
+                "is_resale_price_fixed": a_purchase.is_resale_price_fixed,
+                "price_list_multiplier": a_purchase.price_list_multiplier,
+                "vat_level": a_purchase.vat_level,
+                "purchase_price": a_purchase.purchase_price,
+                "selling_price": a_purchase.selling_price,
+                "producer_vat": a_purchase.producer_vat,
+                "customer_vat": a_purchase.customer_vat,
+                "deposit": a_purchase.deposit,
+                "is_updated_on": now
+            }
+
+        bulk_update(Purchase, purchase_rows)
+        bulk_update(OfferItem, {
+            offer_item_id: {
+                "quantity_invoiced": totals[0],
+                "total_purchase_with_tax": totals[1],
+                "total_selling_with_tax": totals[2]
+            } for offer_item_id, totals in offer_item_total.items()
+        })
+        bulk_update(CustomerInvoice, {
+            customer_invoice_id: {
+                "total_price_with_tax": totals[0],
+                "total_vat": totals[1],
+                "total_deposit": totals[2]
+            } for customer_invoice_id, totals in customer_invoice_total.items()
+        })
+        bulk_update(CustomerProducerInvoice, {
+            customer_producer_invoice_id: {
+                "total_purchase_with_tax": totals[0],
+                "total_selling_with_tax": totals[1]
+            } for customer_producer_invoice_id, totals in customer_producer_invoice_total.items()
+        })
+        bulk_update(ProducerInvoice, {
+            producer_invoice_id: {
+                "total_price_with_tax": totals[0],
+                "total_vat": totals[1],
+                "total_deposit": totals[2]
+            } for producer_invoice_id, totals in producer_invoice_total.items()
+        })
+        self.total_purchase_with_tax = permanence_total[0]
+        self.total_selling_with_tax = permanence_total[1]
+        self.total_purchase_vat = permanence_total[2]
+        self.total_selling_vat = permanence_total[3]
+        # Once the new totals are written : a ledger read before would store the reset totals
+        invalidate_permanence_ledger(self.id)
+
     def recalculate_profit(self):
         from repanier.models.purchase import PurchaseWoReceiver
 
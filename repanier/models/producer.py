@@ -7,7 +7,7 @@ from django.conf import settings
 from django.core import urlresolvers
 from django.core.validators import MinValueValidator
 from django.db import models
-from django.db.models import Sum
+from django.db.models import Sum, Case, When
 from django.db.models.signals import pre_save, post_save
 from django.dispatch import receiver
 from django.utils import timezone, translation
@@ -17,12 +17,14 @@ from django.utils.translation import ugettext_lazy as _
 
 from repanier.const import *
 from repanier.fields.RepanierMoneyField import ModelMoneyField, RepanierMoney
+from repanier.ledger import get_update_fields_wo_ledger
 from repanier.models.bankaccount import BankAccount
 from repanier.models.invoice import ProducerInvoice
 from repanier.models.offeritem import OfferItemWoReceiver
 from repanier.models.product import Product
 from repanier.picture.const import SIZE_L
 from repanier.picture.fields import AjaxPictureField
+from repanier.stock import calculate_stock_usage
 from repanier.tools import update_offer_item
 
 
@@ -101,6 +103,13 @@ class Producer(models.Model):
         _("Balance"), max_digits=8, decimal_places=2, default=DECIMAL_ZERO)
     initial_balance = ModelMoneyField(
         _("Initial balance"), max_digits=8, decimal_places=2, default=DECIMAL_ZERO)
+    # Amounts not yet invoiced, maintained by repanier.ledger
+    ledger_bank_not_invoiced = ModelMoneyField(
+        max_digits=8, decimal_places=2, default=DECIMAL_ZERO, editable=False)
+    ledger_order_not_invoiced = ModelMoneyField(
+        max_digits=8, decimal_places=2, default=DECIMAL_ZERO, editable=False)
+    ledger_version = models.IntegerField(default=0, editable=False)
+    ledger_calculated_version = models.IntegerField(default=-1, editable=False)
     represent_this_buyinggroup = models.BooleanField(
         _("Represent this buyinggroup"), default=False)
     is_active = models.BooleanField(_("Active"), default=True)
@@ -180,42 +189,29 @@ class Producer(models.Model):
     get_admin_balance.short_description = (_("Balance"))
     get_admin_balance.allow_tags = False
 
+    def get_ledger(self):
+        # [bank_not_invoiced, order_not_invoiced], recalculated only if a movement occurred since the last read
+        if self.id is None:
+            return [DECIMAL_ZERO, DECIMAL_ZERO]
+        if self.ledger_calculated_version != self.ledger_version:
+            from repanier.ledger import refresh_producer_ledger
+
+            self.ledger_bank_not_invoiced, self.ledger_order_not_invoiced = refresh_producer_ledger([self.id])[self.id]
+            self.ledger_calculated_version = self.ledger_version
+        return [self.ledger_bank_not_invoiced.amount, self.ledger_order_not_invoiced.amount]
+
     def get_order_not_invoiced(self):
         if settings.REPANIER_SETTINGS_MANAGE_ACCOUNTING:
-            result_set = ProducerInvoice.objects.filter(
-                producer_id=self.id,
-                status__gte=PERMANENCE_OPENED,
-                status__lte=PERMANENCE_SEND
-            ).order_by('?').aggregate(Sum('total_price_with_tax'), Sum('delta_price_with_tax'), Sum('delta_transport'))
-            if result_set["total_price_with_tax__sum"] is not None:
-                order_not_invoiced = RepanierMoney(result_set["total_price_with_tax__sum"])
-            else:
-                order_not_invoiced = REPANIER_MONEY_ZERO
-            if result_set["delta_price_with_tax__sum"] is not None:
-                order_not_invoiced += RepanierMoney(result_set["delta_price_with_tax__sum"])
-            if result_set["delta_transport__sum"] is not None:
-                order_not_invoiced += RepanierMoney(result_set["delta_transport__sum"])
+            order_not_invoiced = RepanierMoney(self.get_ledger()[1])
         else:
             order_not_invoiced = REPANIER_MONEY_ZERO
         return order_not_invoiced
 
     def get_bank_not_invoiced(self):
         if settings.REPANIER_SETTINGS_MANAGE_ACCOUNTING:
-            result_set = BankAccount.objects.filter(
-                producer_id=self.id, producer_invoice__isnull=True
-            ).order_by('?').aggregate(Sum('bank_amount_in'), Sum('bank_amount_out'))
-            if result_set["bank_amount_in__sum"] is not None:
-                bank_in = RepanierMoney(result_set["bank_amount_in__sum"])
-            else:
-                bank_in = REPANIER_MONEY_ZERO
-            if result_set["bank_amount_out__sum"] is not None:
-                bank_out = RepanierMoney(result_set["bank_amount_out__sum"])
-            else:
-                bank_out = REPANIER_MONEY_ZERO
-            bank_not_invoiced = bank_in - bank_out
+            bank_not_invoiced = RepanierMoney(self.get_ledger()[0])
         else:
             bank_not_invoiced = REPANIER_MONEY_ZERO
-
         return bank_not_invoiced
 
     def get_calculated_invoiced_balance(self, permanence_id):
@@ -224,44 +220,42 @@ class Producer(models.Model):
         # Do not take into account product whose order unit is >= PRODUCT_ORDER_UNIT_DEPOSIT
         result_set = OfferItemWoReceiver.objects.filter(
             permanence_id=permanence_id,
-            producer_id=self.id,
-            price_list_multiplier__lt=1
+            producer_id=self.id
         ).exclude(
             order_unit__gte=PRODUCT_ORDER_UNIT_DEPOSIT
         ).order_by('?').aggregate(
-            Sum('total_selling_with_tax')
+            payment_needed=Sum(Case(
+                When(price_list_multiplier__lt=1, then='total_selling_with_tax'),
+                default='total_purchase_with_tax'
+            ))
         )
-        if result_set["total_selling_with_tax__sum"] is not None:
-            payment_needed = result_set["total_selling_with_tax__sum"]
+        if result_set["payment_needed"] is not None:
+            payment_needed = result_set["payment_needed"]
         else:
             payment_needed = DECIMAL_ZERO
-        result_set = OfferItemWoReceiver.objects.filter(
-            permanence_id=permanence_id,
-            producer_id=self.id,
-            price_list_multiplier__gte=1,
-        ).exclude(
-            order_unit__gte=PRODUCT_ORDER_UNIT_DEPOSIT
-        ).order_by('?').aggregate(
-            Sum('total_purchase_with_tax'),
-        )
-        if result_set["total_purchase_with_tax__sum"] is not None:
-            payment_needed += result_set["total_purchase_with_tax__sum"]
         calculated_invoiced_balance = self.balance - bank_not_invoiced + payment_needed
         if self.manage_replenishment:
-            for offer_item in OfferItemWoReceiver.objects.filter(
+            for quantity_invoiced, add_2_stock, stock, price_list_multiplier, customer_unit_price, \
+                producer_unit_price, unit_deposit in OfferItemWoReceiver.objects.filter(
                     is_active=True,
                     permanence_id=permanence_id,
                     producer_id=self.id,
                     manage_replenishment=True,
-            ).order_by('?'):
-                invoiced_qty, taken_from_stock, customer_qty = offer_item.get_producer_qty_stock_invoiced()
-                if offer_item.price_list_multiplier < DECIMAL_ONE:  # or offer_item.is_resale_price_fixed:
-                    unit_price = offer_item.customer_unit_price.amount
+                    quantity_invoiced__gt=DECIMAL_ZERO
+            ).order_by('?').values_list(
+                "quantity_invoiced", "add_2_stock", "stock", "price_list_multiplier",
+                "customer_unit_price", "producer_unit_price", "unit_deposit"
+            ):
+                invoiced_qty, taken_from_stock, customer_qty = calculate_stock_usage(
+                    quantity_invoiced, add_2_stock, stock, True
+                )
+                if price_list_multiplier < DECIMAL_ONE:  # or offer_item.is_resale_price_fixed:
+                    unit_price = customer_unit_price
                 else:
-                    unit_price = offer_item.producer_unit_price.amount
+                    unit_price = producer_unit_price
                 if taken_from_stock > DECIMAL_ZERO:
                     delta_price_with_tax = (
-                            (unit_price + offer_item.unit_deposit.amount)
+                            (unit_price + unit_deposit)
                             * taken_from_stock
                     ).quantize(TWO_DECIMALS)
                     calculated_invoiced_balance -= delta_price_with_tax
@@ -383,6 +377,13 @@ class Producer(models.Model):
         self.is_anonymized = True
         self.save()
 
+    def save(self, *args, **kwargs):
+        if not args and not self._state.adding and kwargs.get("update_fields") is None \
+                and not kwargs.get("force_insert"):
+            # Never write back the ledger, see repanier.ledger
+            kwargs["update_fields"] = get_update_fields_wo_ledger(self)
+        super(Producer, self).save(*args, **kwargs)
+
     def __str__(self):
         if self.producer_price_are_wo_vat:
             return "{} {}".format(self.short_profile_name, _("wo tax"))
@@ -6,7 +6,7 @@ from django.conf import settings
 from django.core import urlresolvers
 from django.db import models, transaction
 from django.db.models import F
-from django.db.models.signals import pre_save, post_save
+from django.db.models.signals import pre_save, post_save, post_init, m2m_changed
 from django.dispatch import receiver
 from django.utils.dateparse import parse_date
 from django.utils.safestring import mark_safe
@@ -15,9 +15,11 @@ from djangocms_text_ckeditor.fields import HTMLField
 from parler.fields import TranslatedField
 from parler.models import TranslatedFieldsModel
 
+from repanier.cache import invalidate_cache, user_namespace
 from repanier.const import *
 from repanier.models.contract import ContractContent
 from repanier.models.item import Item
+from repanier.stock import record_stock_movements
 from repanier.tools import clean_offer_item
 
 
@@ -280,6 +282,17 @@ class Product(Item):
         unique_together = ("producer", "reference",)
 
 
+@receiver(post_init, sender=Product)
+def product_post_init(sender, **kwargs):
+    product = kwargs["instance"]
+    if product.id is None:
+        product.previous_stock = DECIMAL_ZERO
+    elif "stock" in product.get_deferred_fields():
+        product.previous_stock = None
+    else:
+        product.previous_stock = product.stock
+
+
 @receiver(pre_save, sender=Product)
 def product_pre_save(sender, **kwargs):
     product = kwargs["instance"]
@@ -357,6 +370,37 @@ def product_post_save(sender, **kwargs):
         calculated_customer_content_price=F('content_quantity') * product.customer_unit_price.amount,
         calculated_content_deposit=F('content_quantity') * product.unit_deposit.amount,
     )
+    record_stock_inventory(product)
+
+
+def record_stock_inventory(product):
+    # A stock set through the product is an inventory movement
+    from repanier.models.stockmovement import StockMovement
+
+    if product.previous_stock is not None and product.stock is not None and product.stock != product.previous_stock:
+        record_stock_movements([StockMovement(
+            product_id=product.id,
+            movement=STOCK_MOVEMENT_INVENTORY,
+            quantity=product.stock - product.previous_stock
+        )], update_stock=False)
+    # Do not do it twice
+    product.previous_stock = product.stock
+
+
+@receiver(m2m_changed, sender=Product.likes.through)
+def product_likes_changed(sender, **kwargs):
+    # Invalidate the cached liked products of the users (see repanier.customer_context)
+    action = kwargs["action"]
+    instance = kwargs["instance"]
+    if kwargs["reverse"]:
+        # user.likes.add(product)
+        user_ids = [instance.id]
+    elif action == "pre_clear":
+        user_ids = list(instance.likes.order_by('?').values_list("id", flat=True))
+    else:
+        user_ids = kwargs["pk_set"] or []
+    if action in ("post_add", "post_remove", "pre_clear"):
+        invalidate_cache(*[user_namespace(user_id) for user_id in user_ids])
 
 
 class Product_Translation(TranslatedFieldsModel):
@@ -12,6 +12,7 @@ from django.utils.translation import ugettext_lazy as _
 import repanier.apps
 from repanier.const import *
 from repanier.fields.RepanierMoneyField import ModelMoneyField
+from repanier.ledger import invalidate_customer_ledger, invalidate_producer_ledger
 from repanier.models.box import BoxContent
 from repanier.models.invoice import CustomerInvoice, ProducerInvoice, CustomerProducerInvoice
 from repanier.models.offeritem import OfferItemWoReceiver
@@ -182,6 +183,49 @@ class Purchase(models.Model):
                     return (self.quantity_invoiced / offer_item.order_average_weight).quantize(FOUR_DECIMALS)
             return self.quantity_invoiced
 
+    def get_quantities(self):
+        # Return the quantity counted into the offer item and the quantity used to calculate the prices
+        if self.status < PERMANENCE_WAIT_FOR_SEND:
+            quantity = self.quantity_ordered
+            if self.offer_item.order_unit == PRODUCT_ORDER_UNIT_PC_KG:
+                # This quantity is used to calculate the price
+                # The unit price is for 1 kg.
+                # 1 = 1 piece of order_average_weight
+                # 2 = 2 pices of order_average_weight
+                return quantity, quantity * self.offer_item.order_average_weight
+            return quantity, quantity
+        return self.quantity_invoiced, self.quantity_invoiced
+
+    def calculate_row_price(self, quantity):
+        self.is_resale_price_fixed = self.offer_item.is_resale_price_fixed
+        if settings.REPANIER_SETTINGS_CUSTOM_CUSTOMER_PRICE:
+            if self.is_resale_price_fixed \
+                    or self.offer_item.price_list_multiplier < DECIMAL_ONE:
+                self.price_list_multiplier = DECIMAL_ONE
+            else:
+                self.price_list_multiplier = self.customer.price_list_multiplier
+        else:
+            self.price_list_multiplier = DECIMAL_ONE
+
+        unit_deposit = self.get_unit_deposit()
+
+        self.purchase_price.amount = (
+                (self.get_producer_unit_price() + unit_deposit) * quantity).quantize(TWO_DECIMALS)
+        self.selling_price.amount = (
+                (self.get_customer_unit_price() + unit_deposit) * quantity).quantize(TWO_DECIMALS)
+
+        permanences_dates_counter = self.offer_item.permanences_dates_counter
+        if permanences_dates_counter > 1:
+            # Multiple delivery dates of a contract
+            self.purchase_price.amount *= permanences_dates_counter
+            self.selling_price.amount *= permanences_dates_counter
+
+    def calculate_row_vat(self, quantity):
+        self.vat_level = self.offer_item.vat_level
+        self.producer_vat.amount = (self.get_producer_unit_vat() * quantity).quantize(FOUR_DECIMALS)
+        self.customer_vat.amount = (self.get_customer_unit_vat() * quantity).quantize(FOUR_DECIMALS)
+        self.deposit.amount = self.get_unit_deposit() * quantity
+
     def get_long_name(self, customer_price=True):
         return self.offer_item.get_long_name(customer_price=customer_price)
 
@@ -303,19 +347,11 @@ def purchase_post_init(sender, **kwargs):
 @receiver(pre_save, sender=Purchase)
 def purchase_pre_save(sender, **kwargs):
     purchase = kwargs["instance"]
+    offer_item_quantity, quantity = purchase.get_quantities()
     if purchase.status < PERMANENCE_WAIT_FOR_SEND:
-        quantity = purchase.quantity_ordered
-        delta_quantity = quantity - purchase.previous_quantity_ordered
-        if purchase.offer_item.order_unit == PRODUCT_ORDER_UNIT_PC_KG:
-            # This quantity is used to calculate the price
-            # The unit price is for 1 kg.
-            # 1 = 1 piece of order_average_weight
-            # 2 = 2 pices of order_average_weight
-            quantity *= purchase.offer_item.order_average_weight
-
+        delta_quantity = offer_item_quantity - purchase.previous_quantity_ordered
     else:
-        quantity = purchase.quantity_invoiced
-        delta_quantity = quantity - purchase.previous_quantity_invoiced
+        delta_quantity = offer_item_quantity - purchase.previous_quantity_invoiced
     if purchase.is_box_content:
         purchase.is_resale_price_fixed = True
         if delta_quantity != DECIMAL_ZERO:
@@ -323,28 +359,7 @@ def purchase_pre_save(sender, **kwargs):
                 quantity_invoiced=F('quantity_invoiced') + delta_quantity,
             )
     else:
-        purchase.is_resale_price_fixed = purchase.offer_item.is_resale_price_fixed
-        if settings.REPANIER_SETTINGS_CUSTOM_CUSTOMER_PRICE:
-            if purchase.is_resale_price_fixed \
-                    or purchase.offer_item.price_list_multiplier < DECIMAL_ONE:
-                purchase.price_list_multiplier = DECIMAL_ONE
-            else:
-                purchase.price_list_multiplier = purchase.customer.price_list_multiplier
-        else:
-            purchase.price_list_multiplier = DECIMAL_ONE
-
-        unit_deposit = purchase.get_unit_deposit()
-
-        purchase.purchase_price.amount = (
-                (purchase.get_producer_unit_price() + unit_deposit) * quantity).quantize(TWO_DECIMALS)
-        purchase.selling_price.amount = (
-                (purchase.get_customer_unit_price() + unit_deposit) * quantity).quantize(TWO_DECIMALS)
-
-        permanences_dates_counter = purchase.offer_item.permanences_dates_counter
-        if permanences_dates_counter > 1:
-            # Multiple delivery dates of a contract
-            purchase.purchase_price.amount *= permanences_dates_counter
-            purchase.selling_price.amount *= permanences_dates_counter
+        purchase.calculate_row_price(quantity)
 
         delta_purchase_price = purchase.purchase_price.amount - purchase.previous_purchase_price
         delta_selling_price = purchase.selling_price.amount - purchase.previous_selling_price
@@ -353,11 +368,7 @@ def purchase_pre_save(sender, **kwargs):
                 delta_selling_price != DECIMAL_ZERO or
                 delta_purchase_price != DECIMAL_ZERO):
 
-            purchase.vat_level = purchase.offer_item.vat_level
-            purchase.producer_vat.amount = (purchase.get_producer_unit_vat() * quantity).quantize(FOUR_DECIMALS)
-            purchase.customer_vat.amount = (purchase.get_customer_unit_vat() * quantity).quantize(FOUR_DECIMALS)
-
-            purchase.deposit.amount = unit_deposit * quantity
+            purchase.calculate_row_vat(quantity)
             delta_purchase_vat = purchase.producer_vat.amount - purchase.previous_producer_vat
             delta_selling_vat = purchase.customer_vat.amount - purchase.previous_customer_vat
             delta_deposit = purchase.deposit.amount - purchase.previous_deposit
@@ -388,6 +399,8 @@ def purchase_pre_save(sender, **kwargs):
                 total_vat=F('total_vat') + delta_purchase_vat,
                 total_deposit=F('total_deposit') + delta_deposit
             )
+            invalidate_customer_ledger(purchase.customer_id)
+            invalidate_producer_ledger(purchase.producer_id)
             if purchase.offer_item.price_list_multiplier < DECIMAL_ONE or purchase.price_list_multiplier < DECIMAL_ONE:
                 Permanence.objects.filter(id=purchase.permanence_id).update(
                     total_purchase_with_tax=F('total_purchase_with_tax') + delta_selling_price,
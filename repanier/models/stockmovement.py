@@ -0,0 +1,42 @@
+# -*- coding: utf-8
+from django.db import models
+from django.utils.translation import ugettext_lazy as _
+
+from repanier.const import *
+
+
+class StockMovement(models.Model):
+    # One change of the stock of a product. The stock of a product is the sum of its movements.
+    # The movements outlive their permanence and offer item, so that the stock can still be replayed.
+    # See repanier.stock
+    product = models.ForeignKey(
+        'Product', verbose_name=_("Product"),
+        on_delete=models.CASCADE)
+    permanence = models.ForeignKey(
+        'Permanence', verbose_name=_("Permanence"),
+        null=True, blank=True, default=None,
+        on_delete=models.SET_NULL)
+    offer_item = models.ForeignKey(
+        'OfferItem', verbose_name=_("Offer item"),
+        null=True, blank=True, default=None,
+        on_delete=models.SET_NULL)
+    movement = models.CharField(
+        max_length=3,
+        choices=LUT_STOCK_MOVEMENT,
+        default=STOCK_MOVEMENT_INVENTORY,
+        verbose_name=_("Movement"))
+    # Positive when added to the stock, negative when taken from it
+    quantity = models.DecimalField(
+        _("Quantity"),
+        default=DECIMAL_ZERO, max_digits=9, decimal_places=3)
+    is_created_on = models.DateTimeField(_("Created on"), auto_now_add=True)
+
+    def __str__(self):
+        return "{} {} {}".format(self.product_id, self.get_movement_display(), self.quantity)
+
+    class Meta:
+        verbose_name = _("Stock movement")
+        verbose_name_plural = _("Stock movements")
+        index_together = [
+            ["product", "id"]
+        ]
@@ -0,0 +1,130 @@
+# -*- coding: utf-8
+import re
+import unicodedata
+
+from django.conf import settings
+from django.db.models import F, FloatField, Func, Q, Value
+
+from repanier.const import *
+
+# Search of the offer items on the order form.
+# Each translation of an offer item has a precomputed search_text : the long name, the producer
+# and the department, lower case and without accents. It is refreshed with the cache parts of the offer
+# items, when they are created or updated from their product (render_offer_item_cache_parts),
+# and for the whole permanence by reorder_offer_items.
+# With REPANIER_SETTINGS_FULL_TEXT_SEARCH (PostgreSQL only), search_vector is the language aware tsvector
+# of search_text, indexed with GIN, and the offer items are found and ranked by a full text search.
+# Otherwise (e.g. sqlite), there is no search_vector and each word of the search must be into search_text.
+
+FULL_TEXT_SEARCH = settings.REPANIER_SETTINGS_FULL_TEXT_SEARCH
+
+if FULL_TEXT_SEARCH:
+    from django.contrib.postgres.search import SearchRank, SearchVector
+
+# Text search configurations of PostgreSQL
+SEARCH_CONFIGS = {
+    "da": "danish",
+    "de": "german",
+    "en": "english",
+    "es": "spanish",
+    "fr": "french",
+    "it": "italian",
+    "nl": "dutch",
+    "pt": "portuguese",
+    "sv": "swedish",
+}
+SEARCH_CONFIG_DEFAULT = "simple"
+
+WORD_RE = re.compile(r"[^\W_]+", re.UNICODE)
+
+
+def get_search_config(language_code):
+    return SEARCH_CONFIGS.get(language_code.split("-")[0], SEARCH_CONFIG_DEFAULT)
+
+
+def get_search_words(text):
+    # "Pâtes, Fraîches" -> ["pates", "fraiches"]
+    text = unicodedata.normalize("NFKD", text or EMPTY_STRING)
+    text = EMPTY_STRING.join(c for c in text if not unicodedata.combining(c))
+    return WORD_RE.findall(text.lower())
+
+
+def get_search_text(*values):
+    return " ".join(word for value in values for word in get_search_words(value))
+
+
+def refresh_search_index(permanence_id=None, offer_item_ids=None):
+    # Recompute search_text and search_vector of the offer items of the permanence, or of the given offer items
+    from repanier.models.lut import LUT_DepartmentForCustomer
+    from repanier.models.offeritem import OfferItemWoReceiver
+    from repanier.tools import bulk_update
+
+    translation_model = OfferItemWoReceiver._parler_meta.root_model
+    department_translation_model = LUT_DepartmentForCustomer._parler_meta.root_model
+    if offer_item_ids is None:
+        translation_qs = translation_model.objects.filter(master__permanence_id=permanence_id)
+        department_translation_qs = department_translation_model.objects.filter(
+            master__offeritem__permanence_id=permanence_id
+        )
+    else:
+        translation_qs = translation_model.objects.filter(master_id__in=offer_item_ids)
+        department_translation_qs = department_translation_model.objects.filter(
+            master__offeritem__id__in=offer_item_ids
+        )
+    department_names = {}
+    for department_id, language_code, short_name in department_translation_qs.order_by('?').distinct().values_list(
+            "master_id", "language_code", "short_name"
+    ):
+        department_names[(department_id, language_code)] = short_name
+    rows = {}
+    language_codes = set()
+    for translation_id, language_code, long_name, search_text, producer_name, department_id in \
+            translation_qs.order_by('?').values_list(
+                "id", "language_code", "long_name", "search_text",
+                "master__producer__short_profile_name", "master__department_for_customer_id"
+            ):
+        language_codes.add(language_code)
+        new_search_text = get_search_text(
+            long_name, producer_name, department_names.get((department_id, language_code))
+        )
+        if new_search_text != search_text:
+            rows[translation_id] = {"search_text": new_search_text}
+    bulk_update(translation_model, rows)
+    if FULL_TEXT_SEARCH:
+        # One update per language, computed by the database
+        for language_code in language_codes:
+            translation_qs.filter(language_code=language_code).order_by('?').update(
+                search_vector=SearchVector("search_text", config=get_search_config(language_code))
+            )
+
+
+class PrefixSearchQuery(Func):
+    # to_tsquery and not plainto_tsquery (SearchQuery) : each word is a prefix,
+    # as with the former icontains "tom" finds "tomates"
+    function = "to_tsquery"
+
+    def __init__(self, words, config):
+        super(PrefixSearchQuery, self).__init__(
+            Value(config), Value(" & ".join("{}:*".format(word) for word in words))
+        )
+
+
+def search_offer_items(offer_item_qs, q, language_code):
+    # Filter offer_item_qs on q and annotate each offer item with its "search_rank"
+    words = get_search_words(q)
+    if len(words) == 0:
+        return offer_item_qs.annotate(search_rank=Value(0, output_field=FloatField()))
+    if FULL_TEXT_SEARCH:
+        query = PrefixSearchQuery(words, get_search_config(language_code))
+        return offer_item_qs.filter(
+            translations__language_code=language_code,
+            translations__search_vector=query
+        ).annotate(
+            search_rank=SearchRank(F("translations__search_vector"), query)
+        )
+    # One filter() to search all the words into the same translation
+    offer_item_qs = offer_item_qs.filter(
+        Q(translations__language_code=language_code),
+        *[Q(translations__search_text__contains=word) for word in words]
+    )
+    return offer_item_qs.annotate(search_rank=Value(0, output_field=FloatField()))
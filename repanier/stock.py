@@ -0,0 +1,141 @@
+# -*- coding: utf-8
+from django.db.models import F, Sum
+
+from repanier.const import *
+from repanier.tools import bulk_update
+
+# Ledger of the stock of the products.
+# Every change of Product.stock is recorded as a StockMovement :
+# - an inventory, when the stock is set (product form, stock sheet import, ...),
+# - the quantity taken from the stock and the quantity added to it, when a permanence is invoiced.
+# Product.stock is updated by the same delta, so that it is never recalculated from scratch,
+# and replay_stock rebuilds it from the movements.
+# Before invoicing, the quantity taken from the stock of an offer item follows its quantity_invoiced,
+# kept up to date by the purchases.
+
+
+def calculate_stock_usage(quantity_invoiced, add_2_stock, stock, manage_replenishment):
+    # Return the quantity to buy to the producer, the stock used to deliver the invoiced quantity
+    # and the quantity delivered to the customers
+    if quantity_invoiced > DECIMAL_ZERO:
+        if manage_replenishment:
+            # if RepanierSettings.producer_pre_opening then the stock is the max available qty by the producer,
+            # not into our stock
+            quantity_for_customer = quantity_invoiced - add_2_stock
+            if stock == DECIMAL_ZERO:
+                return quantity_invoiced, DECIMAL_ZERO, quantity_for_customer
+            else:
+                delta = (quantity_for_customer - stock).quantize(FOUR_DECIMALS)
+                if delta <= DECIMAL_ZERO:
+                    # i.e. quantity_for_customer <= stock
+                    return add_2_stock, quantity_for_customer, quantity_for_customer
+                else:
+                    return delta + add_2_stock, stock, quantity_for_customer
+        else:
+            return quantity_invoiced, DECIMAL_ZERO, quantity_invoiced
+    return DECIMAL_ZERO, DECIMAL_ZERO, DECIMAL_ZERO
+
+
+def record_stock_movements(movements, update_stock=True):
+    # Save the movements [StockMovement, ...] and add them to the stock of their products.
+    # With update_stock=False, the stock of the products already includes them.
+    from repanier.models.product import Product
+    from repanier.models.stockmovement import StockMovement
+
+    delta_stock = {}
+    for movement in movements:
+        movement.quantity = movement.quantity.quantize(THREE_DECIMALS)
+        delta_stock[movement.product_id] = delta_stock.get(movement.product_id, DECIMAL_ZERO) + movement.quantity
+    movements = [movement for movement in movements if movement.quantity != DECIMAL_ZERO]
+    if len(movements) == 0:
+        return
+    StockMovement.objects.bulk_create(movements, batch_size=BULK_UPDATE_BATCH_SIZE)
+    if update_stock:
+        bulk_update(Product, {
+            product_id: {"stock": F('stock') + delta}
+            for product_id, delta in delta_stock.items() if delta != DECIMAL_ZERO
+        })
+
+
+def set_stock(product_stocks, product_qs=None):
+    # Inventory : {product_id: counted stock}. Record the difference with the current stock.
+    # Return the ids of the products whose stock has changed.
+    from repanier.models.product import Product
+    from repanier.models.stockmovement import StockMovement
+
+    if product_qs is None:
+        product_qs = Product.objects.all()
+    movements = []
+    for product_id, stock in product_qs.filter(
+            id__in=product_stocks.keys()
+    ).order_by('?').values_list("id", "stock"):
+        if product_stocks[product_id] != stock:
+            movements.append(StockMovement(
+                product_id=product_id,
+                movement=STOCK_MOVEMENT_INVENTORY,
+                quantity=product_stocks[product_id] - stock
+            ))
+    record_stock_movements(movements)
+    return [movement.product_id for movement in movements]
+
+
+def calculate_stock(product_ids=None):
+    # {product_id: stock} : the sum of the movements, one grouped aggregate
+    # Note : .order_by() and not .order_by('?'), the random order would be added to the "group by"
+    from repanier.models.stockmovement import StockMovement
+
+    qs = StockMovement.objects.all()
+    if product_ids is not None:
+        qs = qs.filter(product_id__in=product_ids)
+    return {
+        row["product_id"]: row["quantity__sum"] or DECIMAL_ZERO
+        for row in qs.order_by().values("product_id").annotate(Sum("quantity"))
+    }
+
+
+def replay_stock(product_ids=None):
+    # Rebuild the stock of the products from their movements. Return {product_id: stock}
+    from repanier.models.product import Product
+
+    stocks = calculate_stock(product_ids)
+    qs = Product.objects.order_by('?')
+    if product_ids is not None:
+        qs = qs.filter(id__in=product_ids)
+    rows = {}
+    for product_id, stock in qs.values_list("id", "stock"):
+        replayed = stocks.setdefault(product_id, DECIMAL_ZERO)
+        if replayed != stock:
+            rows[product_id] = {"stock": replayed}
+    bulk_update(Product, rows)
+    return stocks
+
+
+def check_stock():
+    # Compare the stock of the products with the sum of their movements.
+    # Return [(product_id, stored, calculated), ...]
+    from repanier.models.product import Product
+
+    stocks = calculate_stock()
+    differences = []
+    for product_id, stock in Product.objects.order_by('id').values_list("id", "stock"):
+        calculated = stocks.get(product_id, DECIMAL_ZERO)
+        if stock != calculated:
+            differences.append((product_id, stock, calculated))
+    return differences
+
+
+def open_stock_ledger():
+    # Record the difference between the stock of the products and the sum of their movements as an inventory,
+    # i.e. the stock of the products which existed before the movements were recorded.
+    # Return the number of movements.
+    from repanier.models.stockmovement import StockMovement
+
+    movements = [
+        StockMovement(
+            product_id=product_id,
+            movement=STOCK_MOVEMENT_INVENTORY,
+            quantity=stock - calculated
+        ) for product_id, stock, calculated in check_stock()
+    ]
+    record_stock_movements(movements, update_stock=False)
+    return len(movements)
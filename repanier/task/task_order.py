@@ -15,10 +15,12 @@ from repanier.email import email_offer
 from repanier.email import email_order
 from repanier.models.box import Box
 from repanier.models.deliveryboard import DeliveryBoard
+from repanier.models.job import run_steps
 from repanier.models.offeritem import OfferItemWoReceiver
 from repanier.models.permanence import Permanence
 from repanier.models.producer import Producer
 from repanier.models.product import Product
+from repanier.tools import bulk_create_offer_items
 from repanier.tools import reorder_offer_items
 from repanier.tools import reorder_purchases
 
@@ -72,8 +74,8 @@ def common_to_pre_open_and_open(permanence):
             is_box=False,
             is_into_offer=True
         ).order_by('?')
-        for product in product_queryset:
-            product.get_or_create_offer_item(permanence, reset_add_2_stock=True)
+        # Products are never boxes here : no box content to add
+        bulk_create_offer_items(permanence, product_queryset, reset_add_2_stock=True)
         boxes_in_this_permanence = Box.objects.filter(
             permanence=permanence,
             is_active=True
@@ -89,61 +91,80 @@ def common_to_pre_open_and_open(permanence):
 # @transaction.atomic
 # Important : no @transaction.atomic because otherwise the "clock" in **permanence.get_html_status_display()**
 # won't works on the admin screen. The clock is based on the permanence.status state.
-def pre_open_order(permanence_id):
+def pre_open_order(permanence_id, job=None):
     permanence = Permanence.objects.filter(id=permanence_id).order_by('?').first()
-    permanence.set_status(old_status=(PERMANENCE_PLANNED,), new_status=PERMANENCE_WAIT_FOR_PRE_OPEN)
 
-    common_to_pre_open_and_open(permanence)
+    def allow_access_to_producers():
+        # 1 - Allow access to the producer to his/her products into "pre order" status using random uuid4
+        for producer in Producer.objects.filter(
+                permanence=permanence_id, producer_pre_opening=True
+        ).only('offer_uuid').order_by('?'):
+            producer.offer_uuid = uuid.uuid1()
+            producer.offer_filled = False
+            producer.save(update_fields=['offer_uuid', 'offer_filled'])
 
-    # 1 - Allow access to the producer to his/her products into "pre order" status using random uuid4
-    for producer in Producer.objects.filter(
-            permanence=permanence_id, producer_pre_opening=True
-    ).only('offer_uuid').order_by('?'):
-        producer.offer_uuid = uuid.uuid1()
-        producer.offer_filled = False
-        producer.save(update_fields=['offer_uuid', 'offer_filled'])
-    email_offer.send_pre_open_order(permanence_id)
-    permanence.set_status(old_status=(PERMANENCE_WAIT_FOR_PRE_OPEN,), new_status=PERMANENCE_PRE_OPEN)
+    # When run by a job, a failed step is resumed : the previous steps are not done again
+    run_steps([
+        ("wait for pre open", lambda: permanence.set_status(
+            old_status=(PERMANENCE_PLANNED,), new_status=PERMANENCE_WAIT_FOR_PRE_OPEN)),
+        ("generate offer", lambda: common_to_pre_open_and_open(permanence)),
+        ("allow access to producers", allow_access_to_producers),
+        ("send mails", lambda: email_offer.send_pre_open_order(permanence_id)),
+        ("pre open", lambda: permanence.set_status(
+            old_status=(PERMANENCE_WAIT_FOR_PRE_OPEN,), new_status=PERMANENCE_PRE_OPEN)),
+    ], job)
 
 
 # @transaction.atomic
 # Important : no @transaction.atomic because otherwise the "clock" in **permanence.get_html_status_display()**
 # won't works on the admin screen. The clock is based on the permanence.status state.
-def open_order(permanence_id, do_not_send_any_mail=False):
+def open_order(permanence_id, do_not_send_any_mail=False, job=None):
     # Be careful : use permanece_id, deliveries_id, ... and not objects
     # for the "thread" processing
     permanence = Permanence.objects.filter(id=permanence_id).order_by('?').first()
-    permanence.set_status(old_status=(PERMANENCE_PLANNED, PERMANENCE_PRE_OPEN), new_status=PERMANENCE_WAIT_FOR_OPEN)
 
-    common_to_pre_open_and_open(permanence)
+    def disallow_access_to_producers():
+        # 1 - Disallow access to the producer to his/her products no more into "pre order" status
+        for producer in Producer.objects.filter(
+                permanence=permanence_id,
+                producer_pre_opening=True,
+                is_active=True
+        ).only('offer_uuid', 'offer_filled').order_by('?'):
+            producer.offer_uuid = uuid.uuid1()
+            producer.save(update_fields=['offer_uuid', ])
+            if not producer.offer_filled:
+                # Deactivate offer item if the producer as not reacted to the pre opening
+                OfferItemWoReceiver.objects.filter(
+                    permanence_id=permanence_id,
+                    may_order=True,
+                    producer_id=producer.id
+                ).update(may_order=False)
 
-    # 1 - Disallow access to the producer to his/her products no more into "pre order" status
-    for producer in Producer.objects.filter(
-            permanence=permanence_id,
-            producer_pre_opening=True,
-            is_active=True
-    ).only('offer_uuid', 'offer_filled').order_by('?'):
-        producer.offer_uuid = uuid.uuid1()
-        producer.save(update_fields=['offer_uuid', ])
-        if not producer.offer_filled:
-            # Deactivate offer item if the producer as not reacted to the pre opening
-            OfferItemWoReceiver.objects.filter(
-                permanence_id=permanence_id,
-                may_order=True,
-                producer_id=producer.id
-            ).update(may_order=False)
-    # 3 - Keep only producer with offer items which can be ordered
-    permanence.producers.clear()
-    for offer_item in OfferItemWoReceiver.objects.filter(
-            permanence_id=permanence.id,
-            # order_unit__lt=PRODUCT_ORDER_UNIT_DEPOSIT,
-            may_order=True
-    ).order_by().distinct("producer_id"):
-        permanence.producers.add(offer_item.producer_id)
-
-    if not do_not_send_any_mail:
-        email_offer.send_open_order(permanence_id)
-    permanence.set_status(old_status=(PERMANENCE_WAIT_FOR_OPEN,), new_status=PERMANENCE_OPENED)
+    def keep_producers_with_offer_items():
+        # 3 - Keep only producer with offer items which can be ordered
+        permanence.producers.clear()
+        for offer_item in OfferItemWoReceiver.objects.filter(
+                permanence_id=permanence.id,
+                # order_unit__lt=PRODUCT_ORDER_UNIT_DEPOSIT,
+                may_order=True
+        ).order_by().distinct("producer_id"):
+            permanence.producers.add(offer_item.producer_id)
+
+    def send_mails():
+        if not do_not_send_any_mail:
+            email_offer.send_open_order(permanence_id)
+
+    # When run by a job, a failed step is resumed : the previous steps are not done again
+    run_steps([
+        ("wait for open", lambda: permanence.set_status(
+            old_status=(PERMANENCE_PLANNED, PERMANENCE_PRE_OPEN), new_status=PERMANENCE_WAIT_FOR_OPEN)),
+        ("generate offer", lambda: common_to_pre_open_and_open(permanence)),
+        ("disallow access to producers", disallow_access_to_producers),
+        ("keep producers with offer items", keep_producers_with_offer_items),
+        ("send mails", send_mails),
+        ("open", lambda: permanence.set_status(
+            old_status=(PERMANENCE_WAIT_FOR_OPEN,), new_status=PERMANENCE_OPENED)),
+    ], job)
 
 
 def back_to_scheduled(permanence):
@@ -178,7 +199,7 @@ def automatically_closed():
 
 # Important : no @transaction.atomic because otherwise the "clock" in **permanence.get_html_status_display()**
 # won't works on the admin screen. The clock is based on the permanence.status state.
-def close_and_send_order(permanence_id, everything=True, producers_id=(), deliveries_id=()):
+def close_and_send_order(permanence_id, everything=True, producers_id=(), deliveries_id=(), job=None):
     # Be careful : use permanece_id, deliveries_id, ... and not objects
     # for the "thread" processing
 
@@ -188,7 +209,11 @@ def close_and_send_order(permanence_id, everything=True, producers_id=(), delive
     logger.debug("producers_id : %s", producers_id)
     logger.debug("deliveries_id : %s", deliveries_id)
 
-    permanence = Permanence.objects.filter(id=permanence_id, status=PERMANENCE_OPENED).order_by('?').first()
+    if job is not None and job.step > 0:
+        # Resume an interrupted job : the status is no more PERMANENCE_OPENED
+        permanence = Permanence.objects.filter(id=permanence_id).order_by('?').first()
+    else:
+        permanence = Permanence.objects.filter(id=permanence_id, status=PERMANENCE_OPENED).order_by('?').first()
     if permanence is None:
         return
     if permanence.with_delivery_point:
@@ -206,20 +231,28 @@ def close_and_send_order(permanence_id, everything=True, producers_id=(), delive
             if settings.REPANIER_SETTINGS_CUSTOMER_MUST_CONFIRM_ORDER:
                 return
 
-    permanence.set_status(old_status=(PERMANENCE_OPENED,), new_status=PERMANENCE_WAIT_FOR_CLOSED, everything=everything,
-                          producers_id=producers_id,
-                          deliveries_id=deliveries_id)
-    permanence.close_order(everything=everything, producers_id=producers_id, deliveries_id=deliveries_id)
-    permanence.set_status(old_status=(PERMANENCE_WAIT_FOR_CLOSED,), new_status=PERMANENCE_CLOSED, everything=everything,
-                          producers_id=producers_id,
-                          deliveries_id=deliveries_id)
-    permanence.set_status(old_status=(PERMANENCE_CLOSED,), new_status=PERMANENCE_WAIT_FOR_SEND, everything=everything,
-                          producers_id=producers_id,
-                          deliveries_id=deliveries_id)
-    permanence.recalculate_order_amount(send_to_producer=True)
-    reorder_purchases(permanence.id)
-    email_order.email_order(permanence.id, everything=everything, producers_id=producers_id,
-                            deliveries_id=deliveries_id)
-    permanence.set_status(old_status=(PERMANENCE_WAIT_FOR_SEND,), new_status=PERMANENCE_SEND, everything=everything,
-                          producers_id=producers_id,
-                          deliveries_id=deliveries_id)
+    # When run by a job, a failed step is resumed : the previous steps are not done again
+    run_steps([
+        ("wait for closed", lambda: permanence.set_status(
+            old_status=(PERMANENCE_OPENED,), new_status=PERMANENCE_WAIT_FOR_CLOSED, everything=everything,
+            producers_id=producers_id,
+            deliveries_id=deliveries_id)),
+        ("close order", lambda: permanence.close_order(
+            everything=everything, producers_id=producers_id, deliveries_id=deliveries_id)),
+        ("closed", lambda: permanence.set_status(
+            old_status=(PERMANENCE_WAIT_FOR_CLOSED,), new_status=PERMANENCE_CLOSED, everything=everything,
+            producers_id=producers_id,
+            deliveries_id=deliveries_id)),
+        ("wait for send", lambda: permanence.set_status(
+            old_status=(PERMANENCE_CLOSED,), new_status=PERMANENCE_WAIT_FOR_SEND, everything=everything,
+            producers_id=producers_id,
+            deliveries_id=deliveries_id)),
+        ("recalculate order amount", lambda: permanence.recalculate_order_amount(send_to_producer=True)),
+        ("reorder purchases", lambda: reorder_purchases(permanence.id)),
+        ("send mails", lambda: email_order.email_order(
+            permanence.id, everything=everything, producers_id=producers_id, deliveries_id=deliveries_id)),
+        ("send", lambda: permanence.set_status(
+            old_status=(PERMANENCE_WAIT_FOR_SEND,), new_status=PERMANENCE_SEND, everything=everything,
+            producers_id=producers_id,
+            deliveries_id=deliveries_id)),
+    ], job)
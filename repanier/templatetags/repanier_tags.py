@@ -8,12 +8,11 @@ from django.utils.safestring import mark_safe
 from django.utils.translation import ugettext_lazy as _
 
 from repanier.const import EMPTY_STRING, PERMANENCE_CLOSED, DECIMAL_ZERO, PERMANENCE_OPENED
-from repanier.models.customer import Customer
-from repanier.models.invoice import CustomerInvoice, ProducerInvoice
+from repanier.customer_context import get_customer_context
+from repanier.models.invoice import CustomerInvoice
 from repanier.models.offeritem import OfferItemWoReceiver
 from repanier.models.permanenceboard import PermanenceBoard
 from repanier.models.producer import Producer
-from repanier.models.purchase import PurchaseWoReceiver
 from repanier.tools import sint, get_html_selected_value, get_html_selected_box_value
 
 register = template.Library()
@@ -161,8 +160,8 @@ def repanier_select_task(context, *args, **kwargs):
     request = context['request']
     user = request.user
     result = EMPTY_STRING
-    customer_is_active = Customer.objects.filter(user_id=user.id, is_active=True).order_by('?').exists()
-    if customer_is_active:
+    customer_context = get_customer_context(request)
+    if customer_context.is_active:
         p_task_id = sint(kwargs.get('task_id', 0))
         if p_task_id > 0:
             permanence_board = PermanenceBoard.objects.filter(id=p_task_id).select_related(
@@ -181,7 +180,7 @@ def repanier_select_task(context, *args, **kwargs):
                         </i></b>
                         """.format(
                             task_id=permanence_board.id,
-                            long_basket_name=user.customer.long_basket_name
+                            long_basket_name=customer_context.customer.long_basket_name
                         )
                     else:
                         result = """
@@ -206,7 +205,7 @@ def repanier_select_task(context, *args, **kwargs):
                             </i></b>
                             """.format(
                                 task_id=permanence_board.id,
-                                long_basket_name=user.customer.long_basket_name
+                                long_basket_name=customer_context.customer.long_basket_name
                             )
                         else:
                             result = """
@@ -223,9 +222,12 @@ def repanier_select_task(context, *args, **kwargs):
 @register.simple_tag(takes_context=True)
 def repanier_select_offer_item(context, *args, **kwargs):
     request = context['request']
-    user = request.user
     offer_item = kwargs.get('offer_item')
     date = kwargs.get('date', EMPTY_STRING)
+    # Prefetched by OrderView for the whole page, otherwise read once per request by the customer context
+    offer_item_state = context.get('offer_item_state')
+    if offer_item_state is None:
+        offer_item_state = get_customer_context(request).get_permanence_state(offer_item.permanence_id)
     result = []
     if offer_item.may_order:
         # Important : offer_item.permanences_dates_order is used to
@@ -234,24 +236,21 @@ def repanier_select_offer_item(context, *args, **kwargs):
         # 0   : No group needed
         # 1   : Master of a group
         # > 1 : Displayed with the master of the group (filtered in order_class.py)
-        select_offer_item(offer_item, result, user)
+        select_offer_item(offer_item, result, offer_item_state)
         if offer_item.permanences_dates_order == 1 and date == "all":
-            for sub_offer_item in OfferItemWoReceiver.objects.filter(
+            if "sub_offer_items" in offer_item_state:
+                sub_offer_item_qs = offer_item_state["sub_offer_items"].get(offer_item.product_id, [])
+            else:
+                sub_offer_item_qs = OfferItemWoReceiver.objects.filter(
                     permanence_id=offer_item.permanence_id,
                     product_id=offer_item.product_id,
                     permanences_dates_order__gt=1
-            ).order_by("permanences_dates_order"):
-                select_offer_item(sub_offer_item, result, user)
+                ).order_by("permanences_dates_order")
+            for sub_offer_item in sub_offer_item_qs:
+                select_offer_item(sub_offer_item, result, offer_item_state)
     if offer_item.is_box_content:
-        box_purchase = PurchaseWoReceiver.objects.filter(
-            customer_id=user.customer,
-            offer_item_id=offer_item.id,
-            is_box_content=True
-        ).order_by('?').only('quantity_ordered').first()
-        if box_purchase is None:
-            quantity_ordered = DECIMAL_ZERO
-        else:
-            quantity_ordered = box_purchase.quantity_ordered
+        box_purchase = offer_item_state["purchases"].get((offer_item.id, True))
+        quantity_ordered = DECIMAL_ZERO if box_purchase is None else box_purchase[0]
         html = get_html_selected_box_value(offer_item, quantity_ordered)
         result.append(
             "<select id=\"box_offer_item{id}\" name=\"box_offer_item{id}\" disabled class=\"form-control\">{option}</select>".format(
@@ -262,30 +261,19 @@ def repanier_select_offer_item(context, *args, **kwargs):
     return mark_safe(EMPTY_STRING.join(result))
 
 
-def select_offer_item(offer_item, result, user):
-    purchase = PurchaseWoReceiver.objects.filter(
-        customer_id=user.customer,
-        offer_item_id=offer_item.id,
-        is_box_content=False
-    ).order_by('?').only('quantity_ordered').first()
+def select_offer_item(offer_item, result, offer_item_state):
+    purchase = offer_item_state["purchases"].get((offer_item.id, False))
     if purchase is not None:
-        is_open = purchase.status == PERMANENCE_OPENED
-        html = get_html_selected_value(
-            offer_item,
-            purchase.quantity_ordered,
-            is_open=is_open
-        )
+        quantity_ordered, status = purchase
+        is_open = status == PERMANENCE_OPENED
     else:
-        is_open = ProducerInvoice.objects.filter(
-            permanence__offeritem=offer_item.id,
-            producer__offeritem=offer_item.id,
-            status=PERMANENCE_OPENED
-        ).order_by('?').exists()
-        html = get_html_selected_value(
-            offer_item,
-            DECIMAL_ZERO,
-            is_open=is_open
-        )
+        quantity_ordered = DECIMAL_ZERO
+        is_open = offer_item.producer_id in offer_item_state["open_producer_ids"]
+    html = get_html_selected_value(
+        offer_item,
+        quantity_ordered,
+        is_open=is_open
+    )
     if offer_item.permanences_dates_counter > 0:
         permanences_date = offer_item.get_html_permanences_dates
     else:
@@ -311,12 +299,14 @@ def repanier_btn_like(context, *args, **kwargs):
     request = context['request']
     user = request.user
     result = EMPTY_STRING
-    customer_is_active = Customer.objects.filter(user_id=user.id, is_active=True).order_by('?').exists()
-    if customer_is_active:
+    customer_context = get_customer_context(request)
+    if customer_context.is_active:
         offer_item = kwargs.get('offer_item', None)
         str_id = str(offer_item.id)
         result = "<br><span class=\"btn_like{str_id}\" style=\"cursor: pointer;\">{html}</span>".format(
             str_id=str_id,
-            html=offer_item.get_html_like(user)
+            html=offer_item.get_html_like(
+                user, is_liked=offer_item.product_id in customer_context.liked_product_ids
+            )
         )
     return mark_safe(result)
@@ -5,7 +5,48 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
-from django.test import TestCase
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import F
+from django.template import Context, Template
+from django.test import TestCase, RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from repanier.const import *
+from repanier.models.bankaccount import BankAccount
+from repanier.models.configuration import Configuration
+from repanier.models.customer import Customer
+from repanier.models.invoice import CustomerInvoice, CustomerProducerInvoice, ProducerInvoice
+from repanier.models.lut import LUT_DeliveryPoint
+from repanier.models.offeritem import OfferItem
+from repanier.models.permanence import Permanence
+from repanier.models.producer import Producer
+from repanier.models.product import Product
+from repanier.models.purchase import Purchase
+from repanier.tools import create_or_update_one_purchase, reorder_offer_items
+from repanier.views.order_class import OrderView
+from repanier.xlsx.export_tools import ExportContext, new_landscape_a4_sheet
+
+LOCMEM_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'KEY_FUNCTION': 'repanier.cache.make_key',
+    }
+}
+
+# The rows of order_form.html
+ORDER_PAGE_ROWS = Template(
+    "{% load repanier_tags %}"
+    "{% for offer in offeritem_list %}"
+    "{% repanier_btn_like offer_item=offer %}"
+    "{% repanier_select_offer_item offer_item=offer %}"
+    "{% endfor %}"
+)
 
 
 class SimpleTest(TestCase):
@@ -14,3 +55,320 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class OrderViewQueryCountTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        Configuration.init_repanier()
+        cls.customer = Customer.get_or_create_the_very_first_customer()
+        cls.producer = Producer.objects.create(
+            short_profile_name="Producer",
+            long_profile_name="Producer",
+            phone1="0"
+        )
+        cls.permanence = Permanence.objects.create(
+            permanence_date=timezone.now().date(),
+            status=PERMANENCE_OPENED
+        )
+        ProducerInvoice.objects.create(
+            permanence_id=cls.permanence.id,
+            producer_id=cls.producer.id,
+            status=PERMANENCE_OPENED
+        )
+
+    def add_offer_items(self, count):
+        for i in range(count):
+            product = Product.objects.create(
+                producer_id=self.producer.id,
+                long_name="Product {}".format(Product.objects.count())
+            )
+            product.get_or_create_offer_item(self.permanence)
+        OfferItem.objects.filter(permanence_id=self.permanence.id).update(is_active=True, may_order=True)
+        reorder_offer_items(self.permanence.id)
+
+    def get_order_context(self):
+        # Build the context of the order page, as OrderView does
+        cache.clear()
+        request = RequestFactory().get(reverse("order_view", args=(self.permanence.id,)))
+        request.user = self.customer.user
+        response = OrderView.as_view()(request, permanence_id=self.permanence.id)
+        return request, dict(response.context_data, request=request)
+
+    def get_order_page(self):
+        # Build the context of the order page, then render its rows
+        request, context = self.get_order_context()
+        return request, context, ORDER_PAGE_ROWS.render(Context(context))
+
+    def test_query_count_does_not_grow_with_the_page_size(self):
+        self.add_offer_items(2)
+        with CaptureQueriesContext(connection) as small_page:
+            _request, context, _html = self.get_order_page()
+        self.assertEqual(len(context["offeritem_list"]), 2)
+        self.add_offer_items(10)
+        with self.assertNumQueries(len(small_page)):
+            _request, context, _html = self.get_order_page()
+        self.assertEqual(len(context["offeritem_list"]), 12)
+
+    def test_rows_of_the_order_page_have_a_fixed_query_count(self):
+        self.add_offer_items(12)
+        with CaptureQueriesContext(connection) as order_page:
+            _request, context = self.get_order_context()
+            self.assertEqual(len(context["offeritem_list"]), 12)
+            # The rows only read the liked products of the customer
+            with self.assertNumQueries(1):
+                ORDER_PAGE_ROWS.render(Context(context))
+            # which are kept by the customer context of the request
+            with self.assertNumQueries(0):
+                ORDER_PAGE_ROWS.render(Context(context))
+        # The customer is read once for the view and all the rows
+        self.assertEqual(len([
+            query for query in order_page.captured_queries if 'FROM "repanier_customer"' in query["sql"]
+        ]), 1)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ExportContextQueryCountTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        Configuration.init_repanier()
+
+    def new_sheets(self, count):
+        wb = None
+        for i in range(count):
+            wb, _ws = new_landscape_a4_sheet(wb, "Sheet {}".format(i), EMPTY_STRING)
+        return wb
+
+    def test_query_count_does_not_grow_with_the_sheets(self):
+        with ExportContext():
+            # The responsible staff are created on first use
+            self.new_sheets(1)
+        with CaptureQueriesContext(connection) as one_sheet:
+            with ExportContext() as context:
+                self.new_sheets(1)
+        self.assertEqual(context.sheet_count, 1)
+        self.assertEqual(context.query_count, len(one_sheet))
+        with self.assertNumQueries(len(one_sheet)):
+            with ExportContext() as context:
+                self.new_sheets(10)
+        self.assertEqual(context.sheet_count, 10)
+        self.assertEqual(context.query_count, len(one_sheet))
+
+
+def get_amounts(qs, *fields):
+    return [[getattr(value, "amount", value) for value in row] for row in qs.order_by("id").values_list(*fields)]
+
+
+class PermanenceTotalsTest(TestCase):
+    # The totals recalculated in batch by recalculate_order_amount(re_init=True) must be the ones
+    # kept up to date by purchase_pre_save while the customers order
+
+    @classmethod
+    def setUpTestData(cls):
+        Configuration.init_repanier()
+        cls.customer = Customer.get_or_create_the_very_first_customer()
+        cls.permanence = Permanence.objects.create(
+            permanence_date=timezone.now().date(),
+            status=PERMANENCE_OPENED
+        )
+        cls.offer_items = []
+        for i, producer_values in enumerate((
+                # Paid at the selling price
+                {},
+                # Paid at the producer price
+                {"price_list_multiplier": Decimal("1.25")},
+                {"is_resale_price_fixed": True},
+        )):
+            producer = Producer.objects.create(
+                short_profile_name="Producer {}".format(i),
+                long_profile_name="Producer {}".format(i),
+                phone1="0",
+                **producer_values
+            )
+            for product_values in (
+                    {"order_unit": PRODUCT_ORDER_UNIT_PC, "unit_deposit": Decimal("0.10"), "vat_level": VAT_600},
+                    {"order_unit": PRODUCT_ORDER_UNIT_PC_KG, "order_average_weight": Decimal("0.5"),
+                     "vat_level": VAT_400},
+            ):
+                product = Product.objects.create(
+                    producer_id=producer.id,
+                    long_name="Product {}".format(Product.objects.count()),
+                    producer_unit_price=Decimal("2.35"),
+                    **product_values
+                )
+                cls.offer_items.append(product.get_or_create_offer_item(cls.permanence))
+
+    def order(self):
+        for quantity, offer_item in enumerate(self.offer_items, start=1):
+            create_or_update_one_purchase(self.customer.id, offer_item, q_order=Decimal(quantity), batch_job=True)
+
+    def get_totals(self):
+        permanence_id = self.permanence.id
+        return {
+            "offer_items": get_amounts(
+                OfferItem.objects.filter(permanence_id=permanence_id),
+                "quantity_invoiced", "total_purchase_with_tax", "total_selling_with_tax"
+            ),
+            "customer_invoices": get_amounts(
+                CustomerInvoice.objects.filter(permanence_id=permanence_id),
+                "total_price_with_tax", "total_vat", "total_deposit"
+            ),
+            "customer_producer_invoices": get_amounts(
+                CustomerProducerInvoice.objects.filter(permanence_id=permanence_id),
+                "total_purchase_with_tax", "total_selling_with_tax"
+            ),
+            "producer_invoices": get_amounts(
+                ProducerInvoice.objects.filter(permanence_id=permanence_id),
+                "total_price_with_tax", "total_vat", "total_deposit"
+            ),
+            "permanence": get_amounts(
+                Permanence.objects.filter(id=permanence_id),
+                "total_purchase_with_tax", "total_selling_with_tax", "total_purchase_vat", "total_selling_vat"
+            ),
+        }
+
+    def test_batch_gives_the_totals_of_the_signals(self):
+        self.order()
+        totals = self.get_totals()
+        self.assertNotEqual(totals["permanence"], [[DECIMAL_ZERO] * 4])
+        Permanence.objects.get(id=self.permanence.id).recalculate_order_amount(re_init=True)
+        self.assertEqual(self.get_totals(), totals)
+
+    def test_batch_saves_the_vat_level_of_the_offer_item(self):
+        self.order()
+        offer_item = OfferItem.objects.get(id=self.offer_items[0].id)
+        offer_item.vat_level = VAT_400
+        offer_item.save()
+        Permanence.objects.get(id=self.permanence.id).recalculate_order_amount(re_init=True)
+        purchase = Purchase.objects.get(offer_item_id=offer_item.id)
+        self.assertEqual(purchase.vat_level, VAT_400)
+        self.assertEqual(
+            purchase.customer_vat.amount,
+            (offer_item.customer_vat.amount * purchase.quantity_ordered).quantize(FOUR_DECIMALS)
+        )
+
+
+class PermanenceInvoiceTest(TestCase):
+    # invoice() calculates the deltas of the customer invoices, the balances and the stock of all the rows at once.
+    # They must be the ones calculated row per row by the models.
+
+    @classmethod
+    def setUpTestData(cls):
+        Configuration.init_repanier()
+        cls.customer = Customer.get_or_create_the_very_first_customer()
+        # A group, charged for the purchases of its members, with a shipping cost
+        cls.group = Customer.objects.create(
+            user=User.objects.create_user(username="Group", email="group@repanier.be", password="Group"),
+            short_basket_name="Group",
+            long_basket_name="Group",
+            phone1="0",
+            is_group=True,
+            price_list_multiplier=Decimal("1.10")
+        )
+        delivery_point = LUT_DeliveryPoint.objects.create(
+            short_name="Group",
+            customer_responsible=cls.group,
+            transport=Decimal("5"),
+            min_transport=Decimal("100")
+        )
+        cls.member = Customer.objects.create(
+            user=User.objects.create_user(username="Member", email="member@repanier.be", password="Member"),
+            short_basket_name="Member",
+            long_basket_name="Member",
+            phone1="0",
+            delivery_point=delivery_point
+        )
+        cls.permanence = Permanence.objects.create(
+            permanence_date=timezone.now().date(),
+            status=PERMANENCE_SEND,
+            with_delivery_point=True
+        )
+        cls.offer_items = []
+        for i, producer_values in enumerate((
+                # Delivered from the stock
+                {"manage_replenishment": True},
+                # Paid at the producer price
+                {"price_list_multiplier": Decimal("1.25")},
+        )):
+            producer = Producer.objects.create(
+                short_profile_name="Producer {}".format(i),
+                long_profile_name="Producer {}".format(i),
+                phone1="0",
+                **producer_values
+            )
+            product = Product.objects.create(
+                producer_id=producer.id,
+                long_name="Product {}".format(i),
+                producer_unit_price=Decimal("2.35"),
+                unit_deposit=Decimal("0.10"),
+                stock=Decimal("10"),
+                vat_level=VAT_600
+            )
+            cls.offer_items.append(product.get_or_create_offer_item(cls.permanence))
+        OfferItem.objects.filter(id=cls.offer_items[0].id).update(add_2_stock=Decimal("2"))
+
+    def invoice(self):
+        for customer in (self.customer, self.member):
+            for offer_item in self.offer_items:
+                create_or_update_one_purchase(
+                    customer.id, offer_item, status=PERMANENCE_SEND, q_order=Decimal("5"), batch_job=True
+                )
+        # The results of the models, row per row
+        customer_invoices = {}
+        customer_balances = {}
+        for customer_invoice in CustomerInvoice.objects.filter(
+                permanence_id=self.permanence.id,
+                customer_id=F('customer_charged_id')
+        ).select_related('customer'):
+            customer_invoice.calculate_delta_price()
+            customer_invoice.calculate_delta_transport()
+            customer_invoices[customer_invoice.id] = [
+                customer_invoice.total_price_with_tax.amount,
+                customer_invoice.delta_price_with_tax.amount,
+                customer_invoice.delta_vat.amount,
+                customer_invoice.delta_transport.amount
+            ]
+            customer_balances[customer_invoice.customer_id] = \
+                customer_invoice.customer.balance.amount - customer_invoice.get_total_price_with_tax().amount
+        offer_item_stocks = {}
+        for offer_item in OfferItem.objects.filter(permanence_id=self.permanence.id, manage_replenishment=True):
+            _invoiced_qty, taken_from_stock, _customer_qty = offer_item.get_producer_qty_stock_invoiced()
+            offer_item_stocks[offer_item.id] = offer_item.stock - taken_from_stock + offer_item.add_2_stock
+        Permanence.objects.get(id=self.permanence.id).invoice(payment_date=timezone.now().date())
+        return customer_invoices, customer_balances, offer_item_stocks
+
+    def test_invoice_gives_the_results_of_the_rows(self):
+        customer_invoices, customer_balances, offer_item_stocks = self.invoice()
+        self.assertEqual(len(customer_invoices), 2)
+        self.assertEqual({
+            customer_invoice.id: [
+                customer_invoice.total_price_with_tax.amount,
+                customer_invoice.delta_price_with_tax.amount,
+                customer_invoice.delta_vat.amount,
+                customer_invoice.delta_transport.amount
+            ] for customer_invoice in CustomerInvoice.objects.filter(id__in=customer_invoices)
+        }, customer_invoices)
+        self.assertEqual({
+            customer.id: customer.balance.amount for customer in Customer.objects.filter(id__in=customer_balances)
+        }, customer_balances)
+        self.assertEqual(
+            dict(OfferItem.objects.filter(id__in=offer_item_stocks).values_list("id", "new_stock")),
+            offer_item_stocks
+        )
+        # 10 in stock, 8 taken for the customers and 2 added to the stock
+        self.assertEqual(offer_item_stocks, {self.offer_items[0].id: Decimal("4")})
+
+    def test_invoice_charges_the_shipping_of_the_group(self):
+        customer_invoices, _customer_balances, _offer_item_stocks = self.invoice()
+        group_invoice = CustomerInvoice.objects.get(permanence_id=self.permanence.id, customer_id=self.group.id)
+        self.assertEqual(group_invoice.delta_transport.amount, Decimal("5"))
+        self.assertEqual(customer_invoices[group_invoice.id][3], group_invoice.delta_transport.amount)
+        self.assertEqual(
+            get_amounts(BankAccount.objects.filter(
+                permanence_id=self.permanence.id,
+                operation_status=BANK_PROFIT,
+                bank_amount_in=group_invoice.delta_transport.amount
+            ), "bank_amount_in", "bank_amount_out"),
+            [[Decimal("5"), DECIMAL_ZERO]]
+        )
@@ -1,15 +1,15 @@
 # -*- coding: utf-8
 import datetime
+import hashlib
 import json
 from urllib.request import urlopen
 
 from django.conf import settings
 from django.core import urlresolvers
-from django.core.cache import cache
 from django.db import transaction
-from django.db.models import F
+from django.db.models import F, Case, When, Value
 from django.http import Http404
-from django.template.loader import render_to_string
+from django.template.loader import get_template
 from django.utils import timezone
 from django.utils import translation
 from django.utils.datetime_safe import new_datetime
@@ -19,6 +19,7 @@ from django.utils.translation import ugettext_lazy as _
 from six import string_types
 
 from repanier import apps
+from repanier.cache import invalidate_cache, permanence_namespace
 from repanier.const import *
 from repanier.email.email import RepanierEmail
 
@@ -45,6 +46,35 @@ def next_row(query_iterator):
         return
 
 
+def bulk_update(model, rows, batch_size=BULK_UPDATE_BATCH_SIZE):
+    # Django 1.11 has no QuerySet.bulk_update : emulate it with one "UPDATE ... SET x = CASE id WHEN ..."
+    # per batch of rows. No signal is sent.
+    # rows = {id: {field_name: value, ...}, ...}
+    # A value may be an expression, i.e. F('balance') + delta
+    rows = list(rows.items())
+    for i in range(0, len(rows), batch_size):
+        batch = rows[i:i + batch_size]
+        field_names = set()
+        for _id, values in batch:
+            field_names.update(values.keys())
+        update_kwargs = {}
+        for field_name in field_names:
+            field = model._meta.get_field(field_name)
+            update_kwargs[field.attname] = Case(
+                *[When(
+                    id=row_id,
+                    then=values[field_name] if hasattr(values[field_name], 'resolve_expression') else Value(
+                        values[field_name].amount if isinstance(values[field_name], RepanierMoney) else values[
+                            field_name],
+                        output_field=field
+                    )
+                ) for row_id, values in batch if field_name in values],
+                default=F(field.attname),
+                output_field=field
+            )
+        model.objects.filter(id__in=[row_id for row_id, _values in batch]).order_by('?').update(**update_kwargs)
+
+
 def emails_of_testers():
     from repanier.models.staff import Staff
 
@@ -392,6 +422,40 @@ def get_html_selected_value(offer_item, quantity_ordered, is_open=True):
     return mark_safe(html)
 
 
+def get_order_select_displays(offer_item, unit_price_amount, q_min, q_step, q_alert):
+    # [(qty, display), ...] : the quantities of the order select of the offer item, from q_min to q_alert.
+    # Cached : the key contains everything the display depends on, so that a change of the price,
+    # the units or the stock gives another key.
+    from django.core.cache import cache
+
+    cache_key = "order_select_{}_{}".format(offer_item.id, hashlib.md5("|".join(str(value) for value in (
+        translation.get_language(), offer_item.order_unit, offer_item.order_average_weight,
+        unit_price_amount, q_min, q_step, q_alert
+    )).encode("utf-8")).hexdigest())
+    displays = cache.get(cache_key)
+    if displays is None:
+        displays = []
+        q_valid = q_min
+        # Limit to avoid too long selection list
+        while q_valid <= q_alert and len(displays) <= LIMIT_ORDER_QTY_ITEM:
+            displays.append((q_valid, offer_item.get_display(
+                qty=q_valid,
+                order_unit=offer_item.order_unit,
+                unit_price_amount=unit_price_amount,
+                for_order_select=True
+            )))
+            if q_valid < q_step:
+                # 1; 2; 4; 6; 8 ... q_min = 1; q_step = 2
+                # 0,5; 1; 2; 3 ... q_min = 0,5; q_step = 1
+                q_valid = q_step
+            else:
+                # 1; 2; 3; 4 ... q_min = 1; q_step = 1
+                # 0,125; 0,175; 0,225 ... q_min = 0,125; q_step = 0,50
+                q_valid = q_valid + q_step
+        cache.set(cache_key, displays)
+    return displays
+
+
 def get_html_selected_box_value(offer_item, quantity_ordered):
     # Select one purchase
     if quantity_ordered > DECIMAL_ZERO:
@@ -551,24 +615,31 @@ def create_or_update_one_cart_item(customer, offer_item_id, q_order=None, value_
             with transaction.atomic():
                 sid = transaction.savepoint()
                 # This code executes inside a transaction.
-                for content in BoxContent.objects.filter(
-                        box=offer_item.product_id
+                box_contents = list(BoxContent.objects.filter(
+                    box=offer_item.product_id
                 ).only(
                     "product_id", "content_quantity"
-                ).order_by('?'):
-                    box_offer_item = OfferItem.objects.filter(
-                        product_id=content.product_id,
+                ).order_by('?'))
+                # Read the offer items and the purchases of the whole box at once
+                box_offer_items = {
+                    box_offer_item.product_id: box_offer_item for box_offer_item in OfferItem.objects.filter(
+                        product_id__in=[content.product_id for content in box_contents],
                         permanence_id=offer_item.permanence_id
-                    ).order_by('?').select_related("producer").first()
+                    ).order_by('?').select_related("producer")
+                }
+                box_quantities_ordered = dict(Purchase.objects.filter(
+                    customer_id=customer.id,
+                    offer_item_id__in=[box_offer_item.id for box_offer_item in box_offer_items.values()],
+                    is_box_content=True
+                ).order_by('?').values_list(
+                    "offer_item_id", "quantity_ordered"
+                ))
+                for content in box_contents:
+                    box_offer_item = box_offer_items.get(content.product_id)
                     if box_offer_item is not None:
-                        # Select one purchase
-                        purchase = Purchase.objects.filter(
-                            customer_id=customer.id,
-                            offer_item_id=box_offer_item.id,
-                            is_box_content=True
-                        ).order_by('?').first()
-                        if purchase is not None:
-                            quantity_ordered = purchase.quantity_ordered + delta_q_order * content.content_quantity
+                        previous_quantity_ordered = box_quantities_ordered.get(box_offer_item.id)
+                        if previous_quantity_ordered is not None:
+                            quantity_ordered = previous_quantity_ordered + delta_q_order * content.content_quantity
                         else:
                             quantity_ordered = delta_q_order * content.content_quantity
                         if quantity_ordered < DECIMAL_ZERO:
@@ -638,60 +709,176 @@ def my_basket(is_order_confirm_send, order_amount):
     return json_dict
 
 
-def clean_offer_item(permanence, queryset, reset_add_2_stock=False):
+def set_offer_item_from_product(offer_item, product, producer, reset_add_2_stock=False):
+    offer_item.set_from(product)
+
+    offer_item.producer_pre_opening = producer.producer_pre_opening
+    offer_item.manage_production = producer.represent_this_buyinggroup
+    # Those offer_items not subjects to price modifications
+    offer_item.is_resale_price_fixed = producer.is_resale_price_fixed or product.is_box or product.order_unit >= PRODUCT_ORDER_UNIT_DEPOSIT
+    offer_item.price_list_multiplier = DECIMAL_ONE if offer_item.is_resale_price_fixed else producer.price_list_multiplier
+
+    offer_item.may_order = False
+    offer_item.manage_replenishment = False
+    if offer_item.contract is not None:
+        offer_item.may_order = len(offer_item.permanences_dates) > 0
+        # No stock limit if this is a contract (ie a pre-order)
+        offer_item.limit_order_quantity_to_stock = False
+        offer_item.manage_production = False
+        offer_item.producer_pre_opening = False
+    else:
+        if offer_item.order_unit < PRODUCT_ORDER_UNIT_DEPOSIT:
+            offer_item.may_order = product.is_into_offer
+            offer_item.manage_replenishment = producer.manage_replenishment
+
+    # The group must pay the VAT, so it's easier to allways have
+    # offer_item with VAT included
+    if producer.producer_price_are_wo_vat:
+        offer_item.producer_unit_price += offer_item.producer_vat
+    offer_item.producer_price_are_wo_vat = False
+
+    if reset_add_2_stock:
+        offer_item.add_2_stock = DECIMAL_ZERO
+
+
+def bulk_create_offer_items(permanence, product_queryset, reset_add_2_stock=False):
+    # Same result as product.get_or_create_offer_item(permanence, reset_add_2_stock) for each product
+    # of product_queryset, except the box contents, but with a number of queries independent of the
+    # number of products. The offer_item pre_save is not called : the prices are recalculated here.
+    from repanier.models.offeritem import OfferItem
+
     if permanence.status > PERMANENCE_SEND:
         # The purchases are already invoiced.
         # The offer item may not be modified any more
         raise ValueError("Not offer item may be created when permanece status > PERMANENCE_SEND")
-    for offer_item in queryset.select_related("producer", "product"):
-        product = offer_item.product
-        producer = offer_item.producer
-
-        offer_item.set_from(product)
-
-        offer_item.producer_pre_opening = producer.producer_pre_opening
-        offer_item.manage_production = producer.represent_this_buyinggroup
-        # Those offer_items not subjects to price modifications
-        offer_item.is_resale_price_fixed = producer.is_resale_price_fixed or product.is_box or product.order_unit >= PRODUCT_ORDER_UNIT_DEPOSIT
-        offer_item.price_list_multiplier = DECIMAL_ONE if offer_item.is_resale_price_fixed else producer.price_list_multiplier
-
-        offer_item.may_order = False
-        offer_item.manage_replenishment = False
-        if offer_item.contract is not None:
-            offer_item.may_order = len(offer_item.permanences_dates) > 0
-            # No stock limit if this is a contract (ie a pre-order)
-            offer_item.limit_order_quantity_to_stock = False
-            offer_item.manage_production = False
-            offer_item.producer_pre_opening = False
+    products = {product.id: product for product in product_queryset.select_related("producer")}
+    existing_offer_item_qs = OfferItem.objects.filter(
+        permanence_id=permanence.id,
+        product_id__in=products.keys(),
+        permanences_dates=EMPTY_STRING
+    ).order_by('?')
+    existing_product_ids = set(existing_offer_item_qs.values_list("product_id", flat=True))
+    if len(existing_product_ids) > 0:
+        if reset_add_2_stock:
+            existing_offer_item_qs.update(contract=None, permanences_dates_order=0, may_order=True)
         else:
-            if offer_item.order_unit < PRODUCT_ORDER_UNIT_DEPOSIT:
-                offer_item.may_order = product.is_into_offer
-                offer_item.manage_replenishment = producer.manage_replenishment
+            existing_offer_item_qs.update(contract=None, permanences_dates_order=0)
 
-        # The group must pay the VAT, so it's easier to allways have
-        # offer_item with VAT included
-        if producer.producer_price_are_wo_vat:
-            offer_item.producer_unit_price += offer_item.producer_vat
-        offer_item.producer_price_are_wo_vat = False
+    new_offer_items = []
+    for product in products.values():
+        if product.id not in existing_product_ids:
+            offer_item = OfferItem(
+                permanence_id=permanence.id,
+                product_id=product.id,
+                producer_id=product.producer_id,
+                permanences_dates=EMPTY_STRING
+            )
+            set_offer_item_from_product(offer_item, product, product.producer, reset_add_2_stock=reset_add_2_stock)
+            offer_item.recalculate_prices(offer_item.producer_price_are_wo_vat, offer_item.is_resale_price_fixed,
+                                          offer_item.price_list_multiplier)
+            new_offer_items.append(offer_item)
+    if len(new_offer_items) == 0:
+        return
+    OfferItem.objects.bulk_create(new_offer_items, batch_size=BULK_UPDATE_BATCH_SIZE)
+
+    # Now got everything to calculate the translated fields
+    render_offer_item_cache_parts(OfferItem.objects.filter(
+        permanence_id=permanence.id,
+        product_id__in=[offer_item.product_id for offer_item in new_offer_items],
+        permanences_dates=EMPTY_STRING
+    ))
 
-        if reset_add_2_stock:
-            offer_item.add_2_stock = DECIMAL_ZERO
 
+def clean_offer_item(permanence, queryset, reset_add_2_stock=False):
+    if permanence.status > PERMANENCE_SEND:
+        # The purchases are already invoiced.
+        # The offer item may not be modified any more
+        raise ValueError("Not offer item may be created when permanece status > PERMANENCE_SEND")
+    for offer_item in queryset.select_related("producer", "product"):
+        set_offer_item_from_product(offer_item, offer_item.product, offer_item.producer,
+                                    reset_add_2_stock=reset_add_2_stock)
         offer_item.save()
 
     # Now got everything to calculate the sort order of the order display screen
+    render_offer_item_cache_parts(queryset)
+
+
+def get_offer_item_cache_part_hash(offer_item, long_name, template_source):
+    # Hash of everything cache_part_a.html and cache_part_b.html may display.
+    # The order totals are excluded : they change with each purchase but are not displayed.
+    values = [template_source, translation.get_language(), long_name]
+    for field in offer_item._meta.concrete_fields:
+        if field.name not in (
+                "quantity_invoiced", "total_purchase_with_tax", "total_selling_with_tax", "add_2_stock", "new_stock"
+        ):
+            values.append(getattr(offer_item, field.attname))
+    values.append(offer_item.producer.short_profile_name)
+    values.append(offer_item.product.offer_description)
+    if offer_item.department_for_customer is not None:
+        values.append(offer_item.department_for_customer.short_name)
+    for production_mode in offer_item.product.production_mode.all():
+        values.append(production_mode.short_name)
+        values.append(production_mode.picture2)
+    return hashlib.md5("|".join(str(value) for value in values).encode("utf-8")).hexdigest()
+
+
+def render_offer_item_cache_parts(offer_item_qs, force=False):
+    # Render cache_part_a and cache_part_b of the offer items in each language, by chunk,
+    # and bulk update the translations. The templates are loaded once.
+    # An offer item is only rendered again if the hash of its source fields changed, or if force.
+    # The search index of the offer items is refreshed as well, see repanier.search
+    from repanier.models.offeritem import OfferItem
+    from repanier.search import refresh_search_index
+
+    translation_model = OfferItem._parler_meta.root_model
+    template_a = get_template('repanier/cache_part_a.html')
+    template_b = get_template('repanier/cache_part_b.html')
+    template_source = template_a.template.source + template_b.template.source
+    offer_item_ids = list(offer_item_qs.order_by('?').values_list("id", flat=True))
     cur_language = translation.get_language()
     for language in settings.PARLER_LANGUAGES[settings.SITE_ID]:
-        translation.activate(language["code"])
-        for offer_item in queryset.select_related("producer", "department_for_customer"):
-            offer_item.long_name = offer_item.product.long_name
-            offer_item.cache_part_a = render_to_string('repanier/cache_part_a.html',
-                                                       {'offer': offer_item, 'MEDIA_URL': settings.MEDIA_URL})
-            offer_item.cache_part_b = render_to_string('repanier/cache_part_b.html',
-                                                       {'offer': offer_item, 'MEDIA_URL': settings.MEDIA_URL})
-            offer_item.save_translations()
-
+        language_code = language["code"]
+        translation.activate(language_code)
+        for chunk in range(0, len(offer_item_ids), BULK_UPDATE_BATCH_SIZE):
+            rows = {}
+            new_translations = []
+            for offer_item in OfferItem.objects.filter(
+                    id__in=offer_item_ids[chunk:chunk + BULK_UPDATE_BATCH_SIZE]
+            ).select_related(
+                "producer", "product", "department_for_customer"
+            ).prefetch_related(
+                "translations", "product__translations", "product__production_mode__translations",
+                "department_for_customer__translations"
+            ).order_by('?'):
+                offer_item_translation = None
+                for item_translation in offer_item.translations.all():
+                    if item_translation.language_code == language_code:
+                        offer_item_translation = item_translation
+                long_name = offer_item.product.long_name
+                cache_part_hash = get_offer_item_cache_part_hash(offer_item, long_name, template_source)
+                if not force and offer_item_translation is not None \
+                        and offer_item_translation.cache_part_hash == cache_part_hash:
+                    continue
+                offer_item.set_current_language(language_code)
+                offer_item.long_name = long_name
+                context = {'offer': offer_item, 'MEDIA_URL': settings.MEDIA_URL}
+                values = {
+                    "long_name": long_name,
+                    "cache_part_a": template_a.render(context),
+                    "cache_part_b": template_b.render(context),
+                    "cache_part_hash": cache_part_hash
+                }
+                if offer_item_translation is None:
+                    new_translations.append(translation_model(
+                        master_id=offer_item.id, language_code=language_code, **values
+                    ))
+                else:
+                    rows[offer_item_translation.id] = values
+            bulk_update(translation_model, rows)
+            translation_model.objects.bulk_create(new_translations)
     translation.activate(cur_language)
+    for chunk in range(0, len(offer_item_ids), BULK_UPDATE_BATCH_SIZE):
+        refresh_search_index(offer_item_ids=offer_item_ids[chunk:chunk + BULK_UPDATE_BATCH_SIZE])
 
 
 def reorder_purchases(permanence_id):
@@ -714,12 +901,16 @@ def reorder_purchases(permanence_id):
 
 def reorder_offer_items(permanence_id):
     from repanier.models.offeritem import OfferItemWoReceiver
+    from repanier.search import refresh_search_index
     # calculate the sort order of the order display screen
+    translation_model = OfferItemWoReceiver._parler_meta.root_model
     cur_language = translation.get_language()
     offer_item_qs = OfferItemWoReceiver.objects.filter(permanence_id=permanence_id).order_by('?')
     for language in settings.PARLER_LANGUAGES[settings.SITE_ID]:
         language_code = language["code"]
         translation.activate(language_code)
+        # {translation_id: {field_name: value, ...}, ...}
+        rows = {}
 
         i = 0
         reorder_queryset = offer_item_qs.filter(
@@ -731,10 +922,13 @@ def reorder_offer_items(permanence_id):
             "order_average_weight",
             "producer__short_profile_name",
             "permanences_dates_order"
-        )
-        for offer_item in reorder_queryset:
-            offer_item.producer_sort_order = offer_item.order_sort_order = offer_item.preparation_sort_order = i
-            offer_item.save_translations()
+        ).values_list("translations__id", flat=True)
+        for translation_id in reorder_queryset:
+            rows[translation_id] = {
+                "producer_sort_order": i,
+                "order_sort_order": i,
+                "preparation_sort_order": i
+            }
             if i < 9999:
                 i += 1
         # producer lists sort order : sort by reference if needed, otherwise sort by order_sort_order
@@ -746,10 +940,9 @@ def reorder_offer_items(permanence_id):
         ).order_by(
             "department_for_customer",
             "reference"
-        )
-        for offer_item in reorder_queryset:
-            offer_item.producer_sort_order = i
-            offer_item.save_translations()
+        ).values_list("translations__id", flat=True)
+        for translation_id in reorder_queryset:
+            rows.setdefault(translation_id, {})["producer_sort_order"] = i
             if i < 19999:
                 i += 1
         # preparation lists sort order
@@ -762,15 +955,22 @@ def reorder_offer_items(permanence_id):
             # "department_for_customer__lft",
             "unit_deposit",
             "translations__long_name"
-        )
+        ).values_list("translations__id", flat=True)
         # 'TranslatableQuerySet' object has no attribute 'desc'
-        for offer_item in reorder_queryset:
+        for translation_id in reorder_queryset:
             # display box on top
-            offer_item.producer_sort_order = offer_item.order_sort_order = offer_item.preparation_sort_order = i
-            offer_item.save_translations()
+            rows[translation_id] = {
+                "producer_sort_order": i,
+                "order_sort_order": i,
+                "preparation_sort_order": i
+            }
             if i < -1:
                 i += 1
+        bulk_update(translation_model, rows)
     translation.activate(cur_language)
+    refresh_search_index(permanence_id)
+    # The navigation of the order form, see repanier.facets
+    invalidate_cache(permanence_namespace(permanence_id))
 
 
 def update_offer_item(product_id=None, producer_id=None):
@@ -793,7 +993,7 @@ def update_offer_item(product_id=None, producer_id=None):
             ).order_by('?')
         clean_offer_item(permanence, offer_item_qs)
         permanence.recalculate_order_amount(offer_item_qs=offer_item_qs)
-    cache.clear()
+        invalidate_cache(permanence_namespace(permanence.id))
 
 
 def producer_web_services_activated(reference_site=None):
@@ -141,9 +141,9 @@ urlpatterns = [
     # url(r'^jsi18n/$', JavaScriptCatalog.as_view(), name='javascript-catalog'),
     url(r'^rest/permanences/$', permanences_rest, name='permanences_rest'),
     url(r'^rest/permanence/(?P<permanence_id>\d+)/(?P<producer_name>.*)/(?P<reference>.*)/$',
-        permanence_producer_product_rest,
+        never_cache(permanence_producer_product_rest),
         name='permanence_producer_product_rest'),
-    url(r'^rest/permanence/(?P<permanence_id>\d+)/(?P<producer_name>.*)/$', permanence_producer_rest,
+    url(r'^rest/permanence/(?P<permanence_id>\d+)/(?P<producer_name>.*)/$', never_cache(permanence_producer_rest),
         name='permanence_producer_rest'),
     url(r'^rest/departments-for-customers/$', departments_for_customers_rest, name='departments_for_customers_rest'),
     url(r'^rest/department-for-customer/(?P<short_name>.*)/$', department_for_customer_rest,
@@ -151,8 +151,8 @@ urlpatterns = [
     url(r'^rest/producers/$', producers_list, name='producers_rest'),
     url(r'^rest/producer/(?P<short_profile_name>.*)/$', producer_detail,
         name='producer_rest'),
-    url(r'^rest/products/(?P<producer_short_profile_name>.*)/$', products_rest, name='products_rest'),
-    url(r'^rest/product/(?P<producer_short_profile_name>.*)/(?P<reference>.*)/$', product_rest,
+    url(r'^rest/products/(?P<producer_short_profile_name>.*)/$', never_cache(products_rest), name='products_rest'),
+    url(r'^rest/product/(?P<producer_short_profile_name>.*)/(?P<reference>.*)/$', never_cache(product_rest),
         name='product_rest'),
     url(r'^rest/version/$', version_rest, name='version_rest'),
     url(r'^dowload-customer-invoice/(?P<customer_invoice_id>\d+)/$', download_customer_invoice,
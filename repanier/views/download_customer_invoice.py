@@ -10,6 +10,7 @@ from django.views.decorators.http import require_GET
 from repanier.apps import REPANIER_SETTINGS_GROUP_NAME
 from repanier.models.invoice import CustomerInvoice
 # from repanier.xlsx.xlsx_purchase import export_purchase
+from repanier.xlsx.export_tools import write_workbook
 from repanier.xlsx.xlsx_invoice import export_invoice
 
 
@@ -43,6 +44,6 @@ def download_customer_invoice(request, customer_invoice_id):
                 REPANIER_SETTINGS_GROUP_NAME
             )
             if wb is not None:
-                wb.save(response)
+                write_workbook(wb, response)
                 return response
     raise Http404
@@ -5,6 +5,7 @@ from django.http import Http404, JsonResponse
 from django.views.decorators.cache import never_cache
 from django.views.decorators.http import require_GET
 
+from repanier.customer_context import get_customer_context
 from repanier.models.offeritem import OfferItemWoReceiver
 from repanier.tools import sint
 
@@ -20,14 +21,8 @@ def like_ajax(request):
             if offer_item is not None and offer_item.product_id is not None:
                 product = offer_item.product
                 json_dict = {}
-                if product.likes.filter(id=user.id).exists():
-                    # user has already liked this company
-                    # remove like/user
-                    product.likes.remove(user)
-                else:
-                    # add a new like for a company
-                    product.likes.add(user)
-                like_html = offer_item.get_html_like(user)
+                is_liked = get_customer_context(request).toggle_like(product)
+                like_html = offer_item.get_html_like(user, is_liked=is_liked)
                 if settings.REPANIER_SETTINGS_CONTRACT:
                     for offer_item in OfferItemWoReceiver.objects.filter(product_id=product.id).only("id").order_by(
                             '?'):
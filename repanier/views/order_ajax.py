@@ -9,11 +9,10 @@ from django.views.decorators.cache import never_cache
 from django.views.decorators.http import require_GET
 
 from repanier.const import PERMANENCE_OPENED, DECIMAL_ZERO, EMPTY_STRING
+from repanier.customer_context import get_customer_context
 from repanier.models.box import BoxContent
-from repanier.models.customer import Customer
 from repanier.models.invoice import ProducerInvoice, CustomerInvoice
 from repanier.models.offeritem import OfferItemWoReceiver
-from repanier.models.permanence import Permanence
 from repanier.models.purchase import PurchaseWoReceiver
 from repanier.tools import create_or_update_one_cart_item, sint, sboolean, my_basket, get_html_selected_value, \
     get_html_selected_box_value, get_html_basket_message
@@ -25,107 +24,104 @@ from repanier.tools import create_or_update_one_cart_item, sint, sboolean, my_ba
 def order_ajax(request):
     if not request.is_ajax():
         raise Http404
-    user = request.user
-    customer = Customer.objects.filter(
-        user_id=user.id, may_order=True
-    ).order_by('?').first()
-    if customer is None:
+    customer = get_customer_context(request).customer
+    if customer is None or not customer.may_order:
         raise Http404
     offer_item_id = sint(request.GET.get('offer_item', 0))
     value_id = sint(request.GET.get('value', 0))
     is_basket = sboolean(request.GET.get('is_basket', False))
-    qs = CustomerInvoice.objects.filter(
+    json_dict = {}
+    # Fixed number of queries to read back the state, whatever the size of the box :
+    # only the fragments which may have changed are returned
+    customer_invoice = CustomerInvoice.objects.filter(
         permanence__offeritem=offer_item_id,
         customer_id=customer.id,
-        status=PERMANENCE_OPENED).order_by('?')
-    json_dict = {}
-    if qs.exists():
-        qs = ProducerInvoice.objects.filter(
-            permanence__offeritem=offer_item_id,
-            producer__offeritem=offer_item_id,
-            status=PERMANENCE_OPENED
-        ).order_by('?')
-        if qs.exists():
-            purchase, updated = create_or_update_one_cart_item(
-                customer=customer,
-                offer_item_id=offer_item_id,
-                value_id=value_id,
-                batch_job=False
-            )
-            offer_item = OfferItemWoReceiver.objects.filter(
-                id=offer_item_id
-            ).order_by('?').first()
-            if purchase is None:
-                json_dict["#offer_item{}".format(offer_item.id)] = get_html_selected_value(offer_item, DECIMAL_ZERO,
-                                                                                               is_open=True)
-            else:
-                json_dict["#offer_item{}".format(offer_item.id)] = get_html_selected_value(offer_item,
-                                                                                               purchase.quantity_ordered,
-                                                                                               is_open=True)
-            if updated and offer_item.is_box:
-                # update the content
-                for content in BoxContent.objects.filter(
-                        box=offer_item.product_id
-                ).only(
-                    "product_id"
-                ).order_by('?'):
-                    box_offer_item = OfferItemWoReceiver.objects.filter(
-                        product_id=content.product_id,
-                        permanence_id=offer_item.permanence_id
-                    ).order_by('?').first()
-                    if box_offer_item is not None:
-                        # Select one purchase
-                        purchase = PurchaseWoReceiver.objects.filter(
-                            customer_id=customer.id,
-                            offer_item_id=box_offer_item.id,
-                            is_box_content=False
-                        ).order_by('?').only('quantity_ordered').first()
-                        if purchase is not None:
-                            json_dict["#offer_item{}".format(box_offer_item.id)] = get_html_selected_value(
-                                box_offer_item,
-                                purchase.quantity_ordered,
-                                is_open=True
-                            )
-                        box_purchase = PurchaseWoReceiver.objects.filter(
-                            customer_id=customer.id,
-                            offer_item_id=box_offer_item.id,
-                            is_box_content=True
-                        ).order_by('?').only('quantity_ordered').first()
-                        if box_purchase is not None:
-                            json_dict["#box_offer_item{}".format(box_offer_item.id)] = get_html_selected_box_value(
-                                box_offer_item,
-                                box_purchase.quantity_ordered
-                            )
+        status=PERMANENCE_OPENED
+    ).select_related("permanence").order_by('?').first()
+    if customer_invoice is None:
+        return JsonResponse(json_dict)
+    permanence = customer_invoice.permanence
+    producer_invoice = ProducerInvoice.objects.filter(
+        permanence_id=permanence.id,
+        producer__offeritem=offer_item_id,
+        status=PERMANENCE_OPENED
+    ).select_related("producer").order_by('?').first()
+    if producer_invoice is None:
+        return JsonResponse(json_dict)
+    purchase, updated = create_or_update_one_cart_item(
+        customer=customer,
+        offer_item_id=offer_item_id,
+        value_id=value_id,
+        batch_job=False
+    )
+    offer_item = OfferItemWoReceiver.objects.filter(
+        id=offer_item_id
+    ).order_by('?').first()
+    if purchase is None:
+        json_dict["#offer_item{}".format(offer_item.id)] = get_html_selected_value(offer_item, DECIMAL_ZERO,
+                                                                                   is_open=True)
+    else:
+        json_dict["#offer_item{}".format(offer_item.id)] = get_html_selected_value(offer_item,
+                                                                                   purchase.quantity_ordered,
+                                                                                   is_open=True)
+    if updated and offer_item.is_box:
+        # update the content
+        box_offer_items = list(OfferItemWoReceiver.objects.filter(
+            permanence_id=offer_item.permanence_id,
+            product_id__in=BoxContent.objects.filter(
+                box=offer_item.product_id
+            ).order_by('?').values("product_id")
+        ).order_by('?'))
+        purchases = {}
+        for box_purchase in PurchaseWoReceiver.objects.filter(
+                customer_id=customer.id,
+                offer_item_id__in=[box_offer_item.id for box_offer_item in box_offer_items]
+        ).order_by('?').only("offer_item_id", "is_box_content", "quantity_ordered"):
+            purchases[(box_purchase.offer_item_id, box_purchase.is_box_content)] = box_purchase.quantity_ordered
+        for box_offer_item in box_offer_items:
+            quantity_ordered = purchases.get((box_offer_item.id, False))
+            if quantity_ordered is not None:
+                json_dict["#offer_item{}".format(box_offer_item.id)] = get_html_selected_value(
+                    box_offer_item,
+                    quantity_ordered,
+                    is_open=True
+                )
+            quantity_ordered = purchases.get((box_offer_item.id, True))
+            if quantity_ordered is not None:
+                json_dict["#box_offer_item{}".format(box_offer_item.id)] = get_html_selected_box_value(
+                    box_offer_item,
+                    quantity_ordered
+                )
 
-            if settings.REPANIER_SETTINGS_SHOW_PRODUCER_ON_ORDER_FORM:
-                producer_invoice = ProducerInvoice.objects.filter(
-                    producer_id=offer_item.producer_id, permanence_id=offer_item.permanence_id
-                ).only("total_price_with_tax").order_by('?').first()
-                json_dict.update(producer_invoice.get_order_json())
+    if settings.REPANIER_SETTINGS_SHOW_PRODUCER_ON_ORDER_FORM:
+        producer_invoice.refresh_from_db(fields=["total_price_with_tax", "status"])
+        json_dict.update(producer_invoice.get_order_json())
 
-            customer_invoice = CustomerInvoice.objects.filter(
-                permanence_id=offer_item.permanence_id,
-                customer_id=customer.id
-            ).order_by('?').first()
-            status_changed = customer_invoice.cancel_confirm_order()
-            if settings.REPANIER_SETTINGS_CUSTOMER_MUST_CONFIRM_ORDER and status_changed:
-                html = render_to_string(
-                    'repanier/communication_confirm_order.html')
-                json_dict["#communicationModal"] = mark_safe(html)
-            customer_invoice.save()
-            json_dict.update(
-                my_basket(customer_invoice.is_order_confirm_send, customer_invoice.get_total_price_with_tax()))
-            permanence = Permanence.objects.filter(
-                id=offer_item.permanence_id
-            ).order_by('?').first()
+    customer_invoice = CustomerInvoice.objects.filter(
+        id=customer_invoice.id
+    ).select_related("customer", "delivery").order_by('?').first()
+    status_changed = customer_invoice.cancel_confirm_order()
+    if status_changed:
+        # Do not save the whole invoice : the totals are updated concurrently by the purchases
+        CustomerInvoice.objects.filter(id=customer_invoice.id).order_by('?').update(
+            is_order_confirm_send=False
+        )
+        if settings.REPANIER_SETTINGS_CUSTOMER_MUST_CONFIRM_ORDER:
+            html = render_to_string(
+                'repanier/communication_confirm_order.html')
+            json_dict["#communicationModal"] = mark_safe(html)
+    json_dict.update(
+        my_basket(customer_invoice.is_order_confirm_send, customer_invoice.get_total_price_with_tax()))
 
-            if is_basket:
-                basket_message = get_html_basket_message(customer, permanence, PERMANENCE_OPENED)
-            else:
-                basket_message = EMPTY_STRING
-            json_dict.update(customer_invoice.get_html_my_order_confirmation(
-                permanence=permanence,
-                is_basket=is_basket,
-                basket_message=basket_message
-            ))
+    if is_basket or status_changed:
+        # Out of the basket, the confirmation part only changes with the confirmation status
+        if is_basket:
+            basket_message = get_html_basket_message(customer, permanence, PERMANENCE_OPENED)
+        else:
+            basket_message = EMPTY_STRING
+        json_dict.update(customer_invoice.get_html_my_order_confirmation(
+            permanence=permanence,
+            is_basket=is_basket,
+            basket_message=basket_message
+        ))
     return JsonResponse(json_dict)
@@ -7,13 +7,14 @@ from django.utils import translation
 from django.views.generic import ListView
 
 from repanier.const import EMPTY_STRING
+from repanier.customer_context import get_customer_context
+from repanier.facets import get_order_facets, get_offer_departments, department_has_offer
 from repanier.models.box import BoxContent
-from repanier.models.customer import Customer
 from repanier.models.lut import LUT_DepartmentForCustomer
 from repanier.models.offeritem import OfferItemWoReceiver
 from repanier.models.permanence import Permanence
-from repanier.models.producer import Producer
 from repanier.models.staff import Staff
+from repanier.search import search_offer_items
 from repanier.tools import sint, permanence_ok_or_404, html_box_content
 
 
@@ -66,14 +67,13 @@ class OrderView(ListView):
                 else:
                     self.date_id = date_id
                     self.date_selected = self.all_dates[date_id]
-        customer_may_order = Customer.objects.filter(user_id=self.user.id, is_active=True).order_by('?').exists()
-        if self.user.is_anonymous or not customer_may_order:
+        customer_context = get_customer_context(request)
+        if self.user.is_anonymous or not customer_context.is_active:
             self.is_anonymous = True
             self.may_order = False
         else:
             self.is_anonymous = False
-            customer = self.user.customer
-            self.may_order = customer.may_order if customer is not None else False
+            self.may_order = customer_context.may_order
         self.q = self.request.GET.get('q', None)
         if not self.q:
             self.producer_id = self.request.GET.get('producer', 'all')
@@ -110,38 +110,11 @@ class OrderView(ListView):
                                           not REPANIER_SETTINGS_NOTIFICATION.notification_is_public  else \
             REPANIER_SETTINGS_NOTIFICATION.safe_translation_getter('notification', any_language=True)
         if self.first_page:
-            if settings.REPANIER_SETTINGS_SHOW_PRODUCER_ON_ORDER_FORM:
-                producer_set = Producer.objects.filter(permanence=self.permanence.id).only("id", "short_profile_name")
-            else:
-                producer_set = None
-            context['producer_set'] = producer_set
-            if self.producer_id == 'all':
-                department_set = LUT_DepartmentForCustomer.objects.filter(
-                    offeritem__permanence_id=self.permanence.id,
-                    offeritem__is_active=True,
-                    offeritem__is_box=False) \
-                    .order_by("tree_id", "lft") \
-                    .distinct("id", "tree_id", "lft")
-            else:
-                department_set = LUT_DepartmentForCustomer.objects.filter(
-                    offeritem__producer_id=self.producer_id,
-                    offeritem__permanence_id=self.permanence.id,
-                    offeritem__is_active=True,
-                    offeritem__is_box=False) \
-                    .order_by("tree_id", "lft") \
-                    .distinct("id", "tree_id", "lft")
-            context['department_set'] = department_set
-            context['box_set'] = OfferItemWoReceiver.objects.filter(
-                permanence_id=self.permanence.id,
-                is_box=True,
-                is_active=True,
-                may_order=True,
-                translations__language_code=translation.get_language()
-            ).order_by(
-                'customer_unit_price',
-                'unit_deposit',
-                'translations__long_name',
-            )
+            # Calculated once per permanence, see repanier.facets
+            facets = get_order_facets(self.permanence.id, self.producer_id)
+            context['producer_set'] = facets["producers"]
+            context['department_set'] = facets["departments"]
+            context['box_set'] = facets["boxes"]
             context['staff_order'] = Staff.get_or_create_order_responsible()
             if self.is_anonymous:
                 context['how_to_register'] = REPANIER_SETTINGS_CONFIG.safe_translation_getter(
@@ -167,13 +140,41 @@ class OrderView(ListView):
 
         context['may_order'] = self.may_order
         context['display_anonymous_order_form'] = REPANIER_SETTINGS_DISPLAY_ANONYMOUS_ORDER_FORM
+        if self.may_order:
+            # Evaluate the page once, then prefetch what the repanier_select_offer_item tag needs
+            offer_item_list = list(context[self.context_object_name])
+            context[self.context_object_name] = offer_item_list
+            if context.get('page_obj') is not None:
+                context['page_obj'].object_list = offer_item_list
+            context['offer_item_state'] = self.get_offer_item_state(offer_item_list)
         return context
 
+    def get_offer_item_state(self, offer_item_list):
+        # Constant number of queries whatever the page size :
+        # - the sub offer items of the contracts (permanences_dates_order > 1)
+        # - the purchases of the customer and the producers whose invoice is still open,
+        #   shared with the other tags through the customer context
+        sub_offer_items = {}
+        master_product_ids = [
+            offer_item.product_id for offer_item in offer_item_list if offer_item.permanences_dates_order == 1
+        ]
+        if len(master_product_ids) > 0:
+            for sub_offer_item in OfferItemWoReceiver.objects.filter(
+                    permanence_id=self.permanence.id,
+                    product_id__in=master_product_ids,
+                    permanences_dates_order__gt=1
+            ).order_by("permanences_dates_order"):
+                sub_offer_items.setdefault(sub_offer_item.product_id, []).append(sub_offer_item)
+        offer_item_state = get_customer_context(self.request).get_permanence_state(self.permanence.id).copy()
+        offer_item_state["sub_offer_items"] = sub_offer_items
+        return offer_item_state
+
     def get_queryset(self):
         from repanier.apps import REPANIER_SETTINGS_DISPLAY_ANONYMOUS_ORDER_FORM
         if self.is_anonymous and \
                 (not REPANIER_SETTINGS_DISPLAY_ANONYMOUS_ORDER_FORM or self.is_basket or self.is_like):
             return OfferItemWoReceiver.objects.none()
+        ordering = ("translations__order_sort_order",)
         if self.is_box:
             offer_item = OfferItemWoReceiver.objects.filter(
                 id=self.box_id,
@@ -225,9 +226,12 @@ class OrderView(ListView):
                     )
                 )
                 if isinstance(self.date_id, int):
-                    qs = qs.filter(permanences_dates__contains=self.all_dates[self.date_id])
-                elif settings.REPANIER_SETTINGS_CONTRACT:
-                    qs = qs.filter(permanences_dates_order__lte=1)
+                    permanences_date = self.all_dates[self.date_id]
+                    qs = qs.filter(permanences_dates__contains=permanences_date)
+                else:
+                    permanences_date = 'all'
+                    if settings.REPANIER_SETTINGS_CONTRACT:
+                        qs = qs.filter(permanences_dates_order__lte=1)
                 if self.producer_id != 'all':
                     qs = qs.filter(producer_id=self.producer_id)
                 if self.department_id != 'all':
@@ -235,23 +239,22 @@ class OrderView(ListView):
                         id=self.department_id
                     ).order_by('?').only("lft", "rght", "tree_id").first()
                     if department is not None:
-                        tmp_qs = qs.filter(department_for_customer__lft__gte=department.lft,
+                        if department_has_offer(
+                                get_offer_departments(qs, self.permanence.id, self.producer_id, permanences_date),
+                                department
+                        ):
+                            # Restrict to this department only if a product exists in it
+                            qs = qs.filter(department_for_customer__lft__gte=department.lft,
                                            department_for_customer__rght__lte=department.rght,
                                            department_for_customer__tree_id=department.tree_id)
-                        if tmp_qs.exists():
-                            # Restrict to this department only if no product exists in it
-                            qs = tmp_qs
                         else:
                             # otherwise, act like self.department_id == 'all'
                             self.department_id = 'all'
             if self.q:
-                qs = qs.filter(
-                    translations__long_name__icontains=self.q,
-                    translations__language_code=translation.get_language()
-                )
-        qs = qs.order_by(
-            "translations__order_sort_order"
-        )
+                qs = search_offer_items(qs, self.q, translation.get_language())
+                # The best matches first
+                ordering = ("-search_rank",) + ordering
+        qs = qs.order_by(*ordering)
         if self.is_like:
-            qs = qs.filter(product__likes__id=self.user.id)
+            qs = qs.filter(product_id__in=get_customer_context(self.request).liked_product_ids)
         return qs.distinct()
@@ -8,13 +8,12 @@ from django.utils.translation import ugettext as _
 from django.views.decorators.cache import never_cache
 from django.views.decorators.http import require_GET
 
-from repanier.const import PERMANENCE_OPENED, PERMANENCE_SEND, LIMIT_ORDER_QTY_ITEM, DECIMAL_ZERO, \
-    EMPTY_STRING
-from repanier.models.customer import Customer
+from repanier.const import PERMANENCE_OPENED, PERMANENCE_SEND, DECIMAL_ZERO, EMPTY_STRING
+from repanier.customer_context import get_customer_context
 from repanier.models.invoice import ProducerInvoice, CustomerInvoice
 from repanier.models.offeritem import OfferItemWoReceiver
 from repanier.models.purchase import PurchaseWoReceiver
-from repanier.tools import sint, get_html_selected_value
+from repanier.tools import sint, get_html_selected_value, get_order_select_displays
 
 
 @never_cache
@@ -23,11 +22,8 @@ from repanier.tools import sint, get_html_selected_value
 def order_select_ajax(request):
     if not request.is_ajax():
         raise Http404
-    user = request.user
-    customer = Customer.objects.filter(
-        user_id=user.id, may_order=True) \
-        .only("id", "vat_id", "language").order_by('?').first()
-    if customer is None:
+    customer = get_customer_context(request).customer
+    if customer is None or not customer.may_order:
         raise Http404
     translation.activate(customer.language)
     offer_item_id = sint(request.GET.get('offer_item', 0))
@@ -92,10 +88,9 @@ def order_select_ajax(request):
                                 selected,
                                 _("Sold out")
                             )
-                    q_counter = 0  # Limit to avoid too long selection list
-                    while q_valid <= q_alert and q_counter <= LIMIT_ORDER_QTY_ITEM:
+                    # The displays are cached, only the selected option depends on the customer
+                    for q_valid, display in get_order_select_displays(offer_item, a_price, q_min, q_step, q_alert):
                         q_select_id += 1
-                        q_counter += 1
                         selected = EMPTY_STRING
                         if not q_order_is_displayed:
                             if q_previous_order <= q_valid:
@@ -103,25 +98,11 @@ def order_select_ajax(request):
                                 selected = "selected"
                         if (status == PERMANENCE_OPENED or
                                 (status <= PERMANENCE_SEND and selected == "selected")):
-                            display = offer_item.get_display(
-                                qty=q_valid,
-                                order_unit=offer_item.order_unit,
-                                unit_price_amount=a_price,
-                                for_order_select=True
-                            )
                             html += "<option value=\"{}\" {}>{}</option>".format(
                                 q_select_id,
                                 selected,
                                 display
                             )
-                        if q_valid < q_step:
-                            # 1; 2; 4; 6; 8 ... q_min = 1; q_step = 2
-                            # 0,5; 1; 2; 3 ... q_min = 0,5; q_step = 1
-                            q_valid = q_step
-                        else:
-                            # 1; 2; 3; 4 ... q_min = 1; q_step = 1
-                            # 0,125; 0,175; 0,225 ... q_min = 0,125; q_step = 0,50
-                            q_valid = q_valid + q_step
 
                     if not q_order_is_displayed:
                         # An custom order_qty > q_alert
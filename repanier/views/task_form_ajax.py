@@ -10,6 +10,7 @@ from django.views.decorators.cache import never_cache
 from django.views.decorators.http import require_GET
 
 from repanier.const import PERMANENCE_CLOSED, PERMANENCE_SEND, PERMANENCE_OPENED
+from repanier.customer_context import get_customer_context
 from repanier.models.permanenceboard import PermanenceBoard
 from repanier.tools import sint
 
@@ -20,9 +21,8 @@ from repanier.tools import sint
 def task_form_ajax(request):
     if not request.is_ajax():
         raise Http404
-    try:
-        customer = request.user.customer
-    except:
+    customer = get_customer_context(request).customer
+    if customer is None:
         raise Http404
     result = "ko"
     p_permanence_board_id = sint(request.GET.get('task', -1))
@@ -4,4 +4,6 @@ ROW_TITLE = 0
 ROW_WIDTH = 1
 ROW_VALUE = 2
 ROW_FORMAT = 3
-ROW_BOX = 4
\ No newline at end of file
+ROW_BOX = 4
+# Size above which a written workbook goes from memory to a temporary file
+XLSX_SPOOL_MAX_SIZE = 1024 * 1024
\ No newline at end of file
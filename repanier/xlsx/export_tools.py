@@ -1,12 +1,17 @@
 # -*- coding: utf-8
+import threading
+from functools import wraps
+from tempfile import SpooledTemporaryFile
 
 from django.contrib.sites.models import Site
+from django.db import connection
 from django.utils.text import slugify
 from django.utils.translation import ugettext_lazy as _
 from openpyxl.cell import get_column_letter
-from openpyxl.style import NumberFormat
+from openpyxl.style import NumberFormat, Style
 from openpyxl.styles import Border
 from openpyxl.workbook import Workbook
+from openpyxl.worksheet import Worksheet
 
 from repanier.const import EMPTY_STRING
 from repanier.models.staff import Staff
@@ -14,11 +19,179 @@ from repanier.tools import cap
 from repanier.xlsx.const import *
 
 
+# Styles shared by the cells of all the exported worksheets : {hash(style): read only style}
+_shared_styles = {}
+
+
+def get_shared_style(style):
+    key = hash(style)
+    shared_style = _shared_styles.get(key)
+    if shared_style is None:
+        shared_style = style.copy()
+        # openpyxl gives a private copy of a static style to "cell.style"
+        shared_style.static = True
+        shared_style = _shared_styles.setdefault(key, shared_style)
+    return shared_style
+
+
+def set_cell_style(cell, style):
+    cell.parent._styles[cell.get_coordinate()] = get_shared_style(style)
+
+
+class SharedStyleWorksheet(Worksheet):
+    # Keep one style object per distinct formatting instead of one per cell.
+    # The style of a cell is replaced by the shared one as soon as another cell is styled,
+    # "c.style.font.bold = True" still works : a shared style is copied before being changed.
+
+    def __init__(self, *args, **kwargs):
+        super(SharedStyleWorksheet, self).__init__(*args, **kwargs)
+        self._last_styled = None
+
+    def get_style(self, coordinate):
+        if coordinate != self._last_styled:
+            self.share_last_style()
+            self._last_styled = coordinate
+        return super(SharedStyleWorksheet, self).get_style(coordinate)
+
+    def share_last_style(self):
+        if self._last_styled is not None:
+            style = self._styles.get(self._last_styled)
+            if style is not None and not style.static:
+                self._styles[self._last_styled] = get_shared_style(style)
+            self._last_styled = None
+
+
+def new_workbook():
+    return Workbook(worksheet_class=SharedStyleWorksheet)
+
+
+def write_workbook(workbook, sink=None):
+    # Write the workbook into a file-like sink (an HttpResponse, a file, ...).
+    # Without sink, into a temporary file kept in memory while small, returned rewound.
+    for worksheet in workbook.worksheets:
+        if isinstance(worksheet, SharedStyleWorksheet):
+            worksheet.share_last_style()
+    if sink is None:
+        sink = SpooledTemporaryFile(max_size=XLSX_SPOOL_MAX_SIZE)
+        workbook.save(sink)
+        sink.seek(0)
+    else:
+        workbook.save(sink)
+    return sink
+
+
+HEADER_STYLE = Style()
+HEADER_STYLE.font.bold = True
+HEADER_STYLE.alignment.wrap_text = False
+HEADER_STYLE.borders.bottom.border_style = Border.BORDER_THIN
+HEADER_STYLE = get_shared_style(HEADER_STYLE)
+TEXT_STYLE = Style()
+TEXT_STYLE.number_format.format_code = NumberFormat.FORMAT_TEXT
+TEXT_STYLE = get_shared_style(TEXT_STYLE)
+
+
+_local = threading.local()
+
+
+class ExportContext(object):
+    # What the header and the footer of the sheets need, read once per export.
+    #
+    #   with ExportContext():
+    #       wb = export_...(...)
+    #       ...
+    #
+    # The sheet helpers use the given context, else the current one, else read everything for the sheet.
+    # Only the outermost context is active : a nested context joins it.
+    # query_count is the number of queries done to resolve the context, counted while the queries are logged
+    # (DEBUG or assertNumQueries), sheet_count the number of sheets set up.
+
+    def __init__(self):
+        self.is_resolved = False
+        self.is_outermost = False
+        self.query_count = 0
+        self.sheet_count = 0
+        self.site_name = None
+        self.orders_customer = None
+        self.invoices_customer = None
+        self.currency_xlsx = None
+        self.currency_display = None
+
+    @classmethod
+    def get_current(cls):
+        return getattr(_local, "context", None)
+
+    @classmethod
+    def get(cls, context=None):
+        if context is None:
+            context = ExportContext.get_current() or ExportContext()
+        context.resolve()
+        return context
+
+    def __enter__(self):
+        current = ExportContext.get_current()
+        if current is not None:
+            return current
+        self.is_outermost = True
+        _local.context = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.is_outermost:
+            _local.context = None
+            self.is_outermost = False
+
+    def resolve(self):
+        if self.is_resolved:
+            return
+        from repanier.apps import REPANIER_SETTINGS_CURRENCY_XLSX, REPANIER_SETTINGS_CURRENCY_DISPLAY
+
+        queries_logged = connection.queries_logged
+        if queries_logged:
+            initial_query_count = len(connection.queries_log)
+        self.site_name = Site.objects.get_current().name
+        orders_responsible = Staff.get_or_create_order_responsible()
+        if orders_responsible:
+            self.orders_customer = orders_responsible.customer_responsible
+        invoices_responsible = Staff.get_or_create_invoice_responsible()
+        if invoices_responsible:
+            self.invoices_customer = invoices_responsible.customer_responsible
+        if queries_logged:
+            self.query_count += len(connection.queries_log) - initial_query_count
+        self.currency_xlsx = REPANIER_SETTINGS_CURRENCY_XLSX
+        self.currency_display = REPANIER_SETTINGS_CURRENCY_DISPLAY
+        self.is_resolved = True
+
+    def get_right_header(self):
+        # In the active language
+        s1 = EMPTY_STRING
+        c = self.orders_customer
+        if c is not None:
+            s1 = "{}: {}, {}".format(_("Orders"), c.long_basket_name, c.phone1)
+        s2 = EMPTY_STRING
+        c = self.invoices_customer
+        if c is not None:
+            s2 = "{}: {}, {}".format(_("Invoices"), c.long_basket_name, c.phone1)
+        separator = chr(10) + " "
+        return separator.join((s1, s2))
+
+
+def export_in_context(function):
+    # Decorator : the sheets created by the function share one export context
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        with ExportContext():
+            return function(*args, **kwargs)
+
+    return wrapper
+
+
 def format_worksheet_title(title):
     return cap(slugify("{}".format(title)), 31)
 
 
-def worksheet_setup_a4(worksheet, title1, title2, add_print_title=True):
+def worksheet_setup_a4(worksheet, title1, title2, add_print_title=True, context=None):
+    context = ExportContext.get(context)
+    context.sheet_count += 1
     worksheet.title = format_worksheet_title(title1)
     worksheet.page_setup.paperSize = worksheet.PAPERSIZE_A4
     worksheet.page_setup.fitToPage = True
@@ -28,60 +201,51 @@ def worksheet_setup_a4(worksheet, title1, title2, add_print_title=True):
     if add_print_title:
         worksheet.add_print_title(1, rows_or_cols='rows')
         worksheet.freeze_panes = 'A2'
-    worksheet.header_footer.left_header.text = Site.objects.get_current().name
+    worksheet.header_footer.left_header.text = context.site_name
     worksheet.header_footer.left_footer.text = "{}".format(title2)
     worksheet.header_footer.center_footer.text = "{}".format(title1)
     worksheet.header_footer.right_footer.text = 'Page &[Page]/&[Pages]'
-    orders_responsible = Staff.get_or_create_order_responsible()
-    invoices_responsible = Staff.get_or_create_invoice_responsible()
-    s1 = EMPTY_STRING
-    if orders_responsible:
-        c = orders_responsible.customer_responsible
-        if c is not None:
-            s1 = "{}: {}, {}".format(_("Orders"), c.long_basket_name, c.phone1)
-    s2 = EMPTY_STRING
-    if invoices_responsible:
-        c = invoices_responsible.customer_responsible
-        if c is not None:
-            s2 = "{}: {}, {}".format(_("Invoices"), c.long_basket_name, c.phone1)
-    separator = chr(10) + " "
-    worksheet.header_footer.right_header.text = separator.join((s1, s2))
+    worksheet.header_footer.right_header.text = context.get_right_header()
     return worksheet
 
 
-def worksheet_setup_portrait_a4(worksheet, title1, title2, add_print_title=True):
-    worksheet = worksheet_setup_a4(worksheet, title1, title2, add_print_title)
+def worksheet_setup_portrait_a4(worksheet, title1, title2, add_print_title=True, context=None):
+    worksheet = worksheet_setup_a4(worksheet, title1, title2, add_print_title, context)
     worksheet.page_setup.orientation = worksheet.ORIENTATION_PORTRAIT
     return worksheet
 
 
-def new_portrait_a4_sheet(workbook, title1, title2, header=None, add_print_title=True):
+def new_portrait_a4_sheet(workbook, title1, title2, header=None, add_print_title=True, context=None):
     if workbook is None:
-        workbook = Workbook()
+        workbook = new_workbook()
         worksheet = workbook.get_active_sheet()
     else:
         worksheet = workbook.create_sheet()
-    worksheet = worksheet_setup_portrait_a4(worksheet, title1, title2, add_print_title=add_print_title)
+    worksheet = worksheet_setup_portrait_a4(
+        worksheet, title1, title2, add_print_title=add_print_title, context=context
+    )
     if header is not None:
         worksheet_set_header(worksheet, header)
     return workbook, worksheet
 
 
-def worksheet_setup_landscape_a4(worksheet, title1, title2, add_print_title=True):
+def worksheet_setup_landscape_a4(worksheet, title1, title2, add_print_title=True, context=None):
     from repanier.apps import REPANIER_SETTINGS_XLSX_PORTRAIT
-    worksheet = worksheet_setup_a4(worksheet, title1, title2, add_print_title)
+    worksheet = worksheet_setup_a4(worksheet, title1, title2, add_print_title, context)
     worksheet.page_setup.orientation = worksheet.ORIENTATION_PORTRAIT \
         if REPANIER_SETTINGS_XLSX_PORTRAIT else worksheet.ORIENTATION_LANDSCAPE
     return worksheet
 
 
-def new_landscape_a4_sheet(workbook, title1, title2, header=None, add_print_title=True):
+def new_landscape_a4_sheet(workbook, title1, title2, header=None, add_print_title=True, context=None):
     if workbook is None:
-        workbook = Workbook()
+        workbook = new_workbook()
         worksheet = workbook.get_active_sheet()
     else:
         worksheet = workbook.create_sheet()
-    worksheet = worksheet_setup_landscape_a4(worksheet, title1, title2, add_print_title=add_print_title)
+    worksheet = worksheet_setup_landscape_a4(
+        worksheet, title1, title2, add_print_title=add_print_title, context=context
+    )
     if header is not None:
         worksheet_set_header(worksheet, header)
     return workbook, worksheet
@@ -91,22 +255,20 @@ def worksheet_set_header(worksheet, header):
     for col_num in range(len(header)):
         c = worksheet.cell(row=0, column=col_num)
         c.value = "{}".format(header[col_num][ROW_TITLE])
-        c.style.font.bold = True
-        c.style.alignment.wrap_text = False
-        c.style.borders.bottom.border_style = Border.BORDER_THIN
+        set_cell_style(c, HEADER_STYLE)
         worksheet.column_dimensions[get_column_letter(col_num + 1)].width = header[col_num][ROW_WIDTH]
         if header[col_num][ROW_TITLE] == _("Id"):
             worksheet.column_dimensions[get_column_letter(col_num + 1)].visible = False
 
 
-def get_validation_formula(wb=None, valid_values=None):
+def get_validation_formula(wb=None, valid_values=None, context=None):
     if valid_values:
 
         ws_dv_name = format_worksheet_title(_("Data validation"))
         ws_dv = wb.get_sheet_by_name(ws_dv_name)
         if ws_dv is None:
             ws_dv = wb.create_sheet(index=0)
-            worksheet_setup_landscape_a4(ws_dv, ws_dv_name, EMPTY_STRING)
+            worksheet_setup_landscape_a4(ws_dv, ws_dv_name, EMPTY_STRING, context=context)
         col_dv = 0
         c = ws_dv.cell(row=0, column=col_dv)
         while (c.value is not None) and (col_dv < 20):
@@ -118,7 +280,7 @@ def get_validation_formula(wb=None, valid_values=None):
         for v in valid_values:
             c = ws_dv.cell(row=row_num, column=col_dv)
             c.value = "{}".format(v)
-            c.style.number_format.format_code = NumberFormat.FORMAT_TEXT
+            set_cell_style(c, TEXT_STYLE)
             row_num += 1
         return "'{}'!${}$1:${}${}".format(ws_dv_name, col_letter_dv, col_letter_dv, row_num + 1)
     else:
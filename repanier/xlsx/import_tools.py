@@ -1,5 +1,7 @@
 # -*- coding: utf-8
 
+from openpyxl.cell import get_column_letter
+
 from repanier.models.customer import Customer
 from repanier.models.lut import LUT_DepartmentForCustomer
 from repanier.models.producer import Producer
@@ -38,6 +40,35 @@ def get_row(worksheet, header, row_num):
     return row
 
 
+def get_rows(worksheet, header):
+    # [(row_num, row), ...] of the non empty rows below the header, read in one pass.
+    # As with get_row, the sheet ends with 10 empty rows.
+    rows = []
+    if worksheet is not None and header:
+        highest_row = worksheet.get_highest_row()
+        if highest_row < 2:
+            return rows
+        empty_rows = 0
+        for row_num, cells in enumerate(worksheet.range(
+                "A2:{}{}".format(get_column_letter(len(header)), highest_row)
+        ), start=1):
+            row = {}
+            last_row = True
+            for col_header, c in zip(header, cells):
+                # Important c.value==0 : Python (or Python lib) mix 0 and None
+                if c.value is not None or c.value == 0:
+                    last_row = False
+                row[col_header] = None if c.data_type == c.TYPE_FORMULA else c.value
+            if last_row:
+                empty_rows += 1
+                if empty_rows >= 10:
+                    break
+            else:
+                empty_rows = 0
+                rows.append((row_num, row))
+    return rows
+
+
 def get_customer_2_id_dict():
     customer_2_id_dict = {}
     represent_this_buyinggroup = None
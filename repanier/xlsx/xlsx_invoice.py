@@ -6,7 +6,6 @@ from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 from openpyxl import load_workbook
 
-import repanier.apps
 from repanier.xlsx.export_tools import *
 from repanier.const import *
 from repanier.models import Configuration
@@ -16,18 +15,20 @@ from repanier.models.customer import Customer
 from repanier.models.invoice import ProducerInvoice
 from repanier.models.permanence import Permanence
 from repanier.models.producer import Producer
+from repanier.models.offeritem import OfferItem
 from repanier.models.product import Product
 from repanier.models.purchase import Purchase
 from repanier.tools import get_invoice_unit, get_reverse_invoice_unit, \
-    create_or_update_one_purchase, reorder_offer_items, reorder_purchases
+    bulk_create_offer_items, reorder_offer_items, reorder_purchases
 from repanier.xlsx.import_tools import get_customer_email_2_id_dict, \
-    get_header, get_row
+    get_header, get_rows
 
 
 def export_bank(permanence, wb=None, sheet_name=EMPTY_STRING):
     # Detail of bank movements for a permanence
+    context = ExportContext.get()
     wb, ws = new_landscape_a4_sheet(wb, "{} {}".format(_('Dashboard'), sheet_name),
-                                    permanence)
+                                    permanence, context=context)
 
     row_num = 0
 
@@ -75,11 +76,11 @@ def export_bank(permanence, wb=None, sheet_name=EMPTY_STRING):
 
         row = [
             (_('Name'), 40, customer.long_basket_name, NumberFormat.FORMAT_TEXT),
-            (_('Previous balance'), 15, balance_before, repanier.apps.REPANIER_SETTINGS_CURRENCY_XLSX),
-            (_('Cash in'), 10, bank_amount_in, repanier.apps.REPANIER_SETTINGS_CURRENCY_XLSX),
-            (_('Cash out'), 10, bank_amount_out, repanier.apps.REPANIER_SETTINGS_CURRENCY_XLSX),
-            (_('Prepared'), 10, prepared, repanier.apps.REPANIER_SETTINGS_CURRENCY_XLSX),
-            (_('Final balance'), 15, balance_after, repanier.apps.REPANIER_SETTINGS_CURRENCY_XLSX),
+            (_('Previous balance'), 15, balance_before, context.currency_xlsx),
+            (_('Cash in'), 10, bank_amount_in, context.currency_xlsx),
+            (_('Cash out'), 10, bank_amount_out, context.currency_xlsx),
+            (_('Prepared'), 10, prepared, context.currency_xlsx),
+            (_('Final balance'), 15, balance_after, context.currency_xlsx),
             (_('Name'), 20, customer.short_basket_name, NumberFormat.FORMAT_TEXT),
         ]
 
@@ -126,11 +127,11 @@ def export_bank(permanence, wb=None, sheet_name=EMPTY_STRING):
 
         row = [
             (_('Name'), 40, producer.long_profile_name, NumberFormat.FORMAT_TEXT),
-            (_('Previous balance'), 15, balance_before, repanier.apps.REPANIER_SETTINGS_CURRENCY_XLSX),
-            (_('Cash in'), 10, bank_amount_in, repanier.apps.REPANIER_SETTINGS_CURRENCY_XLSX),
-            (_('Cash out'), 10, bank_amount_out, repanier.apps.REPANIER_SETTINGS_CURRENCY_XLSX),
-            (_('Prepared'), 10, prepared, repanier.apps.REPANIER_SETTINGS_CURRENCY_XLSX),
-            (_('Final balance'), 15, balance_after, repanier.apps.REPANIER_SETTINGS_CURRENCY_XLSX),
+            (_('Previous balance'), 15, balance_before, context.currency_xlsx),
+            (_('Cash in'), 10, bank_amount_in, context.currency_xlsx),
+            (_('Cash out'), 10, bank_amount_out, context.currency_xlsx),
+            (_('Prepared'), 10, prepared, context.currency_xlsx),
+            (_('Final balance'), 15, balance_after, context.currency_xlsx),
             (_('Name'), 20, producer.short_profile_name, NumberFormat.FORMAT_TEXT),
         ]
 
@@ -161,22 +162,22 @@ def export_bank(permanence, wb=None, sheet_name=EMPTY_STRING):
     row_num += 1
     c = ws.cell(row=row_num, column=1)
     c.value = initial_bank_amount
-    c.style.number_format.format_code = repanier.apps.REPANIER_SETTINGS_CURRENCY_XLSX
+    c.style.number_format.format_code = context.currency_xlsx
     c = ws.cell(row=row_num, column=4)
     formula = "B{}+SUM(C{}:C{})-SUM(D{}:D{})".format(row_num + 1, 2, row_num - 1, 2, row_num - 1)
     c.value = '=' + formula
-    c.style.number_format.format_code = repanier.apps.REPANIER_SETTINGS_CURRENCY_XLSX
+    c.style.number_format.format_code = context.currency_xlsx
 
     row_num += 1
     c = ws.cell(row=row_num, column=4)
     formula = "SUM(F{}:F{})-SUM(F{}:F{})".format(2, row_break, row_break + 2, row_num - 2)
     c.value = '=' + formula
-    c.style.number_format.format_code = repanier.apps.REPANIER_SETTINGS_CURRENCY_XLSX
+    c.style.number_format.format_code = context.currency_xlsx
 
     row_num += 1
     c = ws.cell(row=row_num, column=4)
     c.value = final_bank_amount
-    c.style.number_format.format_code = repanier.apps.REPANIER_SETTINGS_CURRENCY_XLSX
+    c.style.number_format.format_code = context.currency_xlsx
 
     return wb
 
@@ -185,6 +186,7 @@ def export_invoice(permanence=None, year=None, customer=None, producer=None, wb=
     # Detail of what has been prepared
     from repanier.apps import REPANIER_SETTINGS_CONFIG
 
+    context = ExportContext.get()
     hide_producer_prices = False
     hide_customer_prices = False
     purchase_set = Purchase.objects.all()
@@ -200,7 +202,7 @@ def export_invoice(permanence=None, year=None, customer=None, producer=None, wb=
         hide_producer_prices = True
     if purchase_set.exists():
 
-        wb, ws = new_landscape_a4_sheet(wb, sheet_name, permanence)
+        wb, ws = new_landscape_a4_sheet(wb, sheet_name, permanence, context=context)
         row = []
         row_num = 0
         hide_column_deposit = True
@@ -224,7 +226,7 @@ def export_invoice(permanence=None, year=None, customer=None, producer=None, wb=
                 (_("Quantity"), 10, qty, '#,##0.????',
                  True if purchase.offer_item.order_unit == PRODUCT_ORDER_UNIT_PC_KG else False),
                 (_("Unit"), 10, unit, NumberFormat.FORMAT_TEXT, False),
-                (_("Deposit"), 10, purchase.offer_item.unit_deposit.amount, repanier.apps.REPANIER_SETTINGS_CURRENCY_XLSX,
+                (_("Deposit"), 10, purchase.offer_item.unit_deposit.amount, context.currency_xlsx,
                  False)]
             if hide_producer_prices:
                 row += [
@@ -235,11 +237,11 @@ def export_invoice(permanence=None, year=None, customer=None, producer=None, wb=
             else:
                 row += [
                     (_("Producer unit price"), 10, purchase.get_producer_unit_price(),
-                     repanier.apps.REPANIER_SETTINGS_CURRENCY_XLSX, False),
-                    (_("Purchase price"), 10, purchase.purchase_price.amount, repanier.apps.REPANIER_SETTINGS_CURRENCY_XLSX,
+                     context.currency_xlsx, False),
+                    (_("Purchase price"), 10, purchase.purchase_price.amount, context.currency_xlsx,
                      False),
                     (_("VAT"), 10, purchase.producer_vat.amount,
-                     repanier.apps.REPANIER_SETTINGS_CURRENCY_XLSX, False)
+                     context.currency_xlsx, False)
                 ]
 
             if hide_customer_prices:
@@ -251,11 +253,11 @@ def export_invoice(permanence=None, year=None, customer=None, producer=None, wb=
             else:
                 row += [
                     (_("Customer unit price"), 10, purchase.get_customer_unit_price(),
-                     repanier.apps.REPANIER_SETTINGS_CURRENCY_XLSX, False),
+                     context.currency_xlsx, False),
                     (_("Selling price"), 10, purchase.selling_price.amount,
-                     repanier.apps.REPANIER_SETTINGS_CURRENCY_XLSX, False),
+                     context.currency_xlsx, False),
                     (_("VAT"), 10, purchase.customer_vat.amount,
-                     repanier.apps.REPANIER_SETTINGS_CURRENCY_XLSX, False),
+                     context.currency_xlsx, False),
                 ]
             if hide_producer_prices and hide_customer_prices:
                 row += [
@@ -320,22 +322,22 @@ def export_invoice(permanence=None, year=None, customer=None, producer=None, wb=
                 if col_num == 9:
                     formula = "SUM(J{}:J{})".format(2, row_num)
                     c.value = '=' + formula
-                    c.style.number_format.format_code = repanier.apps.REPANIER_SETTINGS_CURRENCY_XLSX
+                    c.style.number_format.format_code = context.currency_xlsx
                     c.style.font.bold = True
                 if col_num == 10:
                     formula = "SUM(K{}:K{})".format(2, row_num)
                     c.value = '=' + formula
-                    c.style.number_format.format_code = repanier.apps.REPANIER_SETTINGS_CURRENCY_XLSX
+                    c.style.number_format.format_code = context.currency_xlsx
                     c.style.font.bold = True
                 if col_num == 12:
                     formula = "SUM(M{}:M{})".format(2, row_num)
                     c.value = '=' + formula
-                    c.style.number_format.format_code = repanier.apps.REPANIER_SETTINGS_CURRENCY_XLSX
+                    c.style.number_format.format_code = context.currency_xlsx
                     c.style.font.bold = True
                 if col_num == 13:
                     formula = "SUM(N{}:N{})".format(2, row_num)
                     c.value = '=' + formula
-                    c.style.number_format.format_code = repanier.apps.REPANIER_SETTINGS_CURRENCY_XLSX
+                    c.style.number_format.format_code = context.currency_xlsx
                     c.style.font.bold = True
             if customer is not None:
                 config = REPANIER_SETTINGS_CONFIG
@@ -357,90 +359,120 @@ def import_invoice_sheet(worksheet, invoice_reference=None,
                           customer_2_id_dict=None,
                           producer=None
                           ):
+    # The sheet is read in one pass and all the rows are checked before saving anything.
+    # Then the offer items and the purchases are created in bulk
+    # and the totals of the new permanence are calculated once.
     error = False
     error_msg = None
     header = get_header(worksheet)
     if header:
-        now = timezone.now().date()
         lut_reverse_vat = dict(LUT_ALL_VAT_REVERSE)
-        import_counter = 0
-        row_num = 1
-        sid = transaction.savepoint()
-        try:
-
-            permanence = Permanence.objects.create(
-                permanence_date=now,
-                short_name=invoice_reference,
-                status=PERMANENCE_SEND,
-                highest_status=PERMANENCE_SEND
-            )
-            permanence.producers.add(producer)
-            row = get_row(worksheet, header, row_num)
-            while row and not error:
+        errors = []
+        # product reference -> fields of the product, from the last row of this product
+        product_rows = {}
+        # [(customer_id, product_reference, quantity, comment), ...]
+        purchase_rows = []
+        for row_num, row in get_rows(worksheet, header):
+            try:
                 customer_name = row[_("Customer")]
                 if customer_name:
                     if customer_name in customer_2_id_dict:
                         customer_id = customer_2_id_dict[customer_name]
                     else:
-                        error = True
-                        error_msg = _("Row %(row_num)d : No valid customer") % {'row_num': row_num + 1}
-                        break
+                        errors.append(_("Row %(row_num)d : No valid customer") % {'row_num': row_num + 1})
+                        continue
                     product_reference = row[_("Reference")]
-                    unit = row[_("Unit")]
-                    order_unit = get_reverse_invoice_unit(unit)
-                    vat = row[_("VAT level")]
-                    vat_level = lut_reverse_vat[vat]
-                    product = Product.objects.filter(producer_id=producer.id, reference=product_reference).order_by('?').first()
-                    if product is None:
-                        product = Product.objects.create(
-                            producer=producer,
-                            reference=product_reference,
-                        )
-                    product.long_name = row[_("Product")]
-                    # The producer unit price is the imported customer unit price
-                    # If the group get a reduction, this one must be mentionned into the producer admin screen
-                    # into the "price_list_multiplier" field
-                    product.producer_unit_price = row[_("Customer unit price")]
-                    product.unit_deposit = row[_("Deposit")]
-                    product.order_unit = order_unit
-                    product.vat_level = vat_level
-                    product.wrapped = row[_("Wrapped")]
-                    product.save()
-                    qty_and_price_display = product.get_qty_and_price_display(customer_price=False)
-                    if product.long_name.endswith(qty_and_price_display):
-                        product.long_name = product.long_name[:-len(qty_and_price_display)]
-                        product.save()
-                    offer_item = product.get_or_create_offer_item(permanence, reset_add_2_stock=True)
-                    create_or_update_one_purchase(
-                        customer_id,
-                        offer_item,
-                        q_order=Decimal(row[_("Quantity")]),
-                        status=PERMANENCE_SEND,
-                        batch_job=True, is_box_content=False,
-                        comment=row[_("Comment")]
+                    product_rows[product_reference] = {
+                        "long_name": row[_("Product")],
+                        # The producer unit price is the imported customer unit price
+                        # If the group get a reduction, this one must be mentionned into the producer admin screen
+                        # into the "price_list_multiplier" field
+                        "producer_unit_price": row[_("Customer unit price")],
+                        "unit_deposit": row[_("Deposit")],
+                        "order_unit": get_reverse_invoice_unit(row[_("Unit")]),
+                        "vat_level": lut_reverse_vat[row[_("VAT level")]],
+                        "wrapped": row[_("Wrapped")]
+                    }
+                    purchase_rows.append(
+                        (customer_id, product_reference, Decimal(row[_("Quantity")]), row[_("Comment")])
                     )
-                    import_counter += 1
-
-                row_num += 1
-                row = get_row(worksheet, header, row_num)
-            reorder_offer_items(permanence.id)
-            reorder_purchases(permanence.id)
-
-        except KeyError as e:
-            # Missing field
-            error = True
-            error_msg = _("Row %(row_num)d : A required column is missing %(error_msg)s.") % {
-                'row_num': row_num + 1, 'error_msg': str(e)}
-        except Exception as e:
+            except KeyError as e:
+                # Missing field
+                errors.append(_("Row %(row_num)d : A required column is missing %(error_msg)s.") % {
+                    'row_num': row_num + 1, 'error_msg': str(e)})
+            except Exception as e:
+                errors.append(_("Row %(row_num)d : %(error_msg)s.") % {'row_num': row_num + 1, 'error_msg': str(e)})
+        if errors:
             error = True
-            error_msg = _("Row %(row_num)d : %(error_msg)s.") % {'row_num': row_num + 1, 'error_msg': str(e)}
-        if not error and import_counter == 0:
+            error_msg = " ".join("{}".format(msg) for msg in errors)
+        elif len(purchase_rows) == 0:
             error = True
             error_msg = "{}".format(_("Nothing to import."))
-        if error:
-            transaction.savepoint_rollback(sid)
         else:
-            transaction.savepoint_commit(sid)
+            now = timezone.now().date()
+            permanence = Permanence.objects.create(
+                permanence_date=now,
+                short_name=invoice_reference,
+                status=PERMANENCE_SEND,
+                highest_status=PERMANENCE_SEND
+            )
+            permanence.producers.add(producer)
+            products = {
+                product.reference: product for product in Product.objects.filter(
+                    producer_id=producer.id,
+                    reference__in=product_rows.keys()
+                ).order_by('?')
+            }
+            for product_reference, product_row in product_rows.items():
+                product = products.get(product_reference)
+                if product is None:
+                    product = Product.objects.create(
+                        producer=producer,
+                        reference=product_reference,
+                    )
+                    products[product_reference] = product
+                for field_name, value in product_row.items():
+                    setattr(product, field_name, value)
+                qty_and_price_display = product.get_qty_and_price_display(customer_price=False)
+                if product.long_name.endswith(qty_and_price_display):
+                    product.long_name = product.long_name[:-len(qty_and_price_display)]
+                product.save()
+            bulk_create_offer_items(
+                permanence,
+                Product.objects.filter(id__in=[product.id for product in products.values()]),
+                reset_add_2_stock=True
+            )
+            offer_items = {
+                offer_item.product_id: offer_item for offer_item in OfferItem.objects.filter(
+                    permanence_id=permanence.id
+                ).order_by('?')
+            }
+            customers = {
+                customer.id: customer for customer in Customer.objects.filter(
+                    id__in={customer_id for customer_id, _product_reference, _quantity, _comment in purchase_rows}
+                ).order_by('?')
+            }
+            # As create_or_update_one_purchase : the last quantity and all the comments of a pair
+            customer_offer_items = {}
+            quantities = {}
+            comments = {}
+            for customer_id, product_reference, quantity, comment in purchase_rows:
+                offer_item = offer_items[products[product_reference].id]
+                pair = (customer_id, offer_item.id)
+                customer_offer_items[pair] = (customers[customer_id], offer_item)
+                quantities[pair] = quantity
+                if comment:
+                    comments[pair] = "{}, {}".format(comments[pair], comment) if pair in comments else comment
+            permanence.bulk_create_or_update_purchases(
+                list(customer_offer_items.values()),
+                DECIMAL_ZERO,
+                status=PERMANENCE_SEND,
+                quantities=quantities,
+                comments=comments
+            )
+            reorder_offer_items(permanence.id)
+            reorder_purchases(permanence.id)
+            permanence.recalculate_order_amount(re_init=True)
     return error, error_msg
 
 
@@ -2,7 +2,6 @@
 
 from django.utils.translation import ugettext_lazy as _
 
-import repanier.apps
 from repanier.models import ContractContent
 from repanier.models.offeritem import OfferItem
 from repanier.models.producer import Producer
@@ -12,7 +11,8 @@ from repanier.xlsx.export_tools import *
 
 
 def export_offer(permanence, wb=None):
-    wb, ws = new_landscape_a4_sheet(wb, permanence, permanence)
+    context = ExportContext.get()
+    wb, ws = new_landscape_a4_sheet(wb, permanence, permanence, context=context)
     row_num = 0
 
     if permanence.status == PERMANENCE_PLANNED:
@@ -29,7 +29,7 @@ def export_offer(permanence, wb=None):
                 "department_for_customer",
                 "translations__long_name",
                 "order_average_weight"):
-                row_num = export_offer_row(product, row_num, ws)
+                row_num = export_offer_row(product, row_num, ws, context=context)
             for product in Product.objects.prefetch_related(
                     "producer", "department_for_customer").filter(
                 is_into_offer=True,
@@ -38,7 +38,7 @@ def export_offer(permanence, wb=None):
                 "customer_unit_price",
                 "unit_deposit",
                 "translations__long_name"):
-                row_num = export_offer_row(product, row_num, ws)
+                row_num = export_offer_row(product, row_num, ws, context=context)
         else:
             for contract_content in ContractContent.objects.prefetch_related(
                     "product", "product__producer", "product__department_for_customer").filter(
@@ -49,7 +49,8 @@ def export_offer(permanence, wb=None):
                 row_num = export_offer_row(
                     product, row_num, ws,
                     permanences_dates=contract_content.get_permanences_dates,
-                    flexible_dates=contract_content.flexible_dates
+                    flexible_dates=contract_content.flexible_dates,
+                    context=context
                 )
 
     elif permanence.status == PERMANENCE_OPENED:
@@ -63,13 +64,15 @@ def export_offer(permanence, wb=None):
         ):
             row_num = export_offer_row(
                 offer_item, row_num, ws,
-                permanences_dates=offer_item.get_permanences_dates
+                permanences_dates=offer_item.get_permanences_dates,
+                context=context
             )
 
     return wb
 
 
-def export_offer_row(product, row_num, ws, permanences_dates=EMPTY_STRING, flexible_dates=False):
+def export_offer_row(product, row_num, ws, permanences_dates=EMPTY_STRING, flexible_dates=False, context=None):
+    context = ExportContext.get(context)
     row = [
         (_("Producer"), 15, product.producer.short_profile_name, NumberFormat.FORMAT_TEXT, False),
         (_("Department"), 15,
@@ -79,11 +82,11 @@ def export_offer_row(product, row_num, ws, permanences_dates=EMPTY_STRING, flexi
         (_("Product"), 60, product.get_long_name(), NumberFormat.FORMAT_TEXT, False),
         (_("Producer unit price"), 10,
          product.producer_unit_price if product.producer_unit_price < product.customer_unit_price and not product.is_box else EMPTY_STRING,
-         repanier.apps.REPANIER_SETTINGS_CURRENCY_XLSX, False),
+         context.currency_xlsx, False),
         (_("Customer unit price"), 10, product.customer_unit_price,
-         repanier.apps.REPANIER_SETTINGS_CURRENCY_XLSX, False),
+         context.currency_xlsx, False),
         (_("Deposit"), 10, product.unit_deposit,
-         repanier.apps.REPANIER_SETTINGS_CURRENCY_XLSX, False),
+         context.currency_xlsx, False),
     ]
     if permanences_dates:
         row += [
@@ -1,6 +1,7 @@
 # -*- coding: utf-8
 
 from django.conf import settings
+from django.db.models import F
 from django.utils import translation
 from django.utils.translation import ugettext_lazy as _
 from openpyxl.style import Fill
@@ -16,7 +17,7 @@ from repanier.models.permanence import Permanence
 from repanier.models.permanenceboard import PermanenceBoard
 from repanier.models.producer import Producer
 from repanier.models.purchase import Purchase
-from repanier.tools import get_base_unit, next_row
+from repanier.tools import get_base_unit, next_row, bulk_update
 from repanier.xlsx.export_tools import *
 from .xlsx_stock import export_permanence_stock
 
@@ -26,12 +27,43 @@ def next_purchase(purchases):
     return purchase
 
 
+def get_purchase_stream(permanence, producer=None):
+    # All the purchases of the permanence, read with one query, in the order of the basket control :
+    # by customer, producer and product.
+    # The preparation and the producer exports regroup them in memory.
+    purchase_set = Purchase.objects.filter(
+        permanence_id=permanence.id,
+        offer_item__translations__language_code=translation.get_language()
+    )
+    if producer is not None:
+        purchase_set = purchase_set.filter(producer_id=producer.id)
+    purchases = list(purchase_set.annotate(
+        preparation_sort_order=F("offer_item__translations__preparation_sort_order"),
+        delivery_for_preparation_id=F("customer_invoice__delivery_id")
+    ).order_by(
+        "customer__short_basket_name",
+        "offer_item__producer",
+        "offer_item__translations__long_name",
+        "offer_item__order_average_weight",
+        "id"
+    ).select_related('customer', 'offer_item', 'offer_item__department_for_customer'))
+    customers = {}
+    offer_items = {}
+    customer_rank = {}
+    for purchase in purchases:
+        # Share the customers and the offer items, and so their translations cache, between the purchases
+        purchase.customer = customers.setdefault(purchase.customer_id, purchase.customer)
+        purchase.offer_item = offer_items.setdefault(purchase.offer_item_id, purchase.offer_item)
+        # Position of the customer into the "customer__short_basket_name" order
+        purchase.customer_rank = customer_rank.setdefault(purchase.customer_id, len(customer_rank))
+    return purchases
+
+
 def export_abstract(permanence, deliveries_id=(), group=False, wb=None):
+    context = ExportContext.get()
     if permanence is not None:
         row_num = 1
         # Customer info
-        Customer.objects.all().update(preparation_order=0)
-        preparation_order = 1
         if len(deliveries_id) > 0:
             header = [
                 (_('Delivery point'), 20),
@@ -41,56 +73,6 @@ def export_abstract(permanence, deliveries_id=(), group=False, wb=None):
                 (_('Total with vat'), 15),
                 (_('Email'), 35),
             ]
-            wb, ws = new_portrait_a4_sheet(wb, permanence, EMPTY_STRING, header=header, add_print_title=False)
-            for delivery_ref, delivery in enumerate(DeliveryBoard.objects.filter(id__in=deliveries_id).order_by("id")):
-                customer_set = Customer.objects.filter(
-                    customerinvoice__permanence_id=permanence.id,
-                    represent_this_buyinggroup=False,
-                    customerinvoice__delivery_id=delivery.id
-                )
-                for customer in customer_set:
-                    invoice = CustomerInvoice.objects.filter(
-                        permanence=permanence, customer=customer
-                    ).order_by('?').first()
-                    if invoice is not None and invoice.has_purchase:
-                        customer.preparation_order = preparation_order
-                        # customer.save(update_fields=['preparation_order'])
-                        # use vvvv because ^^^^^ will call "pre_save" function which reset valid_email to None
-                        Customer.objects.filter(id=customer.id).order_by('?').update(
-                            preparation_order=preparation_order
-                        )
-                        preparation_order += 1
-                        if settings.REPANIER_SETTINGS_CUSTOMER_MUST_CONFIRM_ORDER and not invoice.is_order_confirm_send:
-                            confirmed = "\n{}".format(_("⚠ This order isn't confirmed"))
-                        else:
-                            confirmed = EMPTY_STRING
-                        row = [
-                            "{} - {}".format(delivery_ref, delivery.get_delivery_display()),
-                            "  {} - {}{}".format(customer.preparation_order, customer.long_basket_name, confirmed),
-                            customer.phone1 or EMPTY_STRING,
-                            customer.phone2 or EMPTY_STRING,
-                            invoice.total_price_with_tax.amount,
-                            # Used to send mail to customer with an order (via copy-paste to mail)
-                            ";".join(
-                                [customer.user.email, customer.email2, EMPTY_STRING]
-                            ) if customer.email2 else ";".join(
-                                [customer.user.email, EMPTY_STRING]
-                            )
-                        ]
-                        for col_num in range(len(row)):
-                            c = ws.cell(row=row_num, column=col_num)
-                            c.value = "{}".format(row[col_num])
-                            if col_num == 4:
-                                c.style.number_format.format_code = repanier.apps.REPANIER_SETTINGS_CURRENCY_XLSX
-                            else:
-                                c.style.number_format.format_code = NumberFormat.FORMAT_TEXT
-                                if col_num == 0:
-                                    c.style.alignment.wrap_text = True
-                                else:
-                                    c.style.alignment.wrap_text = False
-                            if row_num % 2 == 0:
-                                c.style.borders.bottom.border_style = Border.BORDER_THIN
-                        row_num += 1
         else:
             header = [
                 (_("Basket"), 20),
@@ -100,54 +82,75 @@ def export_abstract(permanence, deliveries_id=(), group=False, wb=None):
                 (_('Total with vat'), 15),
                 (_('Email'), 35),
             ]
-            wb, ws = new_portrait_a4_sheet(wb, permanence, EMPTY_STRING, header=header, add_print_title=False)
-            customer_set = Customer.objects.filter(
-                customerinvoice__permanence_id=permanence.id,
-                represent_this_buyinggroup=False
+        wb, ws = new_portrait_a4_sheet(
+            wb, permanence, EMPTY_STRING, header=header, add_print_title=False, context=context
+        )
+        # The invoices of the customers, with the sums used by CustomerInvoice.has_purchase, in one query
+        invoice_set = CustomerInvoice.annotate_purchase_sums(CustomerInvoice.objects.filter(
+            permanence_id=permanence.id,
+            customer__represent_this_buyinggroup=False
+        )).select_related("customer", "customer__user")
+        deliveries = {}
+        if len(deliveries_id) > 0:
+            for delivery_ref, delivery in enumerate(DeliveryBoard.objects.filter(id__in=deliveries_id).order_by("id")):
+                deliveries[delivery.id] = (delivery_ref, delivery)
+            invoice_set = invoice_set.filter(delivery_id__in=deliveries_id).order_by(
+                "delivery_id", "customer__short_basket_name"
             )
-            for customer in customer_set:
-                invoice = CustomerInvoice.objects.filter(
-                    permanence=permanence, customer=customer
-                ).order_by('?').first()
-                if invoice is not None and invoice.has_purchase:
-                    customer.preparation_order = preparation_order
-                    # customer.save(update_fields=['preparation_order'])
-                    # use vvvv because ^^^^^ will call "pre_save" function which reset valid_email to None
-                    Customer.objects.filter(id=customer.id).order_by('?').update(
-                        preparation_order=preparation_order
-                    )
-                    preparation_order += 1
-                    if settings.REPANIER_SETTINGS_CUSTOMER_MUST_CONFIRM_ORDER and not invoice.is_order_confirm_send:
-                        confirmed = "\n{}".format(_("⚠ This order isn't confirmed"))
+        else:
+            invoice_set = invoice_set.order_by("customer__short_basket_name")
+        preparation_orders = {}
+        preparation_order = 1
+        for invoice in invoice_set:
+            customer = invoice.customer
+            if not invoice.has_purchase:
+                preparation_orders[customer.id] = {"preparation_order": 0}
+                continue
+            customer.preparation_order = preparation_order
+            preparation_orders[customer.id] = {"preparation_order": preparation_order}
+            preparation_order += 1
+            if settings.REPANIER_SETTINGS_CUSTOMER_MUST_CONFIRM_ORDER and not invoice.is_order_confirm_send:
+                confirmed = "\n{}".format(_("⚠ This order isn't confirmed"))
+            else:
+                confirmed = EMPTY_STRING
+            if len(deliveries_id) > 0:
+                delivery_ref, delivery = deliveries[invoice.delivery_id]
+                first_columns = [
+                    "{} - {}".format(delivery_ref, delivery.get_delivery_display()),
+                    "  {} - {}{}".format(customer.preparation_order, customer.long_basket_name, confirmed),
+                ]
+            else:
+                first_columns = [
+                    "{} - {}{}".format(customer.preparation_order, customer.long_basket_name, confirmed),
+                    customer.long_basket_name,
+                ]
+            row = first_columns + [
+                customer.phone1 or EMPTY_STRING,
+                customer.phone2 or EMPTY_STRING,
+                invoice.total_price_with_tax.amount,
+                # Used to send mail to customer with an order (via copy-paste to mail)
+                ";".join(
+                    [customer.user.email, customer.email2, EMPTY_STRING]
+                ) if customer.email2 else ";".join(
+                    [customer.user.email, EMPTY_STRING]
+                )
+            ]
+            for col_num in range(len(row)):
+                c = ws.cell(row=row_num, column=col_num)
+                c.value = "{}".format(row[col_num])
+                if col_num == 4:
+                    c.style.number_format.format_code = context.currency_xlsx
+                else:
+                    c.style.number_format.format_code = NumberFormat.FORMAT_TEXT
+                    if col_num == 0:
+                        c.style.alignment.wrap_text = True
                     else:
-                        confirmed = EMPTY_STRING
-                    row = [
-                        "{} - {}{}".format(customer.preparation_order, customer.long_basket_name, confirmed),
-                        customer.long_basket_name,
-                        customer.phone1 or EMPTY_STRING,
-                        customer.phone2 or EMPTY_STRING,
-                        invoice.total_price_with_tax.amount,
-                        # Used to send mail to customer with an order (via copy-paste to mail)
-                        ";".join(
-                            [customer.user.email, customer.email2, EMPTY_STRING]
-                        ) if customer.email2 else ";".join(
-                            [customer.user.email, EMPTY_STRING]
-                        )
-                    ]
-                    for col_num in range(len(row)):
-                        c = ws.cell(row=row_num, column=col_num)
-                        c.value = "{}".format(row[col_num])
-                        if col_num == 4:
-                            c.style.number_format.format_code = repanier.apps.REPANIER_SETTINGS_CURRENCY_XLSX
-                        else:
-                            c.style.number_format.format_code = NumberFormat.FORMAT_TEXT
-                            if col_num == 0:
-                                c.style.alignment.wrap_text = True
-                            else:
-                                c.style.alignment.wrap_text = False
-                        if row_num % 2 == 0:
-                            c.style.borders.bottom.border_style = Border.BORDER_THIN
-                    row_num += 1
+                        c.style.alignment.wrap_text = False
+                if row_num % 2 == 0:
+                    c.style.borders.bottom.border_style = Border.BORDER_THIN
+            row_num += 1
+        # use bulk_update and not save() which would call "pre_save" function which reset valid_email to None
+        bulk_update(Customer, preparation_orders)
 
         # Permanence board info
         permanence_date_save = None
@@ -280,7 +283,7 @@ def export_abstract(permanence, deliveries_id=(), group=False, wb=None):
                     c = ws.cell(row=row_num, column=col_num)
                     c.value = "{}".format(row[col_num])
                     if col_num == 4:
-                        c.style.number_format.format_code = repanier.apps.REPANIER_SETTINGS_CURRENCY_XLSX
+                        c.style.number_format.format_code = context.currency_xlsx
                     else:
                         c.style.number_format.format_code = NumberFormat.FORMAT_TEXT
                         c.style.alignment.wrap_text = False
@@ -293,7 +296,8 @@ def export_abstract(permanence, deliveries_id=(), group=False, wb=None):
 
 def export_customer_label(permanence, deliveries_id=(), wb=None):
     # Customer label
-    wb, ws = new_portrait_a4_sheet(wb, _('Label'), permanence, add_print_title=False)
+    context = ExportContext.get()
+    wb, ws = new_portrait_a4_sheet(wb, _('Label'), permanence, add_print_title=False, context=context)
     row_num = 0
     customer_set = Customer.objects.filter(
         customerinvoice__permanence_id=permanence.id,
@@ -379,7 +383,7 @@ def customer_label(customer_identifier, placements, row_num, ws):
     return row_num
 
 
-def export_preparation(permanence, deliveries_id=(), wb=None):
+def export_preparation(permanence, deliveries_id=(), wb=None, purchases=None):
     yellowFill = Fill()
     yellowFill.start_color.index = 'FFEEEE11'
     yellowFill.end_color.index = 'FFEEEE11'
@@ -398,28 +402,41 @@ def export_preparation(permanence, deliveries_id=(), wb=None):
         (_("Prepared"), 22),
         (_("To distribute"), 10),
     ]
+    if purchases is None:
+        purchases = get_purchase_stream(permanence)
+    producer_list = list(Producer.objects.filter(
+        producerinvoice__permanence_id=permanence.id
+    ).only('invoice_by_basket', 'represent_this_buyinggroup', 'short_profile_name').distinct())
     if len(deliveries_id) == 0:
-        return export_preparation_for_a_delivery(0, None, header, permanence, wb, yellowFill)
+        return export_preparation_for_a_delivery(
+            0, None, header, permanence, wb, yellowFill, producer_list, purchases
+        )
     else:
         for delivery_ref, delivery_id in enumerate(deliveries_id):
-            wb = export_preparation_for_a_delivery(delivery_ref, delivery_id, header, permanence, wb, yellowFill)
+            wb = export_preparation_for_a_delivery(
+                delivery_ref, delivery_id, header, permanence, wb, yellowFill, producer_list, purchases
+            )
         return wb
 
 
-def export_preparation_for_a_delivery(delivery_cpt, delivery_id, header, permanence, wb, yellowFill):
-    producer_set = Producer.objects.filter(
-        producerinvoice__permanence_id=permanence.id
-    ).only('invoice_by_basket', 'short_profile_name')
+def export_preparation_for_a_delivery(delivery_cpt, delivery_id, header, permanence, wb, yellowFill,
+                                      producer_list, purchases):
+    context = ExportContext.get()
+    purchases_of_producer = {}
+    for purchase in purchases:
+        if delivery_id is None or purchase.delivery_for_preparation_id == delivery_id:
+            purchases_of_producer.setdefault(purchase.producer_id, []).append(purchase)
     if delivery_id is not None:
-        producer_set = producer_set.filter(purchase__customer_invoice__delivery_id=delivery_id)
-    producers = producer_set.distinct().iterator()
+        producer_list = [producer for producer in producer_list if producer.id in purchases_of_producer]
+    producers = iter(producer_list)
     producer = next_row(producers)
     if producer is not None:
         wb, ws = new_landscape_a4_sheet(
             wb,
             _("Preparation") if delivery_id is None else "{}-{}".format(delivery_cpt, _("Preparation")),
             permanence,
-            header
+            header,
+            context=context
         )
         row_num = 1
         if delivery_id is not None:
@@ -439,18 +456,12 @@ def export_preparation_for_a_delivery(delivery_cpt, delivery_id, header, permane
                 # If the producer manage the production, he need to go into his field to pick up products.
                 # In this cas, the preparation list must not be done by basket.
                 # But the invoice must be done by basket.
-                purchase_set = Purchase.objects.filter(
-                    permanence_id=permanence.id,
-                    producer_id=producer.id,
-                    offer_item__translations__language_code=translation.get_language()
-                ).order_by(
-                    "customer__short_basket_name",
-                    "offer_item__translations__preparation_sort_order"
-                ).select_related('customer', 'offer_item', 'offer_item__department_for_customer')
-                if delivery_id is not None:
-                    purchase_set = purchase_set.filter(customer_invoice__delivery_id=delivery_id)
-                purchases = purchase_set.iterator()
-                purchase = next_purchase(purchases)
+                # By customer, then by preparation_sort_order
+                producer_purchases = iter(sorted(
+                    purchases_of_producer.get(producer.id, ()),
+                    key=lambda p: (p.customer_rank, p.preparation_sort_order)
+                ))
+                purchase = next_purchase(producer_purchases)
                 while purchase is not None:
                     at_least_one_product = True
                     customer_save = purchase.customer
@@ -526,14 +537,14 @@ def export_preparation_for_a_delivery(delivery_cpt, delivery_id, header, permane
                                 if purchase.offer_item.order_unit == PRODUCT_ORDER_UNIT_PC_KG:
                                     c = ws.cell(row=row_num, column=9)
                                     if purchase.offer_item.wrapped:
-                                        c.value = "{} :".format(repanier.apps.REPANIER_SETTINGS_CURRENCY_DISPLAY)
+                                        c.value = "{} :".format(context.currency_display)
                                     else:
                                         c.value = "{}".format(_('kg :'))
                                     c.style.number_format.format_code = NumberFormat.FORMAT_TEXT
                                 else:
                                     if purchase.offer_item.wrapped:
                                         c = ws.cell(row=row_num, column=9)
-                                        c.value = "{} :".format(repanier.apps.REPANIER_SETTINGS_CURRENCY_DISPLAY)
+                                        c.value = "{} :".format(context.currency_display)
                                         c.style.number_format.format_code = NumberFormat.FORMAT_TEXT
                                 purchases_price += (price_qty *
                                                     (customer_unit_price + purchase.offer_item.unit_deposit.amount)
@@ -545,13 +556,13 @@ def export_preparation_for_a_delivery(delivery_cpt, delivery_id, header, permane
                                     c.style.borders.bottom.border_style = Border.BORDER_THIN
                                 row_num += 1
 
-                            purchase = next_purchase(purchases)
+                            purchase = next_purchase(producer_purchases)
                     c = ws.cell(row=row_num - 1, column=10)
                     if len(purchases_price_formula) > 0:
                         c.value = "={}".format("+".join(purchases_price_formula))
                     else:
                         c.value = DECIMAL_ZERO
-                    c.style.number_format.format_code = repanier.apps.REPANIER_SETTINGS_CURRENCY_XLSX
+                    c.style.number_format.format_code = context.currency_xlsx
                     c.style.font.color = Color(Color.BLUE)
                     ws.conditional_formatting.addCellIs(
                         get_column_letter(11) + str(row_num), 'notEqual',
@@ -564,119 +575,111 @@ def export_preparation_for_a_delivery(delivery_cpt, delivery_id, header, permane
             else:
                 # Using quantity_for_preparation_sort_order the order is by customer__short_basket_name if the product
                 # is to be distributed by piece, otherwise by lower qty first.
-                for offer_item in OfferItemWoReceiver.objects.filter(
-                        permanence_id=permanence.id,
-                        producer_id=producer.id,
-                        translations__language_code=translation.get_language()
-                ).order_by(
-                    "translations__preparation_sort_order"
-                ):
-                    purchase_set = Purchase.objects.filter(
-                        offer_item_id=offer_item.id
-                    ).order_by(
-                        "quantity_for_preparation_sort_order",
-                        "customer__short_basket_name"
-                    ).select_related('customer', 'offer_item', 'offer_item__department_for_customer')
-                    if delivery_id is not None:
-                        purchase_set = purchase_set.filter(customer_invoice__delivery_id=delivery_id)
-                    purchases = purchase_set.iterator()
-                    purchase = next_purchase(purchases)
+                # By offer item in preparation_sort_order, then by quantity_for_preparation_sort_order and customer
+                producer_purchases = iter(sorted(
+                    purchases_of_producer.get(producer.id, ()),
+                    key=lambda p: (
+                        p.preparation_sort_order, p.offer_item_id, p.quantity_for_preparation_sort_order,
+                        p.customer_rank
+                    )
+                ))
+                purchase = next_purchase(producer_purchases)
+                while purchase is not None:
+                    at_least_one_product = True
                     while purchase is not None:
-                        at_least_one_product = True
-                        while purchase is not None:
-                            department_for_customer_save = purchase.offer_item.department_for_customer
-                            department_for_customer_save__short_name = department_for_customer_save.short_name \
-                                if department_for_customer_save is not None else None
-                            offer_item_save = purchase.offer_item
-                            row_start_offer_item = row_num + 2
-                            count_offer_item = 0
-                            for col_num in range(11):
-                                c = ws.cell(row=row_num, column=col_num)
-                                c.style.borders.bottom.border_style = Border.BORDER_THIN
-                            purchases_quantity = DECIMAL_ZERO
-                            row_num += 1
-                            while purchase is not None and offer_item_save == purchase.offer_item:
-                                qty = purchase.get_producer_quantity()
-                                if qty != DECIMAL_ZERO:
-                                    base_unit = get_base_unit(
-                                        qty,
-                                        offer_item_save.order_unit,
-                                        purchase.status
-                                    )
-                                    c = ws.cell(row=row_num, column=0)
-                                    c.value = purchase.id
-                                    c = ws.cell(row=row_num, column=1)
-                                    c.value = purchase.offer_item_id
-                                    if count_offer_item == 0:
-                                        c = ws.cell(row=row_num, column=2)
-                                        c.value = "{}".format(purchase.offer_item.get_placement_display())
-                                        if placement_save is None:
-                                            placement_save = c.value
-                                        elif hide_column_placement:
-                                            if placement_save != c.value:
-                                                hide_column_placement = False
-                                        c = ws.cell(row=row_num, column=3)
-                                        c.value = "{}".format(producer_save.short_profile_name)
-                                    c = ws.cell(row=row_num, column=5)
-                                    if department_for_customer_save__short_name is not None:
-                                        c.value = "{} - {}".format(
-                                            purchase.get_long_name(), department_for_customer_save__short_name)
-                                    else:
-                                        c.value = "{}".format(purchase.get_long_name())
-                                    c.style.alignment.wrap_text = True
-                                    if count_offer_item != 0:
-                                        c.style.font.color.index = 'FF939393'
-                                    c.style.number_format.format_code = NumberFormat.FORMAT_TEXT
-                                    c = ws.cell(row=row_num, column=6)
-                                    c.value = "{} - {}".format(purchase.customer.preparation_order,
-                                                               purchase.customer.short_basket_name)
-                                    c.style.number_format.format_code = NumberFormat.FORMAT_TEXT
-                                    c = ws.cell(row=row_num, column=7)
-                                    c.value = qty
-                                    c.style.number_format.format_code = '#,##0.????'
-                                    c.style.font.color = Color(Color.BLUE)
-                                    ws.conditional_formatting.addCellIs(
-                                        get_column_letter(8) + str(row_num + 1), 'notEqual',
-                                        [str(qty)], True, wb,
-                                        None, None, yellowFill
-                                    )
-                                    c = ws.cell(row=row_num, column=8)
-                                    c.value = "{}".format(base_unit)
-                                    c.style.number_format.format_code = NumberFormat.FORMAT_TEXT
-                                    if offer_item_save.order_unit == PRODUCT_ORDER_UNIT_PC_KG:
-                                        c = ws.cell(row=row_num, column=9)
-                                        if offer_item_save.wrapped:
-                                            c.value = "{} :".format(repanier.apps.REPANIER_SETTINGS_CURRENCY_DISPLAY)
-                                        else:
-                                            c.value = "{}".format(_('kg :'))
-                                        c.style.number_format.format_code = NumberFormat.FORMAT_TEXT
-                                    else:
-                                        if offer_item_save.wrapped:
-                                            c = ws.cell(row=row_num, column=9)
-                                            c.value = "{} :".format(repanier.apps.REPANIER_SETTINGS_CURRENCY_DISPLAY)
-                                            c.style.number_format.format_code = NumberFormat.FORMAT_TEXT
-                                    purchases_quantity += qty
-                                    count_offer_item += 1
-                                    delta = 6
-                                    for col_num in range(4):
-                                        c = ws.cell(row=row_num, column=delta + col_num)
-                                        c.style.borders.bottom.border_style = Border.BORDER_THIN
-                                    row_num += 1
-
-                                purchase = next_purchase(purchases)
-                            if count_offer_item > 1:
-                                c = ws.cell(row=row_num - 1, column=10)
-                                c.value = "=SUM(H{}:H{})".format(row_start_offer_item, row_num)
+                        department_for_customer_save = purchase.offer_item.department_for_customer
+                        department_for_customer_save__short_name = department_for_customer_save.short_name \
+                            if department_for_customer_save is not None else None
+                        offer_item_save = purchase.offer_item
+                        row_start_offer_item = row_num + 2
+                        count_offer_item = 0
+                        for col_num in range(11):
+                            c = ws.cell(row=row_num, column=col_num)
+                            c.style.borders.bottom.border_style = Border.BORDER_THIN
+                        purchases_quantity = DECIMAL_ZERO
+                        row_num += 1
+                        while purchase is not None and offer_item_save == purchase.offer_item:
+                            qty = purchase.get_producer_quantity()
+                            if qty != DECIMAL_ZERO:
+                                base_unit = get_base_unit(
+                                    qty,
+                                    offer_item_save.order_unit,
+                                    purchase.status
+                                )
+                                c = ws.cell(row=row_num, column=0)
+                                c.value = purchase.id
+                                c = ws.cell(row=row_num, column=1)
+                                c.value = purchase.offer_item_id
+                                if count_offer_item == 0:
+                                    c = ws.cell(row=row_num, column=2)
+                                    c.value = "{}".format(purchase.offer_item.get_placement_display())
+                                    if placement_save is None:
+                                        placement_save = c.value
+                                    elif hide_column_placement:
+                                        if placement_save != c.value:
+                                            hide_column_placement = False
+                                    c = ws.cell(row=row_num, column=3)
+                                    c.value = "{}".format(producer_save.short_profile_name)
+                                c = ws.cell(row=row_num, column=5)
+                                if department_for_customer_save__short_name is not None:
+                                    c.value = "{} - {}".format(
+                                        purchase.get_long_name(), department_for_customer_save__short_name)
+                                else:
+                                    c.value = "{}".format(purchase.get_long_name())
+                                c.style.alignment.wrap_text = True
+                                if count_offer_item != 0:
+                                    c.style.font.color.index = 'FF939393'
+                                c.style.number_format.format_code = NumberFormat.FORMAT_TEXT
+                                c = ws.cell(row=row_num, column=6)
+                                c.value = "{} - {}".format(purchase.customer.preparation_order,
+                                                           purchase.customer.short_basket_name)
+                                c.style.number_format.format_code = NumberFormat.FORMAT_TEXT
+                                c = ws.cell(row=row_num, column=7)
+                                c.value = qty
                                 c.style.number_format.format_code = '#,##0.????'
-                                if not offer_item_save.wrapped and offer_item_save.order_unit in [PRODUCT_ORDER_UNIT_KG,
-                                                                                                  PRODUCT_ORDER_UNIT_PC_KG]:
-                                    c.style.font.color = Color(Color.BLUE)
+                                c.style.font.color = Color(Color.BLUE)
                                 ws.conditional_formatting.addCellIs(
-                                    get_column_letter(11) + str(row_num), 'notEqual',
-                                    [str(purchases_quantity)], True, wb,
+                                    get_column_letter(8) + str(row_num + 1), 'notEqual',
+                                    [str(qty)], True, wb,
                                     None, None, yellowFill
                                 )
-                            row_num -= 1
+                                c = ws.cell(row=row_num, column=8)
+                                c.value = "{}".format(base_unit)
+                                c.style.number_format.format_code = NumberFormat.FORMAT_TEXT
+                                if offer_item_save.order_unit == PRODUCT_ORDER_UNIT_PC_KG:
+                                    c = ws.cell(row=row_num, column=9)
+                                    if offer_item_save.wrapped:
+                                        c.value = "{} :".format(context.currency_display)
+                                    else:
+                                        c.value = "{}".format(_('kg :'))
+                                    c.style.number_format.format_code = NumberFormat.FORMAT_TEXT
+                                else:
+                                    if offer_item_save.wrapped:
+                                        c = ws.cell(row=row_num, column=9)
+                                        c.value = "{} :".format(context.currency_display)
+                                        c.style.number_format.format_code = NumberFormat.FORMAT_TEXT
+                                purchases_quantity += qty
+                                count_offer_item += 1
+                                delta = 6
+                                for col_num in range(4):
+                                    c = ws.cell(row=row_num, column=delta + col_num)
+                                    c.style.borders.bottom.border_style = Border.BORDER_THIN
+                                row_num += 1
+
+                            purchase = next_purchase(producer_purchases)
+                        if count_offer_item > 1:
+                            c = ws.cell(row=row_num - 1, column=10)
+                            c.value = "=SUM(H{}:H{})".format(row_start_offer_item, row_num)
+                            c.style.number_format.format_code = '#,##0.????'
+                            if not offer_item_save.wrapped and offer_item_save.order_unit in [PRODUCT_ORDER_UNIT_KG,
+                                                                                              PRODUCT_ORDER_UNIT_PC_KG]:
+                                c.style.font.color = Color(Color.BLUE)
+                            ws.conditional_formatting.addCellIs(
+                                get_column_letter(11) + str(row_num), 'notEqual',
+                                [str(purchases_quantity)], True, wb,
+                                None, None, yellowFill
+                            )
+                        row_num -= 1
 
             if at_least_one_product:
                 for col_num in range(11):
@@ -695,7 +698,8 @@ def export_preparation_for_a_delivery(delivery_cpt, delivery_id, header, permane
     return wb
 
 
-def export_producer_by_product(permanence, producer, wb=None):
+def export_producer_by_product(permanence, producer, wb=None, purchases=None):
+    context = ExportContext.get()
     yellowFill = Fill()
     yellowFill.start_color.index = 'FFEEEE11'
     yellowFill.end_color.index = 'FFEEEE11'
@@ -726,14 +730,22 @@ def export_producer_by_product(permanence, producer, wb=None):
     ).order_by(
         "department_for_customer",
         "translations__producer_sort_order"
-    ).iterator()
+    ).select_related("department_for_customer").iterator()
     offer_item = next_row(offer_items)
     if offer_item:
+        if purchases is None:
+            purchases = get_purchase_stream(permanence, producer=producer)
+        # The purchases of each offer item, by customer
+        purchases_of_offer_item = {}
+        for purchase in purchases:
+            if purchase.producer_id == producer.id:
+                purchases_of_offer_item.setdefault(purchase.offer_item_id, []).append(purchase)
         wb, ws = new_landscape_a4_sheet(
             wb,
             "{} {}".format(producer.short_profile_name, _("by product")),
             permanence,
-            header
+            header,
+            context=context
         )
         row_num = 1
         producer_purchases_price = DECIMAL_ZERO
@@ -756,14 +768,7 @@ def export_producer_by_product(permanence, producer, wb=None):
                 if offer_item.wrapped:
                     hide_column_short_basket_name = False
                     first_purchase = True
-                    purchase_set = Purchase.objects.filter(
-                        offer_item_id=offer_item.id,
-                        offer_item__translations__language_code=translation.get_language()
-                    ).order_by(
-                        "offer_item__translations__producer_sort_order",
-                        "customer__short_basket_name"
-                    )
-                    for purchase in purchase_set:
+                    for purchase in purchases_of_offer_item.get(offer_item.id, ()):
                         if offer_item.limit_order_quantity_to_stock:
                             # Don't purchase anything to the producer in this case
                             qty = DECIMAL_ZERO
@@ -821,12 +826,12 @@ def export_producer_by_product(permanence, producer, wb=None):
                             else:
                                 unit_price = customer_unit_price
                             c.value = unit_price
-                            c.style.number_format.format_code = repanier.apps.REPANIER_SETTINGS_CURRENCY_XLSX
+                            c.style.number_format.format_code = context.currency_xlsx
                             c.style.borders.bottom.border_style = Border.BORDER_THIN
                             c = ws.cell(row=row_num, column=6)
                             unit_deposit = offer_item.unit_deposit.amount
                             c.value = unit_deposit
-                            c.style.number_format.format_code = repanier.apps.REPANIER_SETTINGS_CURRENCY_XLSX
+                            c.style.number_format.format_code = context.currency_xlsx
                             c.style.borders.bottom.border_style = Border.BORDER_THIN
                             c = ws.cell(row=row_num, column=7)
                             if offer_item.order_unit == PRODUCT_ORDER_UNIT_PC_KG:
@@ -839,7 +844,7 @@ def export_producer_by_product(permanence, producer, wb=None):
                             purchase_price = (
                                 price_qty * (unit_price + unit_deposit)
                             ).quantize(TWO_DECIMALS)
-                            c.style.number_format.format_code = repanier.apps.REPANIER_SETTINGS_CURRENCY_XLSX
+                            c.style.number_format.format_code = context.currency_xlsx
                             c.style.borders.bottom.border_style = Border.BORDER_THIN
                             department_purchases_price += purchase_price
                             ws.conditional_formatting.addCellIs(
@@ -904,12 +909,12 @@ def export_producer_by_product(permanence, producer, wb=None):
                         else:
                             unit_price = customer_unit_price
                         c.value = unit_price
-                        c.style.number_format.format_code = repanier.apps.REPANIER_SETTINGS_CURRENCY_XLSX
+                        c.style.number_format.format_code = context.currency_xlsx
                         c.style.borders.bottom.border_style = Border.BORDER_THIN
                         c = ws.cell(row=row_num, column=6)
                         unit_deposit = offer_item.unit_deposit.amount
                         c.value = unit_deposit
-                        c.style.number_format.format_code = repanier.apps.REPANIER_SETTINGS_CURRENCY_XLSX
+                        c.style.number_format.format_code = context.currency_xlsx
                         c.style.borders.bottom.border_style = Border.BORDER_THIN
                         c = ws.cell(row=row_num, column=7)
                         if offer_item.order_unit == PRODUCT_ORDER_UNIT_PC_KG:
@@ -922,7 +927,7 @@ def export_producer_by_product(permanence, producer, wb=None):
                         purchase_price = (
                             price_qty * (unit_price + unit_deposit)
                         ).quantize(TWO_DECIMALS)
-                        c.style.number_format.format_code = repanier.apps.REPANIER_SETTINGS_CURRENCY_XLSX
+                        c.style.number_format.format_code = context.currency_xlsx
                         c.style.borders.bottom.border_style = Border.BORDER_THIN
                         department_purchases_price += purchase_price
                         ws.conditional_formatting.addCellIs(
@@ -949,7 +954,7 @@ def export_producer_by_product(permanence, producer, wb=None):
                 if col_num == 7:
                     formula = "SUM(H{}:H{})".format(row_start_department, row_num)
                     c.value = '=' + formula
-                    c.style.number_format.format_code = repanier.apps.REPANIER_SETTINGS_CURRENCY_XLSX
+                    c.style.number_format.format_code = context.currency_xlsx
                     c.style.font.bold = True
                     producer_purchases_price += department_purchases_price
                     ws.conditional_formatting.addCellIs(
@@ -972,7 +977,7 @@ def export_producer_by_product(permanence, producer, wb=None):
                 c.style.number_format.format_code = NumberFormat.FORMAT_TEXT
             if col_num == 7:
                 c.value = "=" + "+".join(formula_main_total)
-                c.style.number_format.format_code = repanier.apps.REPANIER_SETTINGS_CURRENCY_XLSX
+                c.style.number_format.format_code = context.currency_xlsx
                 c.style.font.bold = True
                 ws.conditional_formatting.addCellIs(
                     get_column_letter(8) + str(row_num + 1), 'notEqual',
@@ -991,6 +996,7 @@ def export_producer_by_product(permanence, producer, wb=None):
 
 
 def export_producer_by_customer(permanence, producer, wb=None):
+    context = ExportContext.get()
     yellowFill = Fill()
     yellowFill.start_color.index = 'FFEEEE11'
     yellowFill.end_color.index = 'FFEEEE11'
@@ -1019,7 +1025,7 @@ def export_producer_by_customer(permanence, producer, wb=None):
     ).order_by(
         "customer__short_basket_name",
         "offer_item__translations__producer_sort_order"
-    ).select_related("offer_item")
+    ).select_related("customer", "offer_item")
     purchases = purchase_set.iterator()
     purchase = next_row(purchases)
     if purchase:
@@ -1027,7 +1033,8 @@ def export_producer_by_customer(permanence, producer, wb=None):
             wb,
             "{} {}".format(producer.short_profile_name, _("duplicate, by basket")),
             permanence,
-            header
+            header,
+            context=context
         )
         row_num = 1
         while purchase is not None:
@@ -1087,11 +1094,11 @@ def export_producer_by_customer(permanence, producer, wb=None):
                     else:
                         unit_price = customer_unit_price
                     c.value = unit_price
-                    c.style.number_format.format_code = repanier.apps.REPANIER_SETTINGS_CURRENCY_XLSX
+                    c.style.number_format.format_code = context.currency_xlsx
                     c.style.borders.bottom.border_style = Border.BORDER_THIN
                     c = ws.cell(row=row_num, column=5)
                     c.value = offer_item_save.unit_deposit.amount
-                    c.style.number_format.format_code = repanier.apps.REPANIER_SETTINGS_CURRENCY_XLSX
+                    c.style.number_format.format_code = context.currency_xlsx
                     c.style.borders.bottom.border_style = Border.BORDER_THIN
                     c = ws.cell(row=row_num, column=6)
                     if offer_item_save.order_unit == PRODUCT_ORDER_UNIT_PC_KG:
@@ -1099,7 +1106,7 @@ def export_producer_by_customer(permanence, producer, wb=None):
                             row_num + 1, offer_item_save.order_average_weight, row_num + 1, row_num + 1)
                     else:
                         c.value = "=ROUND(A{}*(E{}+F{}),2)".format(row_num + 1, row_num + 1, row_num + 1)
-                    c.style.number_format.format_code = repanier.apps.REPANIER_SETTINGS_CURRENCY_XLSX
+                    c.style.number_format.format_code = context.currency_xlsx
                     c.style.borders.bottom.border_style = Border.BORDER_THIN
                     row_num += 1
                 purchase = next_row(purchases)
@@ -1117,7 +1124,7 @@ def export_producer_by_customer(permanence, producer, wb=None):
                 if col_num == 6:
                     formula = "SUM(G{}:G{})".format(row_start_customer, row_num)
                     c.value = '=' + formula
-                    c.style.number_format.format_code = repanier.apps.REPANIER_SETTINGS_CURRENCY_XLSX
+                    c.style.number_format.format_code = context.currency_xlsx
                     c.style.font.bold = True
                     formula_main_total.append(formula)
             row_num += 1
@@ -1134,7 +1141,7 @@ def export_producer_by_customer(permanence, producer, wb=None):
                 c.style.number_format.format_code = NumberFormat.FORMAT_TEXT
             if col_num == 6:
                 c.value = "=" + "+".join(formula_main_total)
-                c.style.number_format.format_code = repanier.apps.REPANIER_SETTINGS_CURRENCY_XLSX
+                c.style.number_format.format_code = context.currency_xlsx
                 c.style.font.bold = True
         if hide_column_unit_deposit:
             ws.column_dimensions[get_column_letter(6)].visible = False
@@ -1150,7 +1157,7 @@ def export_customer(
         deliveries_id=(),
         deposit=False,
         xlsx_formula=True,
-        wb=None, ws_preparation_title=None):
+        wb=None, ws_preparation_title=None, purchases=None):
     yellowFill = Fill()
     yellowFill.start_color.index = 'FFEEEE11'
     yellowFill.end_color.index = 'FFEEEE11'
@@ -1172,22 +1179,23 @@ def export_customer(
     if len(deliveries_id) == 0:
         return export_customer_for_a_delivery(
             customer, 0, None, deposit, header, permanence, wb,
-            ws_preparation_title, yellowFill, xlsx_formula
+            ws_preparation_title, yellowFill, xlsx_formula, purchases
         )
     else:
         for delivery_cpt, delivery_id in enumerate(deliveries_id):
             wb = export_customer_for_a_delivery(
                 customer, delivery_cpt, delivery_id, deposit, header, permanence, wb,
-                ws_preparation_title, yellowFill, xlsx_formula
+                ws_preparation_title, yellowFill, xlsx_formula, purchases
             )
         return wb
 
 
 def export_customer_for_a_delivery(
         customer, delivery_cpt, delivery_id, deposit, header, permanence, wb, ws_preparation_title,
-        yellowFill, xlsx_formula):
+        yellowFill, xlsx_formula, purchase_stream=None):
     from repanier.apps import REPANIER_SETTINGS_CONFIG
 
+    context = ExportContext.get()
     language_code = translation.get_language()
     if customer is not None:
         translation.activate(customer.language)
@@ -1214,6 +1222,15 @@ def export_customer_for_a_delivery(
                 "offer_item__translations__long_name",
                 "offer_item__order_average_weight",
             ).select_related('customer', 'offer_item', 'offer_item__department_for_customer')
+        purchases = purchase_set.iterator()
+    elif purchase_stream is not None:
+        # The purchase stream is already in the basket control order
+        purchases = iter([
+            purchase for purchase in purchase_stream
+            if purchase.producer_id is not None and
+            (purchase.offer_item.order_unit == PRODUCT_ORDER_UNIT_DEPOSIT) == deposit and
+            (delivery_id is None or purchase.delivery_for_preparation_id == delivery_id)
+        ])
     else:
         if deposit:
             purchase_set = Purchase.objects.filter(
@@ -1242,7 +1259,7 @@ def export_customer_for_a_delivery(
             ).select_related('customer', 'offer_item', 'offer_item__department_for_customer')
         if delivery_id is not None:
             purchase_set = purchase_set.filter(customer_invoice__delivery_id=delivery_id)
-    purchases = purchase_set.iterator()
+        purchases = purchase_set.iterator()
     purchase = next_purchase(purchases)
     if purchase is not None:
         config = REPANIER_SETTINGS_CONFIG
@@ -1252,7 +1269,8 @@ def export_customer_for_a_delivery(
                 wb,
                 _("Deposits") if delivery_id is None else "{}-{}".format(delivery_cpt, _("Deposits")),
                 permanence,
-                header
+                header,
+                context=context
             )
         else:
             if repanier.apps.REPANIER_SETTINGS_PAGE_BREAK_ON_CUSTOMER_CHECK:
@@ -1261,14 +1279,16 @@ def export_customer_for_a_delivery(
                     wb,
                     _("Basket control") if delivery_id is None else "{}-{}".format(delivery_cpt, _("Basket control")),
                     permanence,
-                    header
+                    header,
+                    context=context
                 )
             else:
                 wb, ws = new_landscape_a4_sheet(
                     wb,
                     _("Basket control") if delivery_id is None else "{}-{}".format(delivery_cpt, _("Basket control")),
                     permanence,
-                    header
+                    header,
+                    context=context
                 )
         hide_column_placement = True
         hide_column_producer = True
@@ -1364,12 +1384,12 @@ def export_customer_for_a_delivery(
                             c = ws.cell(row=row_num, column=7)
                             customer_unit_price = purchase.get_customer_unit_price()
                             c.value = customer_unit_price
-                            c.style.number_format.format_code = repanier.apps.REPANIER_SETTINGS_CURRENCY_XLSX
+                            c.style.number_format.format_code = context.currency_xlsx
                             c.style.borders.bottom.border_style = Border.BORDER_THIN
                             c = ws.cell(row=row_num, column=8)
                             unit_deposit = offer_item_save.unit_deposit.amount
                             c.value = unit_deposit
-                            c.style.number_format.format_code = repanier.apps.REPANIER_SETTINGS_CURRENCY_XLSX
+                            c.style.number_format.format_code = context.currency_xlsx
                             c.style.borders.bottom.border_style = Border.BORDER_THIN
                             c = ws.cell(row=row_num, column=9)
                             if offer_item_save.order_unit == PRODUCT_ORDER_UNIT_PC_KG:
@@ -1385,7 +1405,7 @@ def export_customer_for_a_delivery(
                             if not xlsx_formula:
                                 c.value = purchases_price
                                 total_price += purchases_price
-                            c.style.number_format.format_code = repanier.apps.REPANIER_SETTINGS_CURRENCY_XLSX
+                            c.style.number_format.format_code = context.currency_xlsx
                             c.style.borders.bottom.border_style = Border.BORDER_THIN
                             if xlsx_formula:
                                 ws.conditional_formatting.addCellIs(
@@ -1429,7 +1449,7 @@ def export_customer_for_a_delivery(
                     c.value = "=SUM(J{}:J{})".format(row_start_customer, row_num)
                 else:
                     c.value = total_price
-                c.style.number_format.format_code = repanier.apps.REPANIER_SETTINGS_CURRENCY_XLSX
+                c.style.number_format.format_code = context.currency_xlsx
                 c.style.font.bold = True
                 # Display a separator line between customers
                 row_num += 1
@@ -1466,15 +1486,17 @@ def generate_customer_xlsx(permanence, deliveries_id=(), customer=None, group=Fa
             wb = export_customer_label(
                 permanence=permanence, deliveries_id=deliveries_id, wb=wb
             )
+            # Read after export_abstract which set the customer's preparation_order
+            purchases = get_purchase_stream(permanence)
             wb = export_preparation(
-                permanence=permanence, deliveries_id=deliveries_id, wb=wb
+                permanence=permanence, deliveries_id=deliveries_id, wb=wb, purchases=purchases
             )
             wb = export_customer(
-                permanence=permanence, deliveries_id=deliveries_id, deposit=True, wb=wb
+                permanence=permanence, deliveries_id=deliveries_id, deposit=True, wb=wb, purchases=purchases
             )
             wb = export_customer(
                 permanence=permanence, deliveries_id=deliveries_id, deposit=False, wb=wb,
-                ws_preparation_title=ws_preparation_title
+                ws_preparation_title=ws_preparation_title, purchases=purchases
             )
             wb = export_permanence_stock(
                 permanence=permanence, deliveries_id=deliveries_id, customer_price=True, wb=wb,
@@ -1485,9 +1507,9 @@ def generate_customer_xlsx(permanence, deliveries_id=(), customer=None, group=Fa
             return
 
 
-def generate_producer_xlsx(permanence, producer=None, wb=None):
+def generate_producer_xlsx(permanence, producer=None, wb=None, purchases=None):
     wb = export_producer_by_product(
-        permanence=permanence, producer=producer, wb=wb
+        permanence=permanence, producer=producer, wb=wb, purchases=purchases
     )
     if not (wb is None or producer.manage_replenishment):
         # At least one order and we don't manage replenishment for this producer
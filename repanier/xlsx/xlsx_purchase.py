@@ -7,12 +7,10 @@ from openpyxl import load_workbook
 from openpyxl.style import Fill
 from openpyxl.styles import Color
 
-from repanier.apps import REPANIER_SETTINGS_CURRENCY_XLSX
 from repanier.const import *
-from repanier.models.offeritem import OfferItemWoReceiver
 from repanier.models.producer import Producer
 from repanier.models.purchase import Purchase
-from repanier.tools import cap, next_row
+from repanier.tools import cap, next_row, bulk_update
 from repanier.xlsx.export_tools import *
 from repanier.xlsx.import_tools import *
 
@@ -27,6 +25,7 @@ def next_purchase(purchases):
 
 
 def export_purchase(permanence=None, year=None, producer=None, customer=None, wb=None):
+    context = ExportContext.get()
     yellowFill = Fill()
     yellowFill.start_color.index = 'FFEEEE11'
     yellowFill.end_color.index = 'FFEEEE11'
@@ -76,7 +75,8 @@ def export_purchase(permanence=None, year=None, producer=None, customer=None, wb
             wb,
             title1,
             _('Invoices'),
-            header
+            header,
+            context=context
         )
         row_num = 1
         count_all_purchase = 0
@@ -194,12 +194,12 @@ def export_purchase(permanence=None, year=None, producer=None, customer=None, wb
                                     )
                                 c = ws.cell(row=row_num, column=7)
                                 c.value = purchase.get_producer_unit_price()
-                                c.style.number_format.format_code = REPANIER_SETTINGS_CURRENCY_XLSX
+                                c.style.number_format.format_code = context.currency_xlsx
                                 # if year is None:
                                 #     c.style.font.color = Color(Color.BLUE)
                                 c = ws.cell(row=row_num, column=8)
                                 c.value = purchase.offer_item.unit_deposit.amount
-                                c.style.number_format.format_code = REPANIER_SETTINGS_CURRENCY_XLSX
+                                c.style.number_format.format_code = context.currency_xlsx
                                 c = ws.cell(row=row_num, column=9)
                                 c.value = "=ROUND(G{}*(H{}+I{}),2)".format(row_num + 1, row_num + 1, row_num + 1)
                                 if year is None:
@@ -218,10 +218,10 @@ def export_purchase(permanence=None, year=None, producer=None, customer=None, wb
                                         [str(purchase_price)], True, wb,
                                         None, None, yellowFill
                                     )
-                                c.style.number_format.format_code = REPANIER_SETTINGS_CURRENCY_XLSX
+                                c.style.number_format.format_code = context.currency_xlsx
                                 c = ws.cell(row=row_num, column=10)
                                 c.value = "=G{}*{}".format(row_num + 1, purchase.offer_item.customer_vat.amount)
-                                c.style.number_format.format_code = REPANIER_SETTINGS_CURRENCY_XLSX
+                                c.style.number_format.format_code = context.currency_xlsx
                                 c = ws.cell(row=row_num, column=12)
                                 c.value = "{}".format(cap(purchase.comment, 100))
                                 c.style.number_format.format_code = NumberFormat.FORMAT_TEXT
@@ -242,7 +242,7 @@ def export_purchase(permanence=None, year=None, producer=None, customer=None, wb
                         if year is None and count_purchase > 1:
                             c = ws.cell(row=row_num - 1, column=11)
                             c.value = "=SUM(J{}:J{})".format(row_start_purchase, row_num)
-                            c.style.number_format.format_code = REPANIER_SETTINGS_CURRENCY_XLSX
+                            c.style.number_format.format_code = context.currency_xlsx
                             c.style.font.color = Color(Color.BLUE)
                             ws.conditional_formatting.addCellIs(
                                 get_column_letter(12) + str(row_num), 'notEqual',
@@ -269,7 +269,7 @@ def export_purchase(permanence=None, year=None, producer=None, customer=None, wb
                         c.style.alignment.horizontal = c.style.alignment.HORIZONTAL_RIGHT
                         c = ws.cell(row=row_num, column=9)
                         c.value = "={}".format(purchase_price_producer_purchase)
-                        c.style.number_format.format_code = REPANIER_SETTINGS_CURRENCY_XLSX
+                        c.style.number_format.format_code = context.currency_xlsx
                         c.style.font.bold = True
                         if year is None:
                             ws.conditional_formatting.addCellIs(
@@ -279,7 +279,7 @@ def export_purchase(permanence=None, year=None, producer=None, customer=None, wb
                             )
                         c = ws.cell(row=row_num, column=10)
                         c.value = "={}".format(tax_producer_purchase)
-                        c.style.number_format.format_code = REPANIER_SETTINGS_CURRENCY_XLSX
+                        c.style.number_format.format_code = context.currency_xlsx
                         row_num += 1
                         for col_num in range(14):
                             c = ws.cell(row=row_num, column=col_num)
@@ -410,14 +410,14 @@ def export_purchase(permanence=None, year=None, producer=None, customer=None, wb
                                     )
                                 else:
                                     c.value = "=H{}".format(row_first_offer_item + 1)
-                                c.style.number_format.format_code = REPANIER_SETTINGS_CURRENCY_XLSX
+                                c.style.number_format.format_code = context.currency_xlsx
                                 c = ws.cell(row=row_num, column=8)
                                 c.value = purchase.offer_item.unit_deposit.amount
-                                c.style.number_format.format_code = REPANIER_SETTINGS_CURRENCY_XLSX
+                                c.style.number_format.format_code = context.currency_xlsx
                                 c = ws.cell(row=row_num, column=9)
                                 c.value = "=ROUND(G{}*(H{}+I{}),2)".format(row_num + 1, row_first_offer_item + 1,
                                                                            row_num + 1)
-                                c.style.number_format.format_code = REPANIER_SETTINGS_CURRENCY_XLSX
+                                c.style.number_format.format_code = context.currency_xlsx
                                 if year is None:
                                     offer_item_price = (purchase.quantity_invoiced *
                                                         (purchase.get_producer_unit_price() +
@@ -436,7 +436,7 @@ def export_purchase(permanence=None, year=None, producer=None, customer=None, wb
                                     )
                                 c = ws.cell(row=row_num, column=10)
                                 c.value = "=G{}*{}".format(row_num + 1, purchase.offer_item.customer_vat.amount)
-                                c.style.number_format.format_code = REPANIER_SETTINGS_CURRENCY_XLSX
+                                c.style.number_format.format_code = context.currency_xlsx
                                 c = ws.cell(row=row_num, column=12)
                                 c.value = "{}".format(cap(purchase.comment, 100))
                                 c.style.number_format.format_code = NumberFormat.FORMAT_TEXT
@@ -463,7 +463,7 @@ def export_purchase(permanence=None, year=None, producer=None, customer=None, wb
                                 ]:
                                     c = ws.cell(row=row_num - 1, column=11)
                                     c.value = "=SUM(J{}:J{})".format(row_start_offer_item, row_num)
-                                    c.style.number_format.format_code = REPANIER_SETTINGS_CURRENCY_XLSX
+                                    c.style.number_format.format_code = context.currency_xlsx
                                     c.style.font.color = Color(Color.BLUE)
                                     ws.conditional_formatting.addCellIs(
                                         get_column_letter(12) + str(row_num), 'notEqual',
@@ -491,7 +491,7 @@ def export_purchase(permanence=None, year=None, producer=None, customer=None, wb
                         c.style.alignment.horizontal = c.style.alignment.HORIZONTAL_RIGHT
                         c = ws.cell(row=row_num, column=9)
                         c.value = "={}".format(purchase_price_producer_purchase)
-                        c.style.number_format.format_code = REPANIER_SETTINGS_CURRENCY_XLSX
+                        c.style.number_format.format_code = context.currency_xlsx
                         c.style.font.bold = True
                         if year is None:
                             ws.conditional_formatting.addCellIs(
@@ -501,7 +501,7 @@ def export_purchase(permanence=None, year=None, producer=None, customer=None, wb
                             )
                         c = ws.cell(row=row_num, column=10)
                         c.value = "={}".format(tax_producer_purchase)
-                        c.style.number_format.format_code = REPANIER_SETTINGS_CURRENCY_XLSX
+                        c.style.number_format.format_code = context.currency_xlsx
                         row_num += 1
                         for col_num in range(14):
                             c = ws.cell(row=row_num, column=col_num)
@@ -518,11 +518,11 @@ def export_purchase(permanence=None, year=None, producer=None, customer=None, wb
             c.style.alignment.horizontal = c.style.alignment.HORIZONTAL_RIGHT
             c = ws.cell(row=row_num, column=9)
             c.value = "={}".format("+".join(purchase_price_all_purchase))
-            c.style.number_format.format_code = REPANIER_SETTINGS_CURRENCY_XLSX
+            c.style.number_format.format_code = context.currency_xlsx
             c.style.font.bold = True
             c = ws.cell(row=row_num, column=10)
             c.value = "={}".format("+".join(tax_all_purchase))
-            c.style.number_format.format_code = REPANIER_SETTINGS_CURRENCY_XLSX
+            c.style.number_format.format_code = context.currency_xlsx
             row_num += 1
             for col_num in range(14):
                 c = ws.cell(row=row_num, column=col_num)
@@ -544,158 +544,183 @@ def import_purchase_sheet(worksheet, permanence=None,
                           customer_2_id_dict=None,
                           producer_2_id_dict=None
                           ):
+    # The sheet is read in one pass and the purchases are read with one query.
+    # All the rows are checked before saving anything and all the errors are reported.
+    # Then the offer items whose price changed are saved, the purchases are updated in bulk
+    # and the totals of the permanence are recalculated once.
     error = False
     error_msg = None
     import_counter = 0
     header = get_header(worksheet)
-    if header:
-        row_num = 1
-        array_purchase = []
-        rule_of_3_source = DECIMAL_ZERO
-        row = get_row(worksheet, header, row_num)
-        while row and not error:
+    rows = get_rows(worksheet, header)
+    errors = []
+    purchase_ids = set()
+    for row_num, row in rows:
+        if row.get(_('Format')) in ["A", "B", "C", "D"] and row.get(_('Id')) is not None:
             try:
-                row_format = row[_('Format')]
-                if row_format in ["A", "B", "C", "D"]:
-                    import_counter += 1
-                    if row[_('Id')] is None:
-                        error = True
-                        error_msg = _("Row %(row_num)d : No purchase id given.") % {'row_num': row_num + 1}
-                        break
-                    row_id = Decimal(row[_('Id')])
-                    purchase = Purchase.objects.filter(id=row_id).order_by('?').first()
-                    if purchase is None:
-                        error = True
-                        error_msg = _("Row %(row_num)d : No purchase corresponding to the given purchase id.") % {
-                            'row_num': row_num + 1}
-                        break
-                    if purchase.permanence_id != permanence.id:
-                        error = True
-                        error_msg = _("Row %(row_num)d : The given permanence doesn't own the given purchase id.") % {
-                            'row_num': row_num + 1}
-                        break
-                    offer_item = OfferItemWoReceiver.objects.filter(id=purchase.offer_item_id).order_by('?').first()
-                    if offer_item is None:
-                        error = True
-                        error_msg = _("Row %(row_num)d : No offer_item corresponding to the given purchase id.") % {
-                            'row_num': row_num + 1}
-                        break
-                    producer_id = None
-                    if row[_('Producer')] in producer_2_id_dict:
-                        producer_id = producer_2_id_dict[row[_('Producer')]]
-                    if producer_id != purchase.producer_id:
-                        error = True
-                        error_msg = _("Row %(row_num)d : No valid producer.") % {'row_num': row_num + 1}
-                        break
-                    customer_name = "{}".format(row[_('Customer')])
-                    if customer_name in customer_2_id_dict:
-                        customer_id = customer_2_id_dict[customer_name]
-                        if customer_id != purchase.customer_id:
-                            error = True
-                            error_msg = _("Row %(row_num)d : No valid customer") % {'row_num': row_num + 1}
-                            break
-                    comment = cap(row[_('Comment')], 100)
-
-                    quantity_has_been_modified = False
-
-                    producer_row_price = row[_('Purchase price')]
-                    if producer_row_price is not None:
-                        producer_row_price = Decimal(producer_row_price).quantize(TWO_DECIMALS)
-                        if purchase.purchase_price.amount != producer_row_price:
-                            quantity_has_been_modified = True
-                            # Asked by GAC HAMOIS : sell broken products...
-                            # if purchase.offer_item.order_unit in [
-                            #     PRODUCT_ORDER_UNIT_KG, PRODUCT_ORDER_UNIT_PC_KG,
-                            #     PRODUCT_ORDER_UNIT_LT
-                            # ]:
-                            producer_unit_price = (purchase.offer_item.producer_unit_price.amount +
-                                                   purchase.offer_item.unit_deposit.amount).quantize(TWO_DECIMALS)
-                            if producer_unit_price != DECIMAL_ZERO:
-                                purchase.quantity_invoiced = (producer_row_price /
-                                                              producer_unit_price).quantize(FOUR_DECIMALS)
-                            else:
-                                purchase.quantity_invoiced = DECIMAL_ZERO
-
-                    if not quantity_has_been_modified:
-                        quantity_invoiced = DECIMAL_ZERO if row[_('Quantity invoiced')] is None \
-                            else Decimal(row[_('Quantity invoiced')]).quantize(FOUR_DECIMALS)
-                        if purchase.quantity_invoiced != quantity_invoiced:
-                            purchase.quantity_invoiced = quantity_invoiced
-
-                    if row_format == "A":
-                        array_purchase = []
-                        rule_of_3_source = DECIMAL_ZERO
-                        producer_unit_price = row[_('Producer unit price')]
-                        if producer_unit_price is not None and not purchase.producer.invoice_by_basket:
-                            previous_producer_unit_price = purchase.get_producer_unit_price()
-                            if producer_unit_price != previous_producer_unit_price:
-                                offer_item.producer_unit_price = producer_unit_price
-                                offer_item.save()
-
-                    purchase.comment = comment
-                    purchase.save()
-                    rule_of_3_source += purchase.purchase_price.amount
-                    array_purchase.append(purchase)
-
-                if row_format in ["C", "D"]:
-                    rule_of_3_target = row[_('Rule of 3')]
-                    if rule_of_3_target is not None:
-                        rule_of_3_target = Decimal(rule_of_3_target).quantize(TWO_DECIMALS)
-                        if rule_of_3_target != rule_of_3_source:
-                            max_purchase_counter = len(array_purchase)
-                            if max_purchase_counter <= 1:
-                                error = True
-                                error_msg = _("Row %(row_num)d : Rule of 3 target in wrong context.") % {
-                                    'row_num': row_num + 1}
-                                return error, error_msg
+                purchase_ids.add(int(row[_('Id')]))
+            except (TypeError, ValueError):
+                pass
+    purchases = {}
+    offer_items = {}
+    for purchase in Purchase.objects.filter(
+            id__in=purchase_ids
+    ).select_related(
+        "offer_item", "customer", "producer"
+    ).order_by('?'):
+        # Share the offer item between its purchases
+        purchase.offer_item = offer_items.setdefault(purchase.offer_item_id, purchase.offer_item)
+        purchases[purchase.id] = purchase
+
+    updated_purchases = {}
+    updated_offer_items = {}
+    array_purchase = []
+    rule_of_3_source = DECIMAL_ZERO
+    for row_num, row in rows:
+        try:
+            row_format = row[_('Format')]
+            if row_format in ["A", "B", "C", "D"]:
+                import_counter += 1
+                if row[_('Id')] is None:
+                    errors.append(_("Row %(row_num)d : No purchase id given.") % {'row_num': row_num + 1})
+                    continue
+                purchase = purchases.get(int(row[_('Id')]))
+                if purchase is None:
+                    errors.append(_("Row %(row_num)d : No purchase corresponding to the given purchase id.") % {
+                        'row_num': row_num + 1})
+                    continue
+                if purchase.permanence_id != permanence.id:
+                    errors.append(_("Row %(row_num)d : The given permanence doesn't own the given purchase id.") % {
+                        'row_num': row_num + 1})
+                    continue
+                offer_item = purchase.offer_item
+                producer_id = None
+                if row[_('Producer')] in producer_2_id_dict:
+                    producer_id = producer_2_id_dict[row[_('Producer')]]
+                if producer_id != purchase.producer_id:
+                    errors.append(_("Row %(row_num)d : No valid producer.") % {'row_num': row_num + 1})
+                    continue
+                customer_name = "{}".format(row[_('Customer')])
+                if customer_name in customer_2_id_dict:
+                    customer_id = customer_2_id_dict[customer_name]
+                    if customer_id != purchase.customer_id:
+                        errors.append(_("Row %(row_num)d : No valid customer") % {'row_num': row_num + 1})
+                        continue
+                comment = cap(row[_('Comment')], 100)
+
+                quantity_has_been_modified = False
+
+                producer_row_price = row[_('Purchase price')]
+                if producer_row_price is not None:
+                    producer_row_price = Decimal(producer_row_price).quantize(TWO_DECIMALS)
+                    if purchase.purchase_price.amount != producer_row_price:
+                        quantity_has_been_modified = True
+                        # Asked by GAC HAMOIS : sell broken products...
+                        # if purchase.offer_item.order_unit in [
+                        #     PRODUCT_ORDER_UNIT_KG, PRODUCT_ORDER_UNIT_PC_KG,
+                        #     PRODUCT_ORDER_UNIT_LT
+                        # ]:
+                        producer_unit_price = (offer_item.producer_unit_price.amount +
+                                               offer_item.unit_deposit.amount).quantize(TWO_DECIMALS)
+                        if producer_unit_price != DECIMAL_ZERO:
+                            purchase.quantity_invoiced = (producer_row_price /
+                                                          producer_unit_price).quantize(FOUR_DECIMALS)
+                        else:
+                            purchase.quantity_invoiced = DECIMAL_ZERO
+
+                if not quantity_has_been_modified:
+                    quantity_invoiced = DECIMAL_ZERO if row[_('Quantity invoiced')] is None \
+                        else Decimal(row[_('Quantity invoiced')]).quantize(FOUR_DECIMALS)
+                    if purchase.quantity_invoiced != quantity_invoiced:
+                        purchase.quantity_invoiced = quantity_invoiced
+
+                if row_format == "A":
+                    array_purchase = []
+                    rule_of_3_source = DECIMAL_ZERO
+                    producer_unit_price = row[_('Producer unit price')]
+                    if producer_unit_price is not None and not purchase.producer.invoice_by_basket:
+                        producer_unit_price = Decimal(producer_unit_price).quantize(TWO_DECIMALS)
+                        previous_producer_unit_price = purchase.get_producer_unit_price()
+                        if producer_unit_price != previous_producer_unit_price:
+                            offer_item.producer_unit_price.amount = producer_unit_price
+                            # The next row prices need the new customer price and vat
+                            offer_item.recalculate_prices(
+                                offer_item.producer_price_are_wo_vat,
+                                offer_item.is_resale_price_fixed,
+                                offer_item.price_list_multiplier
+                            )
+                            updated_offer_items[offer_item.id] = offer_item
+
+                purchase.comment = comment
+                # The row price, as purchase_pre_save would calculate it
+                if not purchase.is_box_content:
+                    offer_item_quantity, quantity = purchase.get_quantities()
+                    purchase.calculate_row_price(quantity)
+                rule_of_3_source += purchase.purchase_price.amount
+                array_purchase.append(purchase)
+                updated_purchases[purchase.id] = purchase
+
+            if row_format in ["C", "D"]:
+                rule_of_3_target = row[_('Rule of 3')]
+                if rule_of_3_target is not None:
+                    rule_of_3_target = Decimal(rule_of_3_target).quantize(TWO_DECIMALS)
+                    if rule_of_3_target != rule_of_3_source:
+                        max_purchase_counter = len(array_purchase)
+                        if max_purchase_counter <= 1:
+                            errors.append(_("Row %(row_num)d : Rule of 3 target in wrong context.") % {
+                                'row_num': row_num + 1})
+                        else:
+                            if rule_of_3_source != DECIMAL_ZERO:
+                                ratio = rule_of_3_target / rule_of_3_source
                             else:
-                                if rule_of_3_source != DECIMAL_ZERO:
-                                    ratio = rule_of_3_target / rule_of_3_source
+                                if rule_of_3_target == DECIMAL_ZERO:
+                                    ratio = DECIMAL_ZERO
                                 else:
-                                    if rule_of_3_target == DECIMAL_ZERO:
-                                        ratio = DECIMAL_ZERO
-                                    else:
-                                        ratio = DECIMAL_ONE
-                                # Rule of 3
-                                if ratio != DECIMAL_ONE:
-                                    adjusted_invoice = DECIMAL_ZERO
-                                    for i, purchase in enumerate(array_purchase, start=1):
-                                        producer_unit_price = purchase.offer_item.producer_unit_price.amount
-                                        if i == max_purchase_counter:
-                                            delta = rule_of_3_target - adjusted_invoice
-                                            if producer_unit_price != DECIMAL_ZERO:
-                                                purchase.quantity_invoiced = (delta / producer_unit_price).quantize(
-                                                    FOUR_DECIMALS)
-                                            else:
-                                                purchase.quantity_invoiced = DECIMAL_ZERO
-                                        else:
-                                            purchase.quantity_invoiced = (purchase.quantity_invoiced * ratio).quantize(
+                                    ratio = DECIMAL_ONE
+                            # Rule of 3
+                            if ratio != DECIMAL_ONE:
+                                adjusted_invoice = DECIMAL_ZERO
+                                for i, purchase in enumerate(array_purchase, start=1):
+                                    producer_unit_price = purchase.offer_item.producer_unit_price.amount
+                                    if i == max_purchase_counter:
+                                        delta = rule_of_3_target - adjusted_invoice
+                                        if producer_unit_price != DECIMAL_ZERO:
+                                            purchase.quantity_invoiced = (delta / producer_unit_price).quantize(
                                                 FOUR_DECIMALS)
-                                            adjusted_invoice += (
-                                                    purchase.quantity_invoiced * producer_unit_price).quantize(
-                                                TWO_DECIMALS)
-                                        purchase.save()
-
-                row_num += 1
-                row = get_row(worksheet, header, row_num)
-
-            except KeyError as e:
-                # Missing field
-                error = True
-                error_msg = _("Row %(row_num)d : A required column is missing %(error_msg)s.") % {
-                    'row_num': row_num + 1, 'error_msg': str(e)}
-            except Exception as e:
-                error = True
-                error_msg = _("Row %(row_num)d : %(error_msg)s.") % {'row_num': row_num + 1, 'error_msg': str(e)}
-
-    if import_counter == 0:
+                                        else:
+                                            purchase.quantity_invoiced = DECIMAL_ZERO
+                                    else:
+                                        purchase.quantity_invoiced = (purchase.quantity_invoiced * ratio).quantize(
+                                            FOUR_DECIMALS)
+                                        adjusted_invoice += (
+                                                purchase.quantity_invoiced * producer_unit_price).quantize(
+                                            TWO_DECIMALS)
+
+        except KeyError as e:
+            # Missing field
+            errors.append(_("Row %(row_num)d : A required column is missing %(error_msg)s.") % {
+                'row_num': row_num + 1, 'error_msg': str(e)})
+            break
+        except Exception as e:
+            errors.append(_("Row %(row_num)d : %(error_msg)s.") % {'row_num': row_num + 1, 'error_msg': str(e)})
+
+    if errors:
+        error = True
+        error_msg = " ".join("{}".format(msg) for msg in errors)
+    elif import_counter == 0:
         error = True
         error_msg = "{}".format(_("Nothing to import."))
-    # if not error:
-    #     recalculate_order_amount(
-    #         permanence_id=permanence.id,
-    #         re_init=True
-    #     )
+    else:
+        for offer_item in updated_offer_items.values():
+            # offer_item_pre_save also books the price change of the replenished stock
+            offer_item.save()
+        bulk_update(Purchase, {
+            purchase.id: {
+                "quantity_invoiced": purchase.quantity_invoiced,
+                "comment": purchase.comment
+            } for purchase in updated_purchases.values()
+        })
+        permanence.recalculate_order_amount(re_init=True)
     return error, error_msg
 
 
@@ -9,16 +9,17 @@ from openpyxl import load_workbook
 from openpyxl.style import Fill
 from openpyxl.styles import Color
 
-import repanier.apps
 from repanier.const import *
 from repanier.models.offeritem import OfferItemWoReceiver
 from repanier.models.product import Product
+from repanier.stock import set_stock
 from repanier.tools import update_offer_item, next_row
 from repanier.xlsx.export_tools import *
-from repanier.xlsx.import_tools import get_row, get_header
+from repanier.xlsx.import_tools import get_rows, get_header
 
 
 def export_permanence_stock(permanence, deliveries_id=(), customer_price=False, wb=None, ws_customer_title=None):
+    context = ExportContext.get()
     if settings.REPANIER_SETTINGS_STOCK and wb is not None:
         yellowFill = Fill()
         yellowFill.start_color.index = 'FFEEEE11'
@@ -35,11 +36,11 @@ def export_permanence_stock(permanence, deliveries_id=(), customer_price=False,
             (_("Asked"), 10),
             (_("Quantity ordered"), 10),
             (_("Initial stock"), 10),
-            (repanier.apps.REPANIER_SETTINGS_CURRENCY_DISPLAY, 15),
+            (context.currency_display, 15),
             (_("Stock used"), 10),
             (_("Additional"), 10),
             (_("Remaining stock"), 10),
-            (repanier.apps.REPANIER_SETTINGS_CURRENCY_DISPLAY, 15),
+            (context.currency_display, 15),
         ]
         offer_items = OfferItemWoReceiver.objects.filter(
             Q(
@@ -80,7 +81,8 @@ def export_permanence_stock(permanence, deliveries_id=(), customer_price=False,
                 wb,
                 _('Stock check'),
                 permanence,
-                header
+                header,
+                context=context
             )
             formula_main_total_a = []
             formula_main_total_b = []
@@ -137,11 +139,11 @@ def export_permanence_stock(permanence, deliveries_id=(), customer_price=False,
                             c = ws.cell(row=row_num, column=4)
                             unit_price = offer_item.customer_unit_price if customer_price else offer_item.producer_unit_price
                             c.value = unit_price.amount
-                            c.style.number_format.format_code = repanier.apps.REPANIER_SETTINGS_CURRENCY_XLSX
+                            c.style.number_format.format_code = context.currency_xlsx
                             c.style.borders.bottom.border_style = Border.BORDER_THIN
                             c = ws.cell(row=row_num, column=5)
                             c.value = offer_item.unit_deposit.amount
-                            c.style.number_format.format_code = repanier.apps.REPANIER_SETTINGS_CURRENCY_XLSX
+                            c.style.number_format.format_code = context.currency_xlsx
                             c.style.borders.bottom.border_style = Border.BORDER_THIN
                             c = ws.cell(row=row_num, column=6)
                             if ws_customer_title is None:
@@ -176,7 +178,7 @@ def export_permanence_stock(permanence, deliveries_id=(), customer_price=False,
                             )
                             c = ws.cell(row=row_num, column=9)
                             c.value = "=ROUND(I{}*(E{}+F{}),2)".format(row_num + 1, row_num + 1, row_num + 1)
-                            c.style.number_format.format_code = repanier.apps.REPANIER_SETTINGS_CURRENCY_XLSX
+                            c.style.number_format.format_code = context.currency_xlsx
                             c.style.borders.bottom.border_style = Border.BORDER_THIN
                             c = ws.cell(row=row_num, column=10)
                             c.value = "=MIN(G{},I{})".format(row_num + 1, row_num + 1)
@@ -201,7 +203,7 @@ def export_permanence_stock(permanence, deliveries_id=(), customer_price=False,
                             c.style.font.bold = True
                             c = ws.cell(row=row_num, column=13)
                             c.value = "=ROUND(M{}*(E{}+F{}),2)".format(row_num + 1, row_num + 1, row_num + 1)
-                            c.style.number_format.format_code = repanier.apps.REPANIER_SETTINGS_CURRENCY_XLSX
+                            c.style.number_format.format_code = context.currency_xlsx
                             c.style.borders.bottom.border_style = Border.BORDER_THIN
                             row_num += 1
                         offer_item = next_row(offer_items)
@@ -214,13 +216,13 @@ def export_permanence_stock(permanence, deliveries_id=(), customer_price=False,
                 c = ws.cell(row=row_num, column=9)
                 formula = "SUM(J{}:J{})".format(row_start_producer, row_num)
                 c.value = "=" + formula
-                c.style.number_format.format_code = repanier.apps.REPANIER_SETTINGS_CURRENCY_XLSX
+                c.style.number_format.format_code = context.currency_xlsx
                 c.style.font.bold = True
                 formula_main_total_a.append(formula)
                 c = ws.cell(row=row_num, column=13)
                 formula = "SUM(N{}:N{})".format(row_start_producer, row_num)
                 c.value = "=" + formula
-                c.style.number_format.format_code = repanier.apps.REPANIER_SETTINGS_CURRENCY_XLSX
+                c.style.number_format.format_code = context.currency_xlsx
                 c.style.font.bold = True
                 formula_main_total_b.append(formula)
 
@@ -239,11 +241,11 @@ def export_permanence_stock(permanence, deliveries_id=(), customer_price=False,
             c.style.alignment.horizontal = c.style.alignment.HORIZONTAL_RIGHT
             c = ws.cell(row=row_num, column=9)
             c.value = "=" + "+".join(formula_main_total_a)
-            c.style.number_format.format_code = repanier.apps.REPANIER_SETTINGS_CURRENCY_XLSX
+            c.style.number_format.format_code = context.currency_xlsx
             c.style.font.bold = True
             c = ws.cell(row=row_num, column=13)
             c.value = "=" + "+".join(formula_main_total_b)
-            c.style.number_format.format_code = repanier.apps.REPANIER_SETTINGS_CURRENCY_XLSX
+            c.style.number_format.format_code = context.currency_xlsx
             c.style.font.bold = True
 
             row_num += 1
@@ -310,6 +312,7 @@ def export_permanence_stock(permanence, deliveries_id=(), customer_price=False,
 
 
 def export_producer_stock(producers, customer_price=False, wb=None):
+    context = ExportContext.get()
     yellowFill = Fill()
     yellowFill.start_color.index = 'FFEEEE11'
     yellowFill.end_color.index = 'FFEEEE11'
@@ -323,7 +326,7 @@ def export_producer_stock(producers, customer_price=False, wb=None):
         (_("Customer unit price") if customer_price else _("Producer unit price"), 10),
         (_("Deposit"), 10),
         (_("Inventory"), 10),
-        (repanier.apps.REPANIER_SETTINGS_CURRENCY_DISPLAY, 15),
+        (context.currency_display, 15),
     ]
     producers = producers.iterator()
     producer = next_row(producers)
@@ -331,7 +334,8 @@ def export_producer_stock(producers, customer_price=False, wb=None):
         wb,
         _('Inventory'),
         _('Inventory'),
-        header
+        header,
+        context=context
     )
     show_column_reference = False
     row_num = 1
@@ -380,11 +384,11 @@ def export_producer_stock(producers, customer_price=False, wb=None):
                 c = ws.cell(row=row_num, column=4)
                 unit_price = product.customer_unit_price if customer_price else product.producer_unit_price
                 c.value = unit_price.amount
-                c.style.number_format.format_code = repanier.apps.REPANIER_SETTINGS_CURRENCY_XLSX
+                c.style.number_format.format_code = context.currency_xlsx
                 c.style.borders.bottom.border_style = Border.BORDER_THIN
                 c = ws.cell(row=row_num, column=5)
                 c.value = product.unit_deposit.amount
-                c.style.number_format.format_code = repanier.apps.REPANIER_SETTINGS_CURRENCY_XLSX
+                c.style.number_format.format_code = context.currency_xlsx
                 c.style.borders.bottom.border_style = Border.BORDER_THIN
                 c = ws.cell(row=row_num, column=6)
                 c.value = product.stock
@@ -393,7 +397,7 @@ def export_producer_stock(producers, customer_price=False, wb=None):
                 c.style.borders.bottom.border_style = Border.BORDER_THIN
                 c = ws.cell(row=row_num, column=7)
                 c.value = "=ROUND((E{}+F{})*G{},2)".format(row_num + 1, row_num + 1, row_num + 1)
-                c.style.number_format.format_code = repanier.apps.REPANIER_SETTINGS_CURRENCY_XLSX
+                c.style.number_format.format_code = context.currency_xlsx
                 ws.conditional_formatting.addCellIs(
                     get_column_letter(8) + str(row_num + 1), 'notEqual',
                     [str(((unit_price.amount + product.unit_deposit.amount) * product.stock).quantize(TWO_DECIMALS))],
@@ -412,7 +416,7 @@ def export_producer_stock(producers, customer_price=False, wb=None):
         c = ws.cell(row=row_num, column=7)
         formula = "SUM(H{}:H{})".format(2, row_num)
         c.value = "=" + formula
-        c.style.number_format.format_code = repanier.apps.REPANIER_SETTINGS_CURRENCY_XLSX
+        c.style.number_format.format_code = context.currency_xlsx
         c.style.font.bold = True
 
         ws.column_dimensions[get_column_letter(1)].visible = False
@@ -428,30 +432,33 @@ def import_producer_stock(worksheet, producers=None):
     error_msg = None
     header = get_header(worksheet)
     if header:
-        row_num = 1
-        row = get_row(worksheet, header, row_num)
-        while row and not error:
+        # product_id -> counted stock
+        product_stocks = {}
+        for row_num, row in get_rows(worksheet, header):
             try:
-                # with transaction.atomic():
-                product_id = None if row[_('Id')] is None else Decimal(row[_('Id')])
+                product_id = None if row[_('Id')] is None else int(row[_('Id')])
                 if product_id is not None:
                     stock = DECIMAL_ZERO if row[_('Inventory')] is None else Decimal(
                         row[_('Inventory')]).quantize(
                         THREE_DECIMALS)
                     stock = stock if stock >= DECIMAL_ZERO else DECIMAL_ZERO
-                    Product.objects.filter(
-                        id=product_id, producer__in=producers
-                    ).update(stock=stock)
-                update_offer_item(product_id=product_id)
-                row_num += 1
-                row = get_row(worksheet, header, row_num)
+                    product_stocks[product_id] = stock
             except KeyError as e:
                 # Missing field
                 error = True
                 error_msg = _("Row %(row_num)d : A required column is missing.") % {'row_num': row_num + 1}
+                break
             except Exception as e:
                 error = True
                 error_msg = _("Row %(row_num)d : %(error_msg)s.") % {'row_num': row_num + 1, 'error_msg': str(e)}
+                break
+        if not error:
+            # One inventory movement per product whose stock has changed
+            product_ids = set_stock(product_stocks, Product.objects.filter(producer__in=producers))
+            for producer_id in Product.objects.filter(
+                    id__in=product_ids
+            ).order_by().values_list("producer_id", flat=True).distinct():
+                update_offer_item(producer_id=producer_id)
     return error, error_msg
 
 